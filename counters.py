@@ -0,0 +1,138 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# shared code for the counter requirements of core PMU events
+
+import json
+import re
+import metricexpr
+from typing import (Dict, Optional, Sequence, Set, TextIO, Tuple)
+
+# Shared MSRs that events program in addition to a counter.
+msr_names = {
+    '0x1a6': 'offcore',
+    '0x1a7': 'offcore',
+    '0x3f6': 'ldlat',
+    '0x3f7': 'frontend',
+}
+
+
+class EventCounters:
+    """The counters and MSRs an event may use."""
+
+    def __init__(self, name: str, counters: Set[int], counters_htoff: Set[int],
+                 fixed: Optional[int], taken_alone: bool, msrs: Sequence[str]):
+        self.name = name
+        # General purpose counters the event may use with and without
+        # hyper-threading enabled.
+        self.counters = counters
+        self.counters_htoff = counters_htoff
+        # The fixed counter number for a fixed counter event.
+        self.fixed = fixed
+        self.taken_alone = taken_alone
+        # MSRs, any one of which the event needs.
+        self.msrs = msrs
+
+
+def parse_counter(counter: Optional[str]) -> Tuple[Set[int], Optional[int]]:
+    """Parse a Counter field like '0,1,2,3' or 'Fixed counter 1' into the
+    general purpose counters and the fixed counter."""
+    if not counter:
+        return (set(), None)
+    m = re.search(r'fixed counter\s*(\d+)', counter, re.IGNORECASE)
+    if m:
+        return (set(), int(m.group(1)))
+    gp = set()
+    fixed = None
+    for x in counter.split(','):
+        x = x.strip()
+        if not x.isdigit():
+            continue
+        if int(x) >= 32:
+            # Newer event files number fixed counters from 32.
+            fixed = int(x) - 32
+        else:
+            gp.add(int(x))
+    return (gp, fixed)
+
+
+def read_event_json(files: Sequence[TextIO]) -> Dict[str, EventCounters]:
+    """Read event json files, either those published or those generated
+    for perf, returning a map from upper case event name to its counters."""
+    result = {}
+    for f in files:
+        jf = json.load(f)
+        if isinstance(jf, dict) and jf["Header"]:
+            jf = jf["Events"]
+        for j in jf:
+            if 'EventName' not in j:
+                continue
+            counters, fixed = parse_counter(j.get('Counter'))
+            counters_htoff, _ = parse_counter(j.get('CounterHTOff', j.get('Counter')))
+            msrs = []
+            msr_index = j.get('MSRIndex', '0x00')
+            for x in msr_index.split(','):
+                x = x.strip().lower()
+                if x and int(x, 16) != 0:
+                    msrs.append(x)
+            result[j['EventName'].upper()] = EventCounters(
+                j['EventName'], counters, counters_htoff or counters, fixed,
+                j.get('TakenAlone', '0') == '1', msrs)
+    return result
+
+
+def num_counters(events: Dict[str, EventCounters], htoff: bool = False) -> int:
+    """The number of general purpose counters, assumed to be one more than
+    the largest counter any event uses."""
+    result = 0
+    for e in events.values():
+        counters = e.counters_htoff if htoff else e.counters
+        if counters:
+            result = max(result, max(counters) + 1)
+    return result
+
+
+def find_event(event: str, events: Dict[str, EventCounters]) -> Optional[EventCounters]:
+    """Find the counters for an event in a MetricExpr, None for events not
+    in a core PMU event list."""
+    name = metricexpr.event_name(event)
+    if name in events:
+        return events[name]
+    return None
+
+
+def is_core_event(event: str, unit: str = '') -> bool:
+    """Is the event from a MetricExpr counted by the core PMU?"""
+    if event in metricexpr.software_events:
+        return False
+    pmu = metricexpr.event_pmu(event)
+    return pmu in ('cpu', unit or 'cpu', 'cpu_core', 'cpu_atom')
+
+
+def is_topdown_event(event: str) -> bool:
+    """Topdown events are read from the PERF_METRICS MSR with TOPDOWN.SLOTS
+    rather than using their own counter."""
+    return event.startswith('topdown\\-')
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# resolve CPUIDs to perf json model directories with a precompiled mapfile
+# cpuid.py mapfile.csv [GenuineIntel-6-55-4 ...] [--host] [--inventory hosts.csv]
+import argparse
+import csv
+import importlib
+import re
+import sys
+import urllib.request
+from typing import (Dict, Iterable, List, Optional, Sequence, Set, TextIO, Tuple)
+
+# A concrete CPUID: vendor, family, model and stepping, None when the
+# CPUID has no stepping.
+Key = Tuple[str, int, int, Optional[int]]
+
+
+def parse_cpuid(cpuid: str) -> Key:
+    """Parse a CPUID in perf's form, like GenuineIntel-6-55-4, where the
+    family is decimal and the model and stepping are hex."""
+    m = re.fullmatch(r'\s*([A-Za-z]+)-(\d+)-([0-9A-Fa-f]+)(?:-([0-9A-Fa-f]+))?\s*', cpuid)
+    if not m:
+        raise Exception(f'Invalid CPUID {cpuid}')
+    stepping = int(m.group(4), 16) if m.group(4) else None
+    return (m.group(1), int(m.group(2)), int(m.group(3), 16), stepping)
+
+
+def expand(pattern: str) -> Set[Key]:
+    """The concrete CPUIDs a Family-model pattern matches."""
+    r = re.compile(pattern, re.IGNORECASE)
+    prefix = re.match(r'([A-Za-z]+)-(\d+)-', pattern)
+    if prefix:
+        vendor_families = [(prefix.group(1), int(prefix.group(2)))]
+    else:
+        vendor = re.match(r'[A-Za-z]+', pattern)
+        if not vendor:
+            raise Exception(f'No vendor in Family-model {pattern}')
+        vendor_families = [(vendor.group(0), f) for f in range(32)]
+    result = set()
+    for vendor, family in vendor_families:
+        for model in range(256):
+            # perf doesn't pad the model but mapfiles may.
+            for m in {f'{model:X}', f'{model:02X}'}:
+                base = f'{vendor}-{family}-{m}'
+                if r.fullmatch(base):
+                    result.add((vendor, family, model, None))
+                for stepping in range(16):
+                    if r.fullmatch(f'{base}-{stepping:X}'):
+                        result.add((vendor, family, model, stepping))
+    return result
+
+
+def read_mapfile(f: Iterable[str]) -> List[Tuple[str, str]]:
+    """Read the Family-model pattern and model directory of each line of a
+    generated or upstream mapfile.csv. The directory of an upstream line is
+    that of its Filename, like SKX."""
+    result = []
+    for row in csv.reader(f):
+        if not row or row[0].startswith('#') or row[0] == 'Family-model' or len(row) < 3:
+            continue
+        directory = row[2]
+        if '/' in directory:
+            directory = directory.strip('/').split('/')[0]
+        result.append((row[0], directory))
+    return result
+
+
+class Resolver:
+    """Every pattern of a mapfile expanded into tables, so each lookup is a
+    dictionary access rather than a regex match per line. As in perf the
+    first matching line wins. Each table holds the index of the first line
+    with a match and its directory."""
+
+    def __init__(self, lines: Sequence[Tuple[str, str]]):
+        # CPUIDs with a stepping matched by patterns with a stepping.
+        self.exact : Dict[Key, Tuple[int, str]] = {}
+        # Family and model matched by patterns without a stepping, for any
+        # stepping.
+        self.models : Dict[Tuple[str, int, int], Tuple[int, str]] = {}
+        # Family and model matched by patterns with a stepping, for CPUIDs
+        # without one.
+        self.any_stepping : Dict[Tuple[str, int, int], Tuple[int, str]] = {}
+        for i, (pattern, directory) in enumerate(lines):
+            for vendor, family, model, stepping in expand(pattern):
+                vfm = (vendor.lower(), family, model)
+                if stepping is None:
+                    self.models.setdefault(vfm, (i, directory))
+                else:
+                    self.exact.setdefault(vfm + (stepping,), (i, directory))
+                    self.any_stepping.setdefault(vfm, (i, directory))
+
+    def lookup(self, cpuid: str) -> Optional[str]:
+        """The model directory for a CPUID, None if no line matches."""
+        vendor, family, model, stepping = parse_cpuid(cpuid)
+        vfm = (vendor.lower(), family, model)
+        if stepping is not None:
+            found = [self.exact.get(vfm + (stepping,)), self.models.get(vfm)]
+        else:
+            found = [self.models.get(vfm), self.any_stepping.get(vfm)]
+        matches = [x for x in found if x]
+        return min(matches)[1] if matches else None
+
+
+def check_mapfile_lines(archs: Iterable) -> List[str]:
+    """Check the pattern mapfile_line writes for each Model matches exactly
+    the CPUIDs of its models, returning a description of each mismatch."""
+    errors = []
+    for model in archs:
+        line = model.mapfile_line().split(',')[0]
+        expected = set()
+        for m in model.models:
+            expected |= expand(m)
+        try:
+            got = expand(line)
+        except re.error as e:
+            errors.append(f'{model.longname}: invalid pattern {line} for {model.models}: {e}')
+            continue
+        if got != expected:
+            errors.append(f'{model.longname}: {line} matches {len(got - expected)} extra '
+                          f'and misses {len(expected - got)} CPUIDs of {model.models}')
+    return errors
+
+
+def resolve_inventory(resolver: Resolver, f: TextIO, out: TextIO):
+    """Append the model directory to each CSV row of an inventory, where
+    the last field of a row is the CPUID, like host,GenuineIntel-6-55-4."""
+    w = csv.writer(out)
+    for row in csv.reader(f):
+        if not row or row[0].startswith('#'):
+            continue
+        try:
+            model = resolver.lookup(row[-1])
+        except Exception:
+            model = None
+        w.writerow(row + [model or ''])
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Find the perf json model directory of CPUIDs')
+    ap.add_argument('mapfile', help='Generated or upstream mapfile.csv, a path or URL')
+    ap.add_argument('cpuid', nargs='*', help='CPUIDs like GenuineIntel-6-55-4')
+    ap.add_argument('--host', action='store_true', help='Resolve the CPUID of this machine')
+    ap.add_argument('--inventory', type=argparse.FileType('r'),
+                    help='CSV of hosts whose last field is the CPUID, - for stdin')
+    ap.add_argument('--check', action='store_true',
+                    help='Check the patterns generated for an upstream mapfile match its models')
+    ap.add_argument(
+        '--metrics-url',
+        default='https://raw.githubusercontent.com/intel/perfmon-metrics/main')
+    args = ap.parse_args()
+
+    if args.check:
+        download_and_gen = importlib.import_module('download_and_gen')
+        base_url = args.mapfile.removesuffix('/mapfile.csv')
+        errors = check_mapfile_lines(download_and_gen.Mapfile(base_url, args.metrics_url).archs)
+        for e in errors:
+            print(e)
+        sys.exit(1 if errors else 0)
+
+    if '://' in args.mapfile:
+        with urllib.request.urlopen(args.mapfile) as f:
+            lines = read_mapfile(l.decode('utf-8') for l in f.readlines())
+    else:
+        with open(args.mapfile, 'r') as f:
+            lines = read_mapfile(f)
+    resolver = Resolver(lines)
+
+    cpuids = list(args.cpuid)
+    if args.host:
+        cpuids.append(importlib.import_module('download_and_gen').host_cpuid())
+    found = True
+    for c in cpuids:
+        model = resolver.lookup(c)
+        print(f'{c} {model if model else "-"}')
+        found = found and model is not None
+    if args.inventory:
+        resolve_inventory(resolver, args.inventory, sys.stdout)
+    sys.exit(0 if found else 1)
+
+
+if __name__ == '__main__':
+    main()
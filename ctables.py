@@ -0,0 +1,922 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# emit perf's pmu-events.c tables, as jevents.py would, from perf json events, and check them
+import collections
+import json
+import os
+import re
+from typing import (Dict, List, NamedTuple, Optional, Sequence, Tuple)
+
+# The fields of an event and of a metric in the big string, in the order
+# of jevents.py and of the decompress functions generated from them. Those
+# of ENUM_ATTRIBUTES are one character, the others end with a NUL, and an
+# empty one is absent.
+EVENT_ATTRIBUTES = ['name', 'topic', 'desc', 'event', 'compat', 'deprecated',
+                    'perpkg', 'unit', 'long_desc']
+METRIC_ATTRIBUTES = ['metric_name', 'metric_group', 'metric_expr', 'metric_threshold',
+                     'desc', 'long_desc', 'unit', 'compat', 'metricgroup_no_group',
+                     'default_metricgroup_name', 'aggr_mode', 'event_grouping']
+ENUM_ATTRIBUTES = {'aggr_mode', 'deprecated', 'event_grouping', 'perpkg'}
+
+# The PMU of events without a Unit.
+DEFAULT_PMU = 'default_core'
+
+# Units whose PMU isn't uncore_ and the lowercase unit.
+PMUS = {
+    'CBO': 'uncore_cbox',
+    'QPI LL': 'uncore_qpi',
+    'SBO': 'uncore_sbox',
+    'iMPH-U': 'uncore_arb',
+    'UPI LL': 'uncore_upi',
+    'cpu_core': 'cpu_core',
+    'cpu_atom': 'cpu_atom',
+}
+
+# Events with fixed encodings, by lowercase name.
+FIXED_EVENTS = {
+    'inst_retired.any': 'event=0xc0,period=2000003',
+    'inst_retired.any_p': 'event=0xc0,period=2000003',
+    'cpu_clk_unhalted.ref': 'event=0x0,umask=0x03,period=2000003',
+    'cpu_clk_unhalted.thread': 'event=0x3c,period=2000003',
+    'cpu_clk_unhalted.core': 'event=0x3c,period=2000003',
+    'cpu_clk_unhalted.thread_any': 'event=0x3c,any=1,period=2000003',
+}
+
+# Event fields and the perf event terms they become.
+EVENT_TERMS = [
+    ('AnyThread', 'any='),
+    ('PortMask', 'ch_mask='),
+    ('CounterMask', 'cmask='),
+    ('EdgeDetect', 'edge='),
+    ('FCMask', 'fc_mask='),
+    ('Invert', 'inv='),
+    ('SampleAfterValue', 'period='),
+    ('UMask', 'umask='),
+    ('NodeType', 'type='),
+    ('RdWrMask', 'rdwrmask='),
+]
+
+MSR_TERMS = {'0x3F6': 'ldlat=', '0x1A6': 'offcore_rsp=', '0x1A7': 'offcore_rsp=',
+             '0x3F7': 'frontend='}
+
+AGGR_MODES = {'PerChip': '1', 'PerCore': '2'}
+
+EVENT_GROUPINGS = {
+    'NO_GROUP_EVENTS': '1',
+    'NO_GROUP_EVENTS_NMI': '2',
+    'NO_NMI_WATCHDOG': '2',
+    'NO_GROUP_EVENTS_SMT': '3',
+}
+
+
+class Entry(NamedTuple):
+    pmu: str
+    # Values in the order of EVENT_ATTRIBUTES or METRIC_ATTRIBUTES. Those of
+    # ENUM_ATTRIBUTES are a character, the others None when absent.
+    values: Tuple[Optional[str], ...]
+
+
+class ModelTables(NamedTuple):
+    events: List[Entry]
+    metrics: List[Entry]
+
+
+class Tables(NamedTuple):
+    # The CPUID pattern, version, model directory and type of each line of
+    # mapfile.csv.
+    mapfile: List[Tuple[str, str, str, str]]
+    models: Dict[str, ModelTables]
+
+
+def unit_to_pmu(unit: Optional[str]) -> str:
+    if not unit:
+        return DEFAULT_PMU
+    return PMUS.get(unit, f'uncore_{unit.lower()}')
+
+
+def _fixdesc(s: Optional[str]) -> Optional[str]:
+    if s is None:
+        return None
+    return s.removesuffix('.  ').removesuffix('. ').removesuffix('.')
+
+
+def _llx(x: int) -> str:
+    return str(x) if 0 <= x < 10 else hex(x)
+
+
+def _values(attributes: Sequence[str], fields: Dict[str, Optional[str]]) -> Tuple[Optional[str], ...]:
+    values = []
+    for attr in attributes:
+        v = fields.get(attr) or None
+        if attr in ENUM_ATTRIBUTES:
+            v = v or '0'
+            if len(v) != 1:
+                raise Exception(f'{attr} {v} is not one character')
+        values.append(v)
+    return tuple(values)
+
+
+def _entries(topic: str, j: Dict[str, str]) -> List[Tuple[bool, Entry]]:
+    # The event and the metric of a record, as jevents.py's JsonEvent reads
+    # it, paired with whether each is a metric.
+    if any(not isinstance(v, str) for v in j.values()):
+        raise Exception(f'Non-string value in {j}')
+    pmu = unit_to_pmu(j.get('Unit'))
+    name = j['EventName'].lower() if 'EventName' in j else None
+    desc = _fixdesc(j.get('BriefDescription'))
+    long_desc = _fixdesc(j.get('PublicDescription'))
+    extra_desc = ''
+    if 'Data_LA' in j:
+        extra_desc += '  Supports address when precise'
+        if 'Errata' in j:
+            extra_desc += '.'
+    if 'Errata' in j:
+        extra_desc += '  Spec update: ' + j['Errata']
+    precise = j.get('PEBS')
+    if precise and desc and '(Precise Event)' not in desc:
+        extra_desc += ' (Must be precise)' if precise == '2' else ' (Precise event)'
+    if desc and extra_desc:
+        desc += extra_desc
+    if long_desc and extra_desc:
+        long_desc += extra_desc
+    if pmu != DEFAULT_PMU:
+        desc = desc + '. Unit: ' + pmu if desc else 'Unit: ' + pmu
+
+    eventcode = int(j['EventCode'].split(',', 1)[0], 0) if 'EventCode' in j else 0
+    if 'ExtSel' in j:
+        eventcode |= int(j['ExtSel']) << 8
+    if 'ConfigCode' in j:
+        event = f'config={_llx(int(j["ConfigCode"], 0))}'
+    else:
+        event = f'event={_llx(eventcode)}'
+    for key, term in EVENT_TERMS:
+        if key in j and j[key] != '0':
+            event += ',' + term + j[key]
+    if j.get('Filter'):
+        event += ',' + j['Filter']
+    msr = MSR_TERMS.get(j.get('MSRIndex', '').split(',', 1)[0])
+    if msr:
+        event += ',' + msr + j['MSRValue']
+    if name in FIXED_EVENTS:
+        event = FIXED_EVENTS[name]
+
+    result = []
+    if name:
+        result.append((False, Entry(pmu, _values(EVENT_ATTRIBUTES, {
+            'name': name, 'topic': topic, 'desc': desc, 'event': event,
+            'compat': j.get('Compat'), 'deprecated': j.get('Deprecated'),
+            'perpkg': j.get('PerPkg'), 'unit': j.get('ScaleUnit'),
+            'long_desc': long_desc}))))
+    if j.get('MetricName'):
+        result.append((True, Entry(pmu, _values(METRIC_ATTRIBUTES, {
+            'metric_name': j['MetricName'], 'metric_group': j.get('MetricGroup'),
+            'metric_expr': j.get('MetricExpr'),
+            'metric_threshold': j.get('MetricThreshold'),
+            'desc': desc, 'long_desc': long_desc, 'unit': j.get('ScaleUnit'),
+            'compat': j.get('Compat'),
+            'metricgroup_no_group': j.get('MetricgroupNoGroup'),
+            'default_metricgroup_name': j.get('DefaultMetricgroupName'),
+            'aggr_mode': AGGR_MODES.get(j.get('AggregationMode')),
+            'event_grouping': EVENT_GROUPINGS.get(j.get('MetricConstraint'))}))))
+    return result
+
+
+def topic_tables(topics: Dict[str, list]) -> ModelTables:
+    """The entries of the records of each json file name in topics, done
+    where the normalized records are, before they're dropped."""
+    tables = ModelTables([], [])
+    for fn, records in topics.items():
+        if fn.endswith('metrics.json'):
+            topic = 'metrics'
+        else:
+            topic = fn.removesuffix('.json').replace('-', ' ')
+        for j in records:
+            for metric, entry in _entries(topic, j):
+                (tables.metrics if metric else tables.events).append(entry)
+    return tables
+
+
+def merge(tables: Sequence[ModelTables]) -> ModelTables:
+    return ModelTables([e for t in tables for e in t.events],
+                       [m for t in tables for m in t.metrics])
+
+
+def read_tree(tree: str) -> Tables:
+    """The tables of each model in mapfile.csv of a perf json tree."""
+    mapfile = []
+    with open(f'{tree}/mapfile.csv', 'r') as f:
+        for l in f:
+            row = l.rstrip('\n').split(',')
+            if len(row) == 4 and row[0] != 'Family-model':
+                mapfile.append(tuple(row))
+    models = {}
+    for _, _, name, _ in mapfile:
+        if name in models:
+            continue
+        topics = {}
+        for fn in sorted(os.listdir(f'{tree}/{name}')):
+            if fn.endswith('.json'):
+                with open(f'{tree}/{name}/{fn}', 'r') as f:
+                    topics[fn] = json.load(f)
+        models[name] = topic_tables(topics)
+    return Tables(mapfile, models)
+
+
+def _by_pmu(entries: Sequence[Entry]) -> Dict[str, List[Entry]]:
+    # Each PMU's entries in name order, as strcasecmp orders the lowercase
+    # event names for pmu_events_table__find_event's binary search.
+    pmus = collections.defaultdict(list)
+    for e in entries:
+        pmus[e.pmu].append(e)
+    for es in pmus.values():
+        es.sort(key=lambda x: (x.values[0].encode('utf-8'), [v or '' for v in x.values]))
+    return dict(sorted(pmus.items()))
+
+
+def _compact(attributes: Sequence[str], values: Tuple[Optional[str], ...]) -> str:
+    # The fields of an entry in the big string, the decompress functions
+    # read them in order.
+    return ''.join(v if a in ENUM_ATTRIBUTES else (v or '') + '\0'
+                   for a, v in zip(attributes, values))
+
+
+class StringTable:
+    """Every distinct string once, each followed by a NUL, in one char
+    array. A string that is the tail of another is the other's tail rather
+    than a copy."""
+
+    def __init__(self, strings: Sequence[str]):
+        self.offsets : Dict[str, int] = {}
+        self.strings : List[Tuple[int, str]] = []
+        pos = 0
+        last = None
+        # Sorted by their reverse, a string is the tail of another only if
+        # it is the tail of the one just before it.
+        for s in sorted(set(strings), key=lambda x: x[::-1], reverse=True):
+            if last is not None and last.endswith(s):
+                self.offsets[s] = self.offsets[last] + \
+                    len(last.encode('utf-8')) - len(s.encode('utf-8'))
+                continue
+            self.offsets[s] = pos
+            self.strings.append((pos, s))
+            pos += len(s.encode('utf-8')) + 1
+            last = s
+        self.size = pos
+
+
+def _c_string(s: str) -> str:
+    result = []
+    for b in s.encode('utf-8'):
+        c = chr(b)
+        if c in '\\"?':
+            result.append('\\' + c)
+        elif 0x20 <= b < 0x7f:
+            result.append(c)
+        else:
+            result.append(f'\\{b:03o}')
+    return ''.join(result)
+
+
+def _comment(s: str) -> str:
+    return s.replace('*/', '*\\/')
+
+
+def _decompress(kind: str, var: str, attributes: Sequence[str]) -> List[str]:
+    out = [f'static void decompress_{kind}(int offset, struct pmu_{kind} *{var})',
+           '{',
+           '\tconst char *p = &big_c_string[offset];',
+           '']
+    for attr in attributes:
+        if attr in ENUM_ATTRIBUTES:
+            out.append(f"\t{var}->{attr} = *p - '0';")
+        else:
+            out.append(f"\t{var}->{attr} = (*p == '\\0' ? NULL : p);")
+        if attr != attributes[-1]:
+            out.append('\tp++;' if attr in ENUM_ATTRIBUTES else '\twhile (*p++);')
+    return out + ['}', '']
+
+
+def emit_c(tables: Tables) -> str:
+    """The pmu-events.c of tables, implementing the pmu-events.h of perf in
+    place of the one jevents.py generates.
+
+    Each event and metric is an int offset into one big_c_string, at its
+    fields one after another, and a string that is the tail of another is
+    stored once. Each PMU's events are sorted by name for binary search."""
+    models = {name: (_by_pmu(m.events), _by_pmu(m.metrics))
+              for name, m in tables.models.items()}
+    strings = []
+    for events, metrics in models.values():
+        for pmus, attributes in ((events, EVENT_ATTRIBUTES), (metrics, METRIC_ATTRIBUTES)):
+            for pmu, entries in pmus.items():
+                strings.append(pmu)
+                strings += [_compact(attributes, e.values) for e in entries]
+    table = StringTable(strings)
+
+    out = ['/* Generated from perf json by download_and_gen.py or perf-json-to-c.py,',
+           ' * do not edit. The tables and functions of pmu-events.h, in place of',
+           ' * those jevents.py generates.',
+           ' */',
+           '#include <pmu-events/pmu-events.h>',
+           '#include "util/header.h"',
+           '#include "util/pmu.h"',
+           '#include <stddef.h>',
+           '#include <stdint.h>',
+           '#include <stdlib.h>',
+           '#include <string.h>',
+           '#include <strings.h>',
+           '',
+           'struct compact_pmu_event {',
+           '\tint offset;',
+           '};',
+           '',
+           'struct pmu_table_entry {',
+           '\tconst struct compact_pmu_event *entries;',
+           '\tuint32_t num_entries;',
+           '\tstruct compact_pmu_event pmu_name;',
+           '};',
+           '',
+           'static const char *const big_c_string =']
+    for pos, s in table.strings:
+        out.append(f'/* offset={pos} */ "{_c_string(s)}\\000"')
+    out += [';', '']
+
+    for name, (events, metrics) in models.items():
+        for kind, pmus, attributes in (('events', events, EVENT_ATTRIBUTES),
+                                       ('metrics', metrics, METRIC_ATTRIBUTES)):
+            tblname = f'pmu_{kind}__{name.replace("-", "_")}'
+            for pmu, entries in pmus.items():
+                out.append(f'static const struct compact_pmu_event '
+                           f'{tblname}_{pmu.replace(",", "_")}[] = {{')
+                out += [f'{{ {table.offsets[_compact(attributes, e.values)]} }}, '
+                        f'/* {_comment(e.values[0])} */' for e in entries]
+                out += ['};', '']
+            if not pmus:
+                continue
+            out.append(f'static const struct pmu_table_entry {tblname}[] = {{')
+            for pmu in pmus:
+                entries = f'{tblname}_{pmu.replace(",", "_")}'
+                out += ['{',
+                        f'\t.entries = {entries},',
+                        f'\t.num_entries = ARRAY_SIZE({entries}),',
+                        f'\t.pmu_name = {{ {table.offsets[pmu]} /* {_comment(pmu)} */ }},',
+                        '},']
+            out += ['};', '']
+
+    out += ['/* Struct used to make the PMU event table implementation opaque to callers. */',
+            'struct pmu_events_table {',
+            '\tconst struct pmu_table_entry *pmus;',
+            '\tuint32_t num_pmus;',
+            '};',
+            '',
+            '/* Struct used to make the PMU metric table implementation opaque to callers. */',
+            'struct pmu_metrics_table {',
+            '\tconst struct pmu_table_entry *pmus;',
+            '\tuint32_t num_pmus;',
+            '};',
+            '',
+            '/*',
+            ' * Map a CPU to its table of PMU events. The CPU is identified by the',
+            ' * cpuid field, which is an arch-specific identifier for the CPU.',
+            ' * The identifier specified in tools/perf/pmu-events/arch/xxx/mapfile',
+            ' * must match the get_cpuid_str() in tools/perf/arch/xxx/util/header.c)',
+            ' *',
+            ' * The  cpuid can contain any character other than the comma.',
+            ' */',
+            'struct pmu_events_map {',
+            '\tconst char *arch;',
+            '\tconst char *cpuid;',
+            '\tstruct pmu_events_table event_table;',
+            '\tstruct pmu_metrics_table metric_table;',
+            '};',
+            '',
+            '/*',
+            ' * Global table mapping each known CPU for the architecture to its',
+            ' * table of PMU events.',
+            ' */',
+            'static const struct pmu_events_map pmu_events_map[] = {']
+    for cpuid, _, name, _ in tables.mapfile:
+        events, metrics = models[name]
+        out += ['{',
+                '\t.arch = "x86",',
+                f'\t.cpuid = "{_c_string(cpuid)}",']
+        for kind, field, pmus in (('events', 'event_table', events),
+                                  ('metrics', 'metric_table', metrics)):
+            tblname = f'pmu_{kind}__{name.replace("-", "_")}'
+            out += [f'\t.{field} = {{',
+                    f'\t\t.pmus = {tblname if pmus else "NULL"},',
+                    f'\t\t.num_pmus = {f"ARRAY_SIZE({tblname})" if pmus else "0"}',
+                    '\t},']
+        out.append('},')
+    out += ['{',
+            '\t.arch = 0,',
+            '\t.cpuid = 0,',
+            '\t.event_table = { 0, 0 },',
+            '\t.metric_table = { 0, 0 },',
+            '}',
+            '};',
+            '',
+            'struct pmu_sys_events {',
+            '\tconst char *name;',
+            '\tstruct pmu_events_table event_table;',
+            '\tstruct pmu_metrics_table metric_table;',
+            '};',
+            '',
+            '/* x86 has no system PMU events. */',
+            'static const struct pmu_sys_events pmu_sys_event_tables[] = {',
+            '\t{',
+            '\t\t.event_table = { 0, 0 },',
+            '\t\t.metric_table = { 0, 0 },',
+            '\t},',
+            '};',
+            '']
+    out += _decompress('event', 'pe', EVENT_ATTRIBUTES)
+    out += _decompress('metric', 'pm', METRIC_ATTRIBUTES)
+    out.append(FUNCTIONS)
+    return '\n'.join(out)
+
+
+# The functions of pmu-events.h, as jevents.py writes them.
+FUNCTIONS = '''static int pmu_events_table__for_each_event_pmu(const struct pmu_events_table *table,
+                                                const struct pmu_table_entry *pmu,
+                                                pmu_event_iter_fn fn,
+                                                void *data)
+{
+        int ret;
+        struct pmu_event pe = {
+                .pmu = &big_c_string[pmu->pmu_name.offset],
+        };
+
+        for (uint32_t i = 0; i < pmu->num_entries; i++) {
+                decompress_event(pmu->entries[i].offset, &pe);
+                if (!pe.name)
+                        continue;
+                ret = fn(&pe, table, data);
+                if (ret)
+                        return ret;
+        }
+        return 0;
+ }
+
+static int pmu_events_table__find_event_pmu(const struct pmu_events_table *table,
+                                            const struct pmu_table_entry *pmu,
+                                            const char *name,
+                                            pmu_event_iter_fn fn,
+                                            void *data)
+{
+        struct pmu_event pe = {
+                .pmu = &big_c_string[pmu->pmu_name.offset],
+        };
+        int low = 0, high = pmu->num_entries - 1;
+
+        while (low <= high) {
+                int cmp, mid = (low + high) / 2;
+
+                decompress_event(pmu->entries[mid].offset, &pe);
+
+                if (!pe.name && !name)
+                        goto do_call;
+
+                if (!pe.name && name) {
+                        low = mid + 1;
+                        continue;
+                }
+                if (pe.name && !name) {
+                        high = mid - 1;
+                        continue;
+                }
+
+                cmp = strcasecmp(pe.name, name);
+                if (cmp < 0) {
+                        low = mid + 1;
+                        continue;
+                }
+                if (cmp > 0) {
+                        high = mid - 1;
+                        continue;
+                }
+  do_call:
+                return fn ? fn(&pe, table, data) : 0;
+        }
+        return PMU_EVENTS__NOT_FOUND;
+}
+
+int pmu_events_table__for_each_event(const struct pmu_events_table *table,
+                                    struct perf_pmu *pmu,
+                                    pmu_event_iter_fn fn,
+                                    void *data)
+{
+        for (size_t i = 0; i < table->num_pmus; i++) {
+                const struct pmu_table_entry *table_pmu = &table->pmus[i];
+                const char *pmu_name = &big_c_string[table_pmu->pmu_name.offset];
+                int ret;
+
+                if (pmu && !pmu__name_match(pmu, pmu_name))
+                        continue;
+
+                ret = pmu_events_table__for_each_event_pmu(table, table_pmu, fn, data);
+                if (pmu || ret)
+                        return ret;
+        }
+        return 0;
+}
+
+int pmu_events_table__find_event(const struct pmu_events_table *table,
+                                 struct perf_pmu *pmu,
+                                 const char *name,
+                                 pmu_event_iter_fn fn,
+                                 void *data)
+{
+        for (size_t i = 0; i < table->num_pmus; i++) {
+                const struct pmu_table_entry *table_pmu = &table->pmus[i];
+                const char *pmu_name = &big_c_string[table_pmu->pmu_name.offset];
+                int ret;
+
+                if (!pmu__name_match(pmu, pmu_name))
+                        continue;
+
+                ret = pmu_events_table__find_event_pmu(table, table_pmu, name, fn, data);
+                if (ret != PMU_EVENTS__NOT_FOUND)
+                        return ret;
+        }
+        return PMU_EVENTS__NOT_FOUND;
+}
+
+size_t pmu_events_table__num_events(const struct pmu_events_table *table,
+                                    struct perf_pmu *pmu)
+{
+        size_t count = 0;
+
+        for (size_t i = 0; i < table->num_pmus; i++) {
+                const struct pmu_table_entry *table_pmu = &table->pmus[i];
+                const char *pmu_name = &big_c_string[table_pmu->pmu_name.offset];
+
+                if (pmu__name_match(pmu, pmu_name))
+                        count += table_pmu->num_entries;
+        }
+        return count;
+}
+
+static int pmu_metrics_table__for_each_metric_pmu(const struct pmu_metrics_table *table,
+                                                const struct pmu_table_entry *pmu,
+                                                pmu_metric_iter_fn fn,
+                                                void *data)
+{
+        int ret;
+        struct pmu_metric pm = {
+                .pmu = &big_c_string[pmu->pmu_name.offset],
+        };
+
+        for (uint32_t i = 0; i < pmu->num_entries; i++) {
+                decompress_metric(pmu->entries[i].offset, &pm);
+                if (!pm.metric_expr)
+                        continue;
+                ret = fn(&pm, table, data);
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+int pmu_metrics_table__for_each_metric(const struct pmu_metrics_table *table,
+                                     pmu_metric_iter_fn fn,
+                                     void *data)
+{
+        for (size_t i = 0; i < table->num_pmus; i++) {
+                int ret = pmu_metrics_table__for_each_metric_pmu(table, &table->pmus[i],
+                                                                 fn, data);
+
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+static const struct pmu_events_map *map_for_pmu(struct perf_pmu *pmu)
+{
+        static struct {
+                const struct pmu_events_map *map;
+                struct perf_pmu *pmu;
+        } last_result;
+        static struct {
+                const struct pmu_events_map *map;
+                char *cpuid;
+        } last_map_search;
+        static bool has_last_result, has_last_map_search;
+        const struct pmu_events_map *map = NULL;
+        char *cpuid = NULL;
+        size_t i;
+
+        if (has_last_result && last_result.pmu == pmu)
+                return last_result.map;
+
+        cpuid = perf_pmu__getcpuid(pmu);
+
+        /*
+         * On some platforms which uses cpus map, cpuid can be NULL for
+         * PMUs other than CORE PMUs.
+         */
+        if (!cpuid)
+                goto out_update_last_result;
+
+        if (has_last_map_search && !strcmp(last_map_search.cpuid, cpuid)) {
+                map = last_map_search.map;
+                free(cpuid);
+        } else {
+                i = 0;
+                for (;;) {
+                        map = &pmu_events_map[i++];
+
+                        if (!map->arch) {
+                                map = NULL;
+                                break;
+                        }
+
+                        if (!strcmp_cpuid_str(map->cpuid, cpuid))
+                                break;
+               }
+               free(last_map_search.cpuid);
+               last_map_search.cpuid = cpuid;
+               last_map_search.map = map;
+               has_last_map_search = true;
+        }
+out_update_last_result:
+        last_result.pmu = pmu;
+        last_result.map = map;
+        has_last_result = true;
+        return map;
+}
+
+const struct pmu_events_table *perf_pmu__find_events_table(struct perf_pmu *pmu)
+{
+        const struct pmu_events_map *map = map_for_pmu(pmu);
+
+        if (!map)
+                return NULL;
+
+        if (!pmu)
+                return &map->event_table;
+
+        for (size_t i = 0; i < map->event_table.num_pmus; i++) {
+                const struct pmu_table_entry *table_pmu = &map->event_table.pmus[i];
+                const char *pmu_name = &big_c_string[table_pmu->pmu_name.offset];
+
+                if (pmu__name_match(pmu, pmu_name))
+                         return &map->event_table;
+        }
+        return NULL;
+}
+
+const struct pmu_metrics_table *perf_pmu__find_metrics_table(struct perf_pmu *pmu)
+{
+        const struct pmu_events_map *map = map_for_pmu(pmu);
+
+        if (!map)
+                return NULL;
+
+        if (!pmu)
+                return &map->metric_table;
+
+        for (size_t i = 0; i < map->metric_table.num_pmus; i++) {
+                const struct pmu_table_entry *table_pmu = &map->metric_table.pmus[i];
+                const char *pmu_name = &big_c_string[table_pmu->pmu_name.offset];
+
+                if (pmu__name_match(pmu, pmu_name))
+                           return &map->metric_table;
+        }
+        return NULL;
+}
+
+const struct pmu_events_table *find_core_events_table(const char *arch, const char *cpuid)
+{
+        for (const struct pmu_events_map *tables = &pmu_events_map[0];
+             tables->arch;
+             tables++) {
+                if (!strcmp(tables->arch, arch) && !strcmp_cpuid_str(tables->cpuid, cpuid))
+                        return &tables->event_table;
+        }
+        return NULL;
+}
+
+const struct pmu_metrics_table *find_core_metrics_table(const char *arch, const char *cpuid)
+{
+        for (const struct pmu_events_map *tables = &pmu_events_map[0];
+             tables->arch;
+             tables++) {
+                if (!strcmp(tables->arch, arch) && !strcmp_cpuid_str(tables->cpuid, cpuid))
+                        return &tables->metric_table;
+        }
+        return NULL;
+}
+
+int pmu_for_each_core_event(pmu_event_iter_fn fn, void *data)
+{
+        for (const struct pmu_events_map *tables = &pmu_events_map[0];
+             tables->arch;
+             tables++) {
+                int ret = pmu_events_table__for_each_event(&tables->event_table,
+                                                           /*pmu=*/ NULL, fn, data);
+
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+int pmu_for_each_core_metric(pmu_metric_iter_fn fn, void *data)
+{
+        for (const struct pmu_events_map *tables = &pmu_events_map[0];
+             tables->arch;
+             tables++) {
+                int ret = pmu_metrics_table__for_each_metric(&tables->metric_table, fn, data);
+
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+const struct pmu_events_table *find_sys_events_table(const char *name)
+{
+        for (const struct pmu_sys_events *tables = &pmu_sys_event_tables[0];
+             tables->name;
+             tables++) {
+                if (!strcmp(tables->name, name))
+                        return &tables->event_table;
+        }
+        return NULL;
+}
+
+int pmu_for_each_sys_event(pmu_event_iter_fn fn, void *data)
+{
+        for (const struct pmu_sys_events *tables = &pmu_sys_event_tables[0];
+             tables->name;
+             tables++) {
+                int ret = pmu_events_table__for_each_event(&tables->event_table,
+                                                           /*pmu=*/ NULL, fn, data);
+
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+int pmu_for_each_sys_metric(pmu_metric_iter_fn fn, void *data)
+{
+        for (const struct pmu_sys_events *tables = &pmu_sys_event_tables[0];
+             tables->name;
+             tables++) {
+                int ret = pmu_metrics_table__for_each_metric(&tables->metric_table, fn, data);
+
+                if (ret)
+                        return ret;
+        }
+        return 0;
+}
+
+static const int metricgroups[][2] = {
+
+};
+
+const char *describe_metricgroup(const char *group)
+{
+        int low = 0, high = (int)ARRAY_SIZE(metricgroups) - 1;
+
+        while (low <= high) {
+                int mid = (low + high) / 2;
+                const char *mgroup = &big_c_string[metricgroups[mid][0]];
+                int cmp = strcmp(mgroup, group);
+
+                if (cmp == 0) {
+                        return &big_c_string[metricgroups[mid][1]];
+                } else if (cmp < 0) {
+                        low = mid + 1;
+                } else {
+                        high = mid - 1;
+                }
+        }
+        return NULL;
+}
+'''
+
+
+def _c_unescape(s: str) -> bytes:
+    return re.sub(rb'\\([0-7]{3}|.)',
+                  lambda m: bytes([int(m.group(1), 8)]) if len(m.group(1)) == 3
+                  else m.group(1), s.encode('ascii'))
+
+
+def parse_c(text: str) -> Tables:
+    """The tables of C written by emit_c, read back from the text rather
+    than from what emit_c was given, in the order of the C arrays."""
+    big = re.search(r'big_c_string =\n(.*?)\n;\n', text, re.S)
+    if not big:
+        raise Exception('No big_c_string')
+    data = b''
+    for l in big.group(1).split('\n'):
+        m = re.fullmatch(r'/\* offset=(\d+) \*/ "(.*)"', l)
+        if not m or int(m.group(1)) != len(data):
+            raise Exception(f'Bad big_c_string line {l}')
+        data += _c_unescape(m.group(2))
+
+    def string(offset: int) -> str:
+        if not 0 <= offset < len(data):
+            raise Exception(f'Bad string offset {offset}')
+        return data[offset:data.index(b'\0', offset)].decode('utf-8')
+
+    def entry(pmu: str, offset: int, attributes: Sequence[str]) -> Entry:
+        values = []
+        for attr in attributes:
+            if attr in ENUM_ATTRIBUTES:
+                values.append(chr(data[offset]))
+                offset += 1
+            else:
+                v = string(offset)
+                values.append(v or None)
+                offset += len(v.encode('utf-8')) + 1
+        return Entry(pmu, tuple(values))
+
+    arrays = {}
+    for name, body in re.findall(
+            r'static const struct compact_pmu_event (\w+)\[\] = \{\n(.*?)\n\};', text, re.S):
+        arrays[name] = [int(x) for x in re.findall(r'^\{ (\d+) \},', body, re.M)]
+    pmu_tables = {}
+    for name, body in re.findall(
+            r'static const struct pmu_table_entry (\w+)\[\] = \{\n(.*?)\n\};', text, re.S):
+        pmu_tables[name] = re.findall(r'\t\.entries = (\w+),\n'
+                                      r'\t\.num_entries = ARRAY_SIZE\(\1\),\n'
+                                      r'\t\.pmu_name = \{ (\d+) ', body)
+
+    def entries(name: str, attributes: Sequence[str]) -> List[Entry]:
+        if name == 'NULL':
+            return []
+        result = []
+        for array, pmu in pmu_tables[name]:
+            result += [entry(string(int(pmu)), x, attributes) for x in arrays[array]]
+        return result
+
+    mapfile = []
+    models = {}
+    for cpuid, events, metrics in re.findall(
+            r'\t\.arch = "x86",\n\t\.cpuid = "(.*)",\n'
+            r'\t\.event_table = \{\n\t\t\.pmus = (\w+),\n.*?\n\t\},\n'
+            r'\t\.metric_table = \{\n\t\t\.pmus = (\w+),', text):
+        # The model directory isn't in the C, name it by its tables.
+        name = events.removeprefix('pmu_events__') if events != 'NULL' \
+            else metrics.removeprefix('pmu_metrics__')
+        mapfile.append((_c_unescape(cpuid).decode('utf-8'), name))
+        models[name] = ModelTables(entries(events, EVENT_ATTRIBUTES),
+                                   entries(metrics, METRIC_ATTRIBUTES))
+    return Tables(mapfile, models)
+
+
+def verify(text: str, tables: Tables) -> List[str]:
+    """The differences between the C tables in text and tables, empty if
+    they have the same contents in the order binary search needs."""
+    problems = []
+    parsed = parse_c(text)
+    if parsed.mapfile != [(cpuid, name.replace('-', '_'))
+                          for cpuid, _, name, _ in tables.mapfile]:
+        problems.append('The mapfile lines differ')
+    for name, model in tables.models.items():
+        c = parsed.models.get(name.replace('-', '_'))
+        if c is None:
+            problems.append(f'{name} is missing')
+            continue
+        for kind, want, have in (('events', model.events, c.events),
+                                 ('metrics', model.metrics, c.metrics)):
+            want, have = _by_pmu(want), _by_pmu(have)
+            for pmu in sorted(set(want) | set(have)):
+                if want.get(pmu) != have.get(pmu):
+                    problems.append(f'The {pmu} {kind} of {name} differ')
+    for name, model in parsed.models.items():
+        # The order of the C itself, rather than that of _by_pmu.
+        if any(a.pmu == b.pmu and a.values[0].encode('utf-8') > b.values[0].encode('utf-8')
+               for a, b in zip(model.events, model.events[1:])):
+            problems.append(f'The events of {name} are not sorted by name')
+    return problems
@@ -1,22 +1,131 @@
 #!/usr/bin/python
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 import csv
+import ctables
+import eventmemo
+import eventstore
+import filewatch
+import functools
+import hashlib
+import inputs
 import io
 import json
 import os
+import output
 import re
+import shutil
+import taskgraph
+import time
 import uncore_csv_json
-import urllib.request
+import zipfile
 import importlib
 from itertools import takewhile
-from typing import (Any, Dict, DefaultDict, Sequence, Set)
+from typing import (Any, Callable, Dict, DefaultDict, List, Optional, Sequence, Set, Tuple)
 
 json_to_perf_json = importlib.import_module('json-to-perf-json')
 hybrid_json_to_perf_json = importlib.import_module('hybrid-json-to-perf-json')
 extract_tma_metrics = importlib.import_module('extract-tma-metrics')
 
 
+# What a worker process returns for the caller to add to its own: the
+# counts of files written and the event memo's stats.
+WorkerStats = Tuple[Dict[str, int], Dict[str, Any]]
+
+
+def worker_stats() -> WorkerStats:
+    return output.take_counts(), eventmemo.take_stats()
+
+
+def add_worker_stats(*results: Optional[WorkerStats]):
+    # Tasks run in this process return None.
+    for counts, memo_stats in filter(None, results):
+        output.add_counts(counts)
+        eventmemo.add_stats(memo_stats)
+
+
+def normalize_pmu(unit: str, memo_file: Optional[str],
+                  content: inputs.Content) -> Tuple[Dict[str, list], WorkerStats]:
+    if memo_file:
+        eventmemo.load(memo_file)
+    return hybrid_json_to_perf_json.pmu_topics(inputs.text(content), unit), worker_stats()
+
+
+# What a worker process writing event files returns: its stats and, when
+# pmu-events C tables are wanted, those of the events while they're in
+# memory.
+ConvertResult = Tuple[Optional[WorkerStats], Optional[ctables.ModelTables]]
+
+
+def convert_core(outdir: str, memo_file: Optional[str], c_tables: bool,
+                 content: inputs.Content) -> ConvertResult:
+    if memo_file:
+        eventmemo.load(memo_file)
+    topics = json_to_perf_json.json_to_perf_json(io.StringIO(inputs.text(content)), outdir, '')
+    return worker_stats(), ctables.topic_tables(topics) if c_tables else None
+
+
+def convert_uncore(outdir: str, csvfile: str, c_tables: bool, uncore: inputs.Content,
+                   experimental: Optional[inputs.Content] = None) -> ConvertResult:
+    if inputs.find(csvfile):
+        uncore_csv = inputs.open_text(csvfile)
+    else:
+        uncore_csv = io.StringIO('')
+    with uncore_csv:
+        topics = uncore_csv_json.uncore_csv_json(
+            csvfile=uncore_csv,
+            jsonfile=io.StringIO(inputs.text(uncore)),
+            extrajsonfile=io.StringIO(inputs.text(experimental)) if experimental is not None else None,
+            targetdir=outdir,
+            all_events=True,
+            verbose=False)
+    return worker_stats(), ctables.topic_tables(topics) if c_tables else None
+
+
+def extract_metrics(cpu: str, cstate: bool, extramodel: str, unit: str, cse: bool,
+                    tma_metrics: inputs.Content, events: inputs.Content) -> list:
+    """Extract the TMA metrics of cpu, or of one core type of a hybrid
+    model."""
+    return extract_tma_metrics.extract_tma_metrics(
+        csvfile=inputs.lines(tma_metrics),
+        cpu=cpu,
+        extrajson=None,
+        cstate=cstate,
+        extramodel=extramodel,
+        unit=unit,
+        memory=True,
+        verbose=False,
+        outfile=None,
+        cse=cse,
+        eventsjson=[io.StringIO(inputs.text(events))])
+
+
+# The stages generating a model's json, and those redone when one of its
+# files changes.
+STAGES = frozenset(['core', 'uncore', 'metrics'])
+FILE_STAGES = {
+    'core': {'core', 'metrics'},
+    'atom': {'core', 'metrics'},
+    'uncore': {'uncore'},
+    'uncore experimental': {'uncore'},
+    'tma metrics': {'metrics'},
+    'e-core tma metrics': {'metrics'},
+    'extra metrics': {'metrics'},
+}
+
+# The TMA metrics of each core type of a hybrid model: the files key and
+# name of its TMA CSV and, by model shortname, the CPU column to extract.
+# The core type core uses the model's own column of the full TMA CSV.
+# Metrics are concatenated in this order. Core types without an entry get
+# no metrics.
+HYBRID_TMA = {
+    'core': ('tma metrics', 'TMA_Metrics-full.csv', {}),
+    'atom': ('e-core tma metrics', 'E-core_TMA_Metrics.csv', {'ADL': 'GRT'}),
+}
+
+
 class Model:
     shortname: str
     longname: str
@@ -25,12 +134,16 @@ class Model:
     models: Sequence[str]
 
     def __init__(self, shortname: str, longname: str, version: str,
-                 models: Set[str], files: Dict[str, str]):
+                 models: Set[str], files: Dict[str, str],
+                 core_types: Sequence[str] = ()):
         self.shortname = shortname
         self.longname = longname.lower()
         self.version = version
         self.models = sorted(models)
         self.files = files
+        # The files keys of the event json for each core type of a hybrid
+        # model, like atom and core.
+        self.core_types = sorted(core_types)
 
     def __lt__(self, other: Any) -> bool:
         # Sort by model number: min(self.models) < min(other.models)
@@ -40,113 +153,166 @@ class Model:
         return f'{self.shortname} / {self.longname}\n\tmodels={self.models}\n\t' + '\n\t'.join(
             [f'{type}_url = {url}' for (type, url) in self.files.items()])
 
-    def to_perf_json(self, outdir: str, csvdir: str):
+    def matches(self, cpuid: str) -> bool:
+        """Does the CPUID, like GenuineIntel-6-55-4, match one of the
+        Family-model patterns? A pattern without a stepping matches any
+        stepping. A CPUID without a stepping doesn't match a pattern with
+        one, which would match models, like SKX and CLX, that only differ
+        by stepping."""
+        def family_model(x: str) -> str:
+            return '-'.join(x.split('-')[:3])
+
+        for pattern in self.models:
+            if re.fullmatch(pattern, cpuid, re.IGNORECASE):
+                return True
+            if pattern.count('-') < 3 and \
+               re.fullmatch(family_model(pattern), family_model(cpuid), re.IGNORECASE):
+                return True
+        return False
+
+    def input_size(self, size: Callable[[str], int] = inputs.size) -> int:
+        """Total size of the model's own input files, an estimate of the
+        cost of generating it. The TMA CSVs, shared by every model, are left
+        out as they would dominate."""
+        shared = set(tma for tma, _, _ in HYBRID_TMA.values())
+        return sum(size(url) for key, url in self.files.items() if key not in shared)
+
+    def tma_jobs(self, tma_cpu: str) -> List[Tuple[str, bool, str, str, str, str]]:
+        """The TMA metrics extractions of the model, one for each core type
+        of a hybrid model in HYBRID_TMA, as tuples of the CPU column, whether
+        to add the cstate metrics, the model, the PMU and the files keys of
+        the TMA CSV and of the event json."""
+        if len(self.core_types) <= 1:
+            return [(tma_cpu, True, self.shortname, '', 'tma metrics', 'core')]
+        jobs = []
+        for t, (tma, _, cpus) in HYBRID_TMA.items():
+            if t not in self.core_types:
+                continue
+            if cpus and self.shortname not in cpus:
+                print(f'No {t} TMA metrics column for {self.shortname}')
+                continue
+            cpu = cpus[self.shortname] if cpus else tma_cpu
+            jobs.append((cpu, False, cpu if cpus else self.shortname, f'cpu_{t}', tma, t))
+        for t in self.core_types:
+            if t not in HYBRID_TMA:
+                print(f'No TMA metrics for the {t} cores of {self.shortname}')
+        if jobs:
+            # The cstate metrics are added once.
+            jobs[-1] = jobs[-1][:1] + (True,) + jobs[-1][2:]
+        return jobs
+
+    def metrics_input_hash(self, tma_cpu: str, cse: bool,
+                           read: Callable[[str], bytes] = inputs.read) -> str:
+        """Hash of the inputs the TMA metrics for the model depend on."""
+        def lines(url: str) -> Sequence[str]:
+            return read(url).decode('utf-8').splitlines(True)
+
+        result = ''
+        for i, (cpu, cstate, extramodel, unit, tma, events) in enumerate(self.tma_jobs(tma_cpu)):
+            if i == 0:
+                # This script merges the extra metrics.
+                with open(__file__, 'rb') as f:
+                    extra = [f.read(), read(self.files[events])]
+                if 'extra metrics' in self.files:
+                    extra.append(read(self.files['extra metrics']))
+            else:
+                extra = [read(self.files[events]), result.encode()]
+            result = extract_tma_metrics.input_hash(
+                lines(self.files[tma]), cpu, extramodel, unit, True, cstate, cse, extra)
+        return result
+
+    def add_tasks(self, graph: taskgraph.TaskGraph, outdir: str, csvdir: str,
+                  cse: bool, hashes: Optional[Dict[str, str]],
+                  fetch_task: Callable[[str], taskgraph.Task],
+                  stages: Set[str] = STAGES,
+                  memo_file: Optional[str] = None,
+                  c_tables: Optional[List[ctables.ModelTables]] = None) -> taskgraph.Task:
+        """Add the tasks generating the model's json in outdir to graph,
+        returning the task computing its mapfile line. fetch_task gives the
+        task fetching a URL, shared by every model. Only the given stages,
+        of STAGES, are generated. memo_file is the event memo kept between
+        runs, if any. The pmu-events C tables of the written files are added
+        to c_tables, if given."""
+        name = self.longname
+        done = []
         # Core event files.
-        if 'atom' in self.files:
-            with urllib.request.urlopen(self.files['atom']) as atom_json:
-                with urllib.request.urlopen(self.files['core']) as core_json:
-                    hybrid_json_to_perf_json.hybrid_json_to_perf_json(
-                        atom_json, core_json, outdir)
-        else:
-            with urllib.request.urlopen(self.files['core']) as core_json:
-                json_to_perf_json.json_to_perf_json(core_json, outdir, '')
+        if 'core' in stages and len(self.core_types) > 1:
+            topics = [graph.add(f'{name}: normalize cpu_{t} events',
+                                functools.partial(normalize_pmu, f'cpu_{t}', memo_file),
+                                [fetch_task(self.files[t])], cpu=True)
+                      for t in self.core_types]
+
+            def write_core(*results) -> ConvertResult:
+                merged = hybrid_json_to_perf_json.write_merged_topics(
+                    [topics for topics, _ in results], outdir)
+                add_worker_stats(*[stats for _, stats in results])
+                return None, ctables.topic_tables(merged) if c_tables is not None else None
+
+            done.append(graph.add(f'{name}: write core events', write_core, topics))
+        elif 'core' in stages:
+            done.append(graph.add(f'{name}: normalize core events',
+                                  functools.partial(convert_core, outdir, memo_file,
+                                                    c_tables is not None),
+                                  [fetch_task(self.files['core'])], cpu=True))
 
         # Uncore event files.
-        if 'uncore' in self.files:
+        if 'uncore' in self.files and 'uncore' in stages:
             uncore_csv_file = f'{csvdir}/perf-uncore-events-{self.shortname.lower()}.csv'
-            if os.path.exists(uncore_csv_file):
-                uncore_csv = open(uncore_csv_file, 'r')
-            else:
-                uncore_csv = io.StringIO('')
-            with urllib.request.urlopen(self.files['uncore']) as uncore_json:
-                if 'uncore experimental' in self.files:
-                    with urllib.request.urlopen(
-                            self.files['uncore experimental']
-                    ) as experimental_json:
-                        uncore_csv_json.uncore_csv_json(
-                            csvfile=uncore_csv,
-                            jsonfile=uncore_json,
-                            extrajsonfile=experimental_json,
-                            targetdir=outdir,
-                            all_events=True,
-                            verbose=False)
-                else:
-                    uncore_csv_json.uncore_csv_json(
-                        csvfile=uncore_csv,
-                        jsonfile=uncore_json,
-                        extrajsonfile=None,
-                        targetdir=outdir,
-                        all_events=True,
-                        verbose=False)
+            deps = [fetch_task(self.files['uncore'])]
+            if 'uncore experimental' in self.files:
+                deps.append(fetch_task(self.files['uncore experimental']))
+            done.append(graph.add(f'{name}: normalize uncore events',
+                                  functools.partial(convert_uncore, outdir, uncore_csv_file,
+                                                    c_tables is not None),
+                                  deps, cpu=True))
+
+        # Add the files written by the worker processes to the counts.
+        def count(*results: ConvertResult):
+            add_worker_stats(*[stats for stats, _ in results])
+            if c_tables is not None:
+                c_tables.extend(t for _, t in results)
+
+        counted = graph.add(f'{name}: count event files', count, done)
+        line = graph.add(f'{name}: mapfile line', self.mapfile_line, after=[counted])
+
         # TMA metrics.
         tma_cpu = extract_tma_metrics.find_tma_cpu(self.shortname)
-        if not tma_cpu:
-            return
+        if not tma_cpu or 'metrics' not in stages:
+            return line
         metrics_file = f'{outdir}/{self.shortname.replace("-","").lower()}-metrics.json'
-        with urllib.request.urlopen(self.files['tma metrics']) as tma_metrics:
-            tma_metrics_lines = [
-                l.decode('utf-8') for l in tma_metrics.readlines()
-            ]
-            outfile = open(metrics_file, 'w', encoding='ascii')
-            if 'atom' in self.files:
-                core_json = io.StringIO()
-                extract_tma_metrics.extract_tma_metrics(
-                    csvfile=tma_metrics_lines,
-                    cpu=tma_cpu,
-                    extrajson=None,
-                    cstate=False,
-                    extramodel=self.shortname,
-                    unit='cpu_core',
-                    memory=True,
-                    verbose=False,
-                    outfile=core_json)
-                atom_json = io.StringIO()
-                with urllib.request.urlopen(
-                        self.files['e-core tma metrics']) as e_core_tma_metrics:
-                    e_core_tma_metrics_lines = [
-                        l.decode('utf-8')
-                        for l in e_core_tma_metrics.readlines()
-                    ]
-                    e_core_tma_cpu = {
-                        'ADL': 'GRT',
-                    }[self.shortname]
-                    extract_tma_metrics.extract_tma_metrics(
-                        csvfile=e_core_tma_metrics_lines,
-                        cpu=e_core_tma_cpu,
-                        extrajson=None,
-                        cstate=True,
-                        extramodel=e_core_tma_cpu,
-                        unit='cpu_atom',
-                        memory=True,
-                        verbose=False,
-                        outfile=atom_json)
-                jo = json.loads(core_json.getvalue())
-                for event in json.loads(atom_json.getvalue()):
-                    jo.append(event)
-                outfile.write(
-                    json.dumps(
-                        jo, sort_keys=True, indent=4, separators=(',', ': ')))
-                outfile.write('\n')
-            else:
-                extract_tma_metrics.extract_tma_metrics(
-                    csvfile=tma_metrics_lines,
-                    cpu=tma_cpu,
-                    extrajson=None,
-                    cstate=True,
-                    extramodel=self.shortname,
-                    unit='',
-                    memory=True,
-                    verbose=False,
-                    outfile=outfile)
-
-        # Additional metrics
-        broken_extra_metrics = {}
-        if 'extra metrics' in self.files:
-            with urllib.request.urlopen(
-                    self.files['extra metrics']) as extra_metrics_json:
-                metrics_json = open(metrics_file, 'r')
-                metrics = json.load(metrics_json)
-                extra_metrics = json.load(extra_metrics_json)
+        jobs = self.tma_jobs(tma_cpu)
+        check = []
+        if hashes is not None:
+            # Only regenerate metrics whose inputs changed.
+            keys = [job[4] for job in jobs] + [job[5] for job in jobs] + ['extra metrics']
+            urls = [self.files[x] for x in keys if x in self.files]
+
+            def changed(*contents):
+                key = f'{self.longname}/{os.path.basename(metrics_file)}'
+                input_hash = self.metrics_input_hash(tma_cpu, cse,
+                                                     lambda x: inputs.data(contents[urls.index(x)]))
+                if hashes.get(key) == input_hash and os.path.exists(metrics_file):
+                    print(f'Metrics for {self.longname} are unchanged')
+                    return taskgraph.SKIP
+                hashes[key] = input_hash
+
+            check = [graph.add(f'{name}: hash metrics inputs', changed,
+                               [fetch_task(x) for x in urls])]
+        # The extraction for each core type is independent and the metrics
+        # are concatenated in order.
+        extracts = [graph.add(f'{name}: extract {unit or "TMA"} metrics',
+                              functools.partial(extract_metrics, cpu, cstate, extramodel,
+                                                unit, cse),
+                              [fetch_task(self.files[tma]), fetch_task(self.files[events])],
+                              after=check, cpu=True)
+                    for cpu, cstate, extramodel, unit, tma, events in jobs]
+
+        def merge_extras(*results):
+            metrics = [m for result in results[:len(jobs)] for m in result]
+            # Additional metrics
+            broken_extra_metrics = {}
+            if 'extra metrics' in self.files:
+                extra_metrics = json.loads(inputs.text(results[-1]))
                 for extra_metric in extra_metrics:
                     if self.shortname in broken_extra_metrics and extra_metric[
                             'MetricName'].lower() in broken_extra_metrics[
@@ -159,7 +325,7 @@ class Model:
                         # consistent units.
                         continue
                     metrics.append(extra_metric)
-                outfile = open(metrics_file, 'w', encoding='ascii')
+            with output.open_output(metrics_file) as outfile:
                 outfile.write(
                     json.dumps(
                         metrics,
@@ -167,6 +333,14 @@ class Model:
                         indent=4,
                         separators=(',', ': ')))
                 outfile.write('\n')
+            if c_tables is not None:
+                c_tables.append(ctables.topic_tables({os.path.basename(metrics_file): metrics}))
+
+        deps = list(extracts)
+        if 'extra metrics' in self.files:
+            deps.append(fetch_task(self.files['extra metrics']))
+        graph.add(f'{name}: merge extra metrics', merge_extras, deps)
+        return line
 
     def mapfile_line(self) -> str:
         if len(self.models) == 1:
@@ -198,90 +372,97 @@ class Model:
 class Mapfile:
     archs: Sequence[Model]
 
-    def __init__(self, base_url: str, metrics_url: str):
+    def __init__(self, base_url: str, metrics_url: str, cpuid: Optional[str] = None):
         self.archs = []
         longnames: Dict[str, str] = {}
         models: DefaultDict[str, Set[str]] = collections.defaultdict(set)
         files: Dict[str, Dict[str, str]] = collections.defaultdict(dict)
+        core_types: DefaultDict[str, Set[str]] = collections.defaultdict(set)
         versions: Dict[str, str] = {}
         print(f'Analyzing {base_url}/mapfile.csv')
-        with urllib.request.urlopen(base_url + '/mapfile.csv') as mapfile_csv:
-            mapfile_csv_lines = [
-                l.decode('utf-8') for l in mapfile_csv.readlines()
-            ]
-            mapfile = csv.reader(mapfile_csv_lines)
-            first_row = True
-            for l in mapfile:
-                while len(l) < 7:
-                    # Fix missing columns.
-                    l.append('')
-                family_model, version, path, event_type, core_type, native_model_id, core_role_name = l
-                if first_row:
-                    assert family_model == 'Family-model'
-                    assert version == 'Version'
-                    assert path == 'Filename'
-                    assert event_type == 'EventType'
-                    assert core_type == 'Core Type'
-                    assert native_model_id == 'Native Model ID'
-                    assert core_role_name == 'Core Role Name'
-                    first_row = False
-                    continue
-                shortname = re.sub(r'/(.*)/.*', r'\1', path)
-                longname = re.sub(rf'/{shortname}/([^_]*)_.*', r'\1', path)
-                url = base_url + path
-
-                # Bug fixes:
-                if shortname == 'ADL' and event_type == 'core':
-                    # ADL GenuineIntel-6-BE only has atom cores and so
-                    # they don't set event_type to 'hybridcore' but
-                    # 'core' leading to ADL having multiple core
-                    # paths. Avoid this by setting the type back to
-                    # atom.
-                    assert 'gracemont' in path
-                    event_type = 'atom'
-                    core_role_name = 'Atom'
-
-                # Workarounds:
-                if event_type == 'hybridcore':
-                    event_type = 'core' if core_role_name == 'Core' else 'atom'
-                if shortname == 'KNM':
-                    # The files for KNL and KNM are the same as are
-                    # the longnames. We don't want the KNM shortname
-                    # but do want the family_model.
-                    models['KNL'].add(family_model)
-                    continue
+        mapfile_csv_lines = inputs.lines(inputs.fetch(base_url + '/mapfile.csv'))
+        mapfile = csv.reader(mapfile_csv_lines)
+        first_row = True
+        for l in mapfile:
+            while len(l) < 7:
+                # Fix missing columns.
+                l.append('')
+            family_model, version, path, event_type, core_type, native_model_id, core_role_name = l
+            if first_row:
+                assert family_model == 'Family-model'
+                assert version == 'Version'
+                assert path == 'Filename'
+                assert event_type == 'EventType'
+                assert core_type == 'Core Type'
+                assert native_model_id == 'Native Model ID'
+                assert core_role_name == 'Core Role Name'
+                first_row = False
+                continue
+            shortname = re.sub(r'/(.*)/.*', r'\1', path)
+            longname = re.sub(rf'/{shortname}/([^_]*)_.*', r'\1', path)
+            url = base_url + path
 
-                if shortname not in longnames:
-                    longnames[shortname] = longname
-                else:
-                    assert longnames[shortname] == longname
-                if shortname not in versions:
-                    versions[shortname] = version
-                else:
-                    assert versions[shortname] == version
-                models[shortname].add(family_model)
-                if shortname in files and event_type in files[shortname]:
-                    assert files[shortname][event_type] == url, \
-                        f'Expected {shortname}/{longname} to have just 1 {event_type} url {files[shortname][event_type]} but found {url}'
-                else:
-                    files[shortname][event_type] = url
+            # Bug fixes:
+            if shortname == 'ADL' and event_type == 'core':
+                # ADL GenuineIntel-6-BE only has atom cores and so
+                # they don't set event_type to 'hybridcore' but
+                # 'core' leading to ADL having multiple core
+                # paths. Avoid this by setting the type back to
+                # atom.
+                assert 'gracemont' in path
+                event_type = 'atom'
+                core_role_name = 'Atom'
+
+            # Workarounds:
+            if event_type == 'hybridcore':
+                # The PMU of each core type is cpu_ and the lower case
+                # Core Role Name, like cpu_core and cpu_atom.
+                event_type = core_role_name.lower()
+                core_types[shortname].add(event_type)
+            if shortname == 'KNM':
+                # The files for KNL and KNM are the same as are
+                # the longnames. We don't want the KNM shortname
+                # but do want the family_model.
+                models['KNL'].add(family_model)
+                continue
+
+            if shortname not in longnames:
+                longnames[shortname] = longname
+            else:
+                assert longnames[shortname] == longname
+            if shortname not in versions:
+                versions[shortname] = version
+            else:
+                assert versions[shortname] == version
+            models[shortname].add(family_model)
+            if shortname in files and event_type in files[shortname]:
+                assert files[shortname][event_type] == url, \
+                    f'Expected {shortname}/{longname} to have just 1 {event_type} url {files[shortname][event_type]} but found {url}'
+            else:
+                files[shortname][event_type] = url
 
         for (shortname, longname) in longnames.items():
+            if cpuid:
+                # Skip other models before probing for their files.
+                if not Model(shortname, longname, versions[shortname],
+                             models[shortname], {}).matches(cpuid):
+                    continue
             files[shortname]['tma metrics'] = base_url + '/TMA_Metrics-full.csv'
-            if 'atom' in files[shortname]:
-                files[shortname][
-                    'e-core tma metrics'] = base_url + '/E-core_TMA_Metrics.csv'
+            for t in core_types[shortname]:
+                if t in HYBRID_TMA:
+                    tma, csv_name, _ = HYBRID_TMA[t]
+                    files[shortname][tma] = f'{base_url}/{csv_name}'
             cpu_metrics_url = f'{metrics_url}/{shortname}/metrics/perf/{shortname.lower()}_metric_perf.json'
-            try:
-                urllib.request.urlopen(cpu_metrics_url)
+            if inputs.exists(cpu_metrics_url):
                 files[shortname]['extra metrics'] = cpu_metrics_url
-            except:
-                pass
 
             self.archs += [
                 Model(shortname, longname, versions[shortname],
-                      models[shortname], files[shortname])
+                      models[shortname], files[shortname], core_types[shortname])
             ]
+        if cpuid and not self.archs:
+            hint = ', models that differ by stepping need one' if cpuid.count('-') < 3 else ''
+            raise Exception(f'No model in {base_url}/mapfile.csv matches {cpuid}{hint}')
         self.archs.sort()
 
     def __str__(self):
@@ -290,54 +471,360 @@ class Mapfile:
             result += str(model) + '\n'
         return result
 
-    def to_perf_json(self, outdir: str, csvdir: str):
-        gen_mapfile = open(f'{outdir}/mapfile.csv', 'w', encoding='ascii')
+    def to_perf_json(self, outdir: str, csvdir: str, cse: bool, incremental: bool,
+                     task_report: Optional[str] = None,
+                     stages: Optional[Dict[str, Set[str]]] = None,
+                     processes: Optional[concurrent.futures.Executor] = None,
+                     memo_file: Optional[str] = None,
+                     pmu_events_c: Optional[str] = None):
+        """Generate the json of every model, or only the stages of the models
+        in stages, by longname, leaving mapfile.csv as it is. Normalized
+        events are kept in memo_file, if given, for the next run. The
+        pmu-events.c of every model is written to pmu_events_c, if given,
+        from the events and metrics as they're generated."""
+        # Drop the counts of an earlier, failed, generation.
+        output.take_counts()
+        eventmemo.take_stats()
+        if memo_file:
+            eventmemo.load(memo_file)
+        # Input hashes of the metrics files from the last generation. Not a
+        # .json file so perf's build ignores it.
+        hashes_file = f'{outdir}/.metrics-input-hashes'
+        hashes = None
+        if incremental:
+            hashes = {}
+            if os.path.exists(hashes_file):
+                with open(hashes_file, 'r') as f:
+                    hashes = json.load(f)
+        graph = taskgraph.TaskGraph()
+        fetches: Dict[str, taskgraph.Task] = {}
+
+        def fetch_task(url: str) -> taskgraph.Task:
+            if url not in fetches:
+                fetches[url] = graph.add(f'fetch {url}', functools.partial(inputs.fetch, url))
+            return fetches[url]
+
+        lines = []
+        c_tables: Dict[str, List[ctables.ModelTables]] = {}
         for model in self.archs:
+            if stages is not None and model.longname not in stages:
+                continue
             print(f'Generating json for {model.longname}')
             modeldir = outdir + '/' + model.longname
             os.system(f'mkdir -p {modeldir}')
-            model.to_perf_json(modeldir, csvdir)
-            gen_mapfile.write(model.mapfile_line() + '\n')
-
-    def download(self, base_url: str, metrics_url: str, outdir: str):
-        os.system(f'mkdir -p {outdir}/01')
-        with open(f'{outdir}/01/mapfile.csv', 'w', encoding='ascii') as out_mapfile:
-            with urllib.request.urlopen(base_url + '/mapfile.csv') as in_mapfile:
-                for l in in_mapfile.readlines():
-                    out_mapfile.write(l.decode('ascii'))
-        files = set()
+            if pmu_events_c:
+                c_tables[model.longname] = []
+            lines.append(model.add_tasks(graph, modeldir, csvdir, cse, hashes, fetch_task,
+                                         stages[model.longname] if stages else STAGES,
+                                         memo_file, c_tables.get(model.longname)))
+
+        mapfile = []
+
+        def write_mapfile(*results):
+            with output.open_output(f'{outdir}/mapfile.csv') as gen_mapfile:
+                for l in results:
+                    gen_mapfile.write(l + '\n')
+            mapfile.extend(tuple(l.split(',')) for l in results)
+
+        if stages is None:
+            graph.add('write mapfile', write_mapfile, lines)
+        try:
+            graph.run(processes=processes)
+        finally:
+            if task_report:
+                with open(task_report, 'w') as f:
+                    json.dump(graph.report(), f, indent=4)
+                    f.write('\n')
+        if pmu_events_c:
+            tables = ctables.Tables(mapfile, {name: ctables.merge(t)
+                                              for name, t in c_tables.items()})
+            output.write_if_changed(pmu_events_c, ctables.emit_c(tables), 'utf-8')
+        if hashes is not None:
+            with output.open_output(hashes_file) as f:
+                json.dump(hashes, f, sort_keys=True, indent=4)
+                f.write('\n')
+        counts = output.take_counts()
+        print(f'{counts.get("changed", 0)} files changed, '
+              f'{counts.get("unchanged", 0)} unchanged')
+        memo_stats = eventmemo.take_stats()
+        total = memo_stats['hits'] + memo_stats['misses']
+        if total:
+            print(f'{memo_stats["hits"]} of {total} events normalized before '
+                  f'({memo_stats["hits"] * 100 / total:.1f}% hit rate)')
+        if memo_file:
+            eventmemo.save(memo_file)
+            output.take_counts()
+
+    def affected(self, paths: Set[str], csvdir: str) -> Optional[Dict[str, Set[str]]]:
+        """The stages of each model, by longname, to redo after the local
+        files in paths changed. None if everything must be redone. Paths
+        are compared by their real paths, so symlinks match their targets."""
+        result: Dict[str, Set[str]] = collections.defaultdict(set)
+        csvdir = os.path.realpath(csvdir)
+        for p in paths:
+            p = os.path.realpath(p)
+            base, ext = os.path.splitext(p)
+            if ext not in inputs.COMPRESSED:
+                base = p
+            if os.path.basename(base) == 'mapfile.csv' or base.endswith('.zip'):
+                return None
+            m = re.fullmatch(r'perf-uncore-events-(.*)\.csv', os.path.basename(base))
+            if m and os.path.dirname(p) == csvdir:
+                for model in self.archs:
+                    if model.shortname.lower() == m.group(1):
+                        result[model.longname].add('uncore')
+                continue
+            for model in self.archs:
+                for key, url in model.files.items():
+                    path = inputs.local_path(url)
+                    if path is not None and os.path.realpath(path) == base:
+                        result[model.longname] |= FILE_STAGES.get(key, {'core', 'metrics'})
+        return result
+
+    def shard(self, index: int, count: int):
+        """Keep only the models of shard index (from 1) of count. Largest
+        input first, each model goes to the least loaded shard so that the
+        partition is balanced and the same on every node."""
+        # Each size may be a HEAD request, ask once for each file.
+        size = functools.lru_cache(maxsize=None)(inputs.size)
+        sizes = {model.longname: model.input_size(size) for model in self.archs}
+        loads = [0] * count
+        shards: Dict[str, int] = {}
+        for model in sorted(self.archs, key=lambda x: (-sizes[x.longname], x.longname)):
+            i = min(range(count), key=lambda x: (loads[x], x))
+            loads[i] += sizes[model.longname]
+            shards[model.longname] = i + 1
+        self.archs = [model for model in self.archs if shards[model.longname] == index]
+
+    def download(self, base_url: str, metrics_url: str, outdir: str,
+                 compress: Optional[str] = None, snapshot: Optional[str] = None):
+        # A snapshot archive is packed from a tree downloaded next to it.
+        work = f'{snapshot}.parts' if snapshot else outdir
+        # Files completed by this or an earlier, interrupted, download. A
+        # rerun only fetches the rest.
+        journal_file = f'{work}/.download-journal'
+        journal: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(journal_file):
+            with open(journal_file, 'r') as f:
+                for l in f:
+                    if l.strip():
+                        j = json.loads(l)
+                        journal[j['Name']] = j
+        # The tree is removed once packed, the manifest of an earlier
+        # archive then records the files that needn't be fetched again.
+        packed: Dict[str, Dict[str, Any]] = {}
+        if snapshot and os.path.exists(snapshot):
+            with zipfile.ZipFile(snapshot) as old:
+                packed = {m['Name']: m for m in json.loads(old.read(inputs.MANIFEST))}
+        reused: Set[str] = set()
+        os.system(f'mkdir -p {work}')
+
+        def path(name: str) -> str:
+            # Compressed files are found by the name without the suffix.
+            return f'{work}/{name}' + (f'.{compress}' if compress else '')
+
+        files = {'01/mapfile.csv': base_url + '/mapfile.csv'}
         for model in self.archs:
             for short, url in model.files.items():
-                files.add(url)
-        for url in sorted(files):
-            if base_url in url:
-                out_path = outdir + '/01' + url.removeprefix(base_url)
-            else:
-                out_path = outdir + '/github' + url.removeprefix(metrics_url)
-            print(f'Downloading:\n\t{url} to\n\t{out_path}')
-            os.system(f'mkdir -p {os.path.dirname(out_path)}')
-            with open(out_path, 'w', encoding='ascii') as out_json:
-                with urllib.request.urlopen(url) as in_json:
-                    for l in in_json.readlines():
-                        ascii_line = re.sub('\xae', '(R)', l.decode('utf-8'))
-                        ascii_line = re.sub('\u2122', '(TM)', ascii_line)
-                        ascii_line = re.sub('\uFEFF', '', ascii_line)
-                        out_json.write(ascii_line)
+                if base_url in url:
+                    files['01' + url.removeprefix(base_url)] = url
+                else:
+                    files['github' + url.removeprefix(metrics_url)] = url
+        with open(journal_file, 'a') as journal_out:
+            for name, url in sorted(files.items(), key=lambda x: x[1]):
+                if name in journal and journal[name]['URL'] == url and \
+                   os.path.exists(path(name)):
+                    print(f'Already downloaded {url}')
+                    continue
+                if name in packed and packed[name]['URL'] == url:
+                    print(f'Already in {snapshot} {url}')
+                    journal[name] = packed[name]
+                    reused.add(name)
+                    continue
+                print(f'Downloading:\n\t{url} to\n\t{path(name)}')
+                content = inputs.fetch(url, partial=f'{work}/.parts/{name}')
+                text = ''
+                for l in inputs.lines(content):
+                    if name != '01/mapfile.csv':
+                        l = re.sub('\xae', '(R)', l)
+                        l = re.sub('\u2122', '(TM)', l)
+                        l = re.sub('\uFEFF', '', l)
+                    text += l
+                data = text.encode('ascii')
+                os.system(f'mkdir -p {os.path.dirname(path(name))}')
+                if compress:
+                    with inputs.COMPRESSED[f'.{compress}'].open(path(name), 'wb') as f:
+                        f.write(data)
+                else:
+                    output.write_if_changed(path(name), data)
+                journal[name] = {'Name': name, 'URL': url, 'Size': len(data),
+                                 'SHA256': hashlib.sha256(data).hexdigest()}
+                journal_out.write(json.dumps(journal[name]) + '\n')
+                journal_out.flush()
+
+        if snapshot:
+            tmp = f'{snapshot}.tmp'
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive, \
+                 zipfile.ZipFile(snapshot) if packed else contextlib.nullcontext() as old:
+                for name in sorted(files):
+                    if name in reused:
+                        archive.writestr(name, old.read(name))
+                    else:
+                        archive.write(path(name), name)
+                archive.writestr(inputs.MANIFEST,
+                                 json.dumps([journal[n] for n in sorted(files)], indent=4) + '\n')
+            os.replace(tmp, snapshot)
+            shutil.rmtree(work)
+            print(f'Now run with: download_and_gen.py --snapshot {snapshot}')
+            return
         print('Now run with: download_and_gen.py ' +
               f'--url=file://{os.path.abspath(outdir)}/01 ' +
               f'--metrics-url=file://{os.path.abspath(outdir)}/github')
 
-def generate_all_event_json(url: str, metrics_url: str, outdir: str, csvdir: str):
-    mapfile = Mapfile(url, metrics_url)
+def host_cpuid(cpuinfo: str = '/proc/cpuinfo') -> str:
+    """The CPUID of the running machine in perf's form, like
+    GenuineIntel-6-55-4."""
+    fields = {}
+    with open(cpuinfo, 'r') as f:
+        for l in f:
+            if not l.strip():
+                # Only the first processor is needed.
+                break
+            key, _, value = l.partition(':')
+            fields[key.strip()] = value.strip()
+    try:
+        return (f"{fields['vendor_id']}-{int(fields['cpu family'])}-"
+                f"{int(fields['model']):X}-{int(fields['stepping']):X}")
+    except (KeyError, ValueError):
+        raise Exception(f'No x86 vendor, family, model and stepping in {cpuinfo}')
+
+def generate_all_event_json(url: str, metrics_url: str, outdir: str, csvdir: str,
+                            cse: bool, incremental: bool = False,
+                            cpuid: Optional[str] = None,
+                            shard: Optional[Tuple[int, int]] = None,
+                            task_report: Optional[str] = None,
+                            memo_file: Optional[str] = None,
+                            pmu_events_c: Optional[str] = None):
+    mapfile = Mapfile(url, metrics_url, cpuid)
+    if shard:
+        mapfile.shard(*shard)
 
     os.system(f'mkdir -p {outdir}')
-    mapfile.to_perf_json(outdir, csvdir)
+    mapfile.to_perf_json(outdir, csvdir, cse, incremental, task_report,
+                         memo_file=memo_file, pmu_events_c=pmu_events_c)
 
-def hermetic_download(url: str, metrics_url: str, outdir: str):
-    mapfile = Mapfile(url, metrics_url)
+def watch(url: str, metrics_url: str, outdir: str, csvdir: str, cse: bool,
+          incremental: bool, cpuid: Optional[str], poll: bool,
+          memo_file: Optional[str] = None):
+    """Generate, then regenerate the stages of the models affected by each
+    change to the local inputs or uncore CSVs. The worker processes, and the
+    inputs they have decoded, are kept between generations."""
+    dirs = [(csvdir, False)]
+    for u in (url, metrics_url):
+        path = inputs.local_path(u)
+        if path is None and u.startswith('zip:'):
+            # Any change to a snapshot archive regenerates everything.
+            path = os.path.dirname(u.removeprefix('zip:').partition('!/')[0])
+            dirs.append((path, False))
+        elif path is None:
+            raise Exception(f'Only local inputs can be watched, not {u}')
+        else:
+            dirs.append((path, True))
+    with filewatch.Watcher(dirs, poll=poll) as watcher, \
+         taskgraph.process_pool() as processes:
+        mapfile = None
+        stages: Optional[Dict[str, Set[str]]] = None
+        # The stages of failed generations, redone with the next change.
+        # None if everything is to be redone.
+        failed: Optional[Dict[str, Set[str]]] = {}
+        while True:
+            start = time.time()
+            try:
+                if mapfile is None:
+                    mapfile = Mapfile(url, metrics_url, cpuid)
+                    os.system(f'mkdir -p {outdir}')
+                mapfile.to_perf_json(outdir, csvdir, cse, incremental, stages=stages,
+                                     processes=processes, memo_file=memo_file)
+                failed = {}
+                print(f'Generated in {time.time() - start:.2f}s, watching for changes')
+            except Exception as e:
+                # Likely a file mid-edit, wait for the next change.
+                print(f'Generation failed: {e}')
+                if stages is None or failed is None:
+                    failed = None
+                else:
+                    for name, s in stages.items():
+                        failed.setdefault(name, set()).update(s)
+            while True:
+                changed = watcher.wait()
+                print('Changed: ' + ' '.join(sorted(changed)))
+                stages = mapfile.affected(changed, csvdir) if mapfile else None
+                if stages is None:
+                    mapfile = None
+                    break
+                if stages:
+                    if failed is None:
+                        stages = None
+                    else:
+                        for name, s in failed.items():
+                            stages.setdefault(name, set()).update(s)
+                    break
 
+def merge_shards(shard_dirs: Sequence[str], outdir: str):
+    """Combine the output of each --shard into the tree of a single run."""
+    lines = []
+    hashes = None
+    models = set()
     os.system(f'mkdir -p {outdir}')
-    mapfile.download(url, metrics_url, outdir)
+    for shard_dir in shard_dirs:
+        with open(f'{shard_dir}/mapfile.csv', 'r') as f:
+            lines += [l for l in f.readlines() if l.strip()]
+        for entry in sorted(os.listdir(shard_dir)):
+            if os.path.isdir(f'{shard_dir}/{entry}'):
+                if entry in models:
+                    raise Exception(f'{entry} is in more than one shard')
+                models.add(entry)
+                for root, _, names in os.walk(f'{shard_dir}/{entry}'):
+                    target = outdir + root.removeprefix(shard_dir)
+                    os.makedirs(target, exist_ok=True)
+                    for n in names:
+                        with open(f'{root}/{n}', 'rb') as f:
+                            output.write_if_changed(f'{target}/{n}', f.read())
+        if os.path.exists(f'{shard_dir}/.metrics-input-hashes'):
+            with open(f'{shard_dir}/.metrics-input-hashes', 'r') as f:
+                hashes = hashes or {}
+                hashes.update(json.load(f))
+    # A single run writes the models sorted by longname, the third field.
+    lines.sort(key=lambda x: x.split(',')[2])
+    with output.open_output(f'{outdir}/mapfile.csv') as f:
+        f.writelines(lines)
+    if hashes is not None:
+        with output.open_output(f'{outdir}/.metrics-input-hashes') as f:
+            json.dump(hashes, f, sort_keys=True, indent=4)
+            f.write('\n')
+    counts = output.take_counts()
+    print(f'{counts.get("changed", 0)} files changed, '
+          f'{counts.get("unchanged", 0)} unchanged')
+
+def store_tree(outdir: str, store_dir: str, tag: str):
+    """Add the generated tree to the store of unique records at store_dir,
+    from which perf-json-store.py writes it again."""
+    store = eventstore.Store(store_dir)
+    new = store.add_tree(tag, outdir)
+    output.take_counts()
+    print(f'Stored as {tag}, {new} new objects')
+
+def hermetic_download(url: str, metrics_url: str, outdir: str,
+                      cpuid: Optional[str] = None, compress: Optional[str] = None,
+                      snapshot: Optional[str] = None):
+    if snapshot and compress:
+        raise Exception('Snapshot archives are always deflated, '
+                        'compress only applies to a downloaded tree')
+    mapfile = Mapfile(url, metrics_url, cpuid)
+
+    if not snapshot:
+        os.system(f'mkdir -p {outdir}')
+    mapfile.download(url, metrics_url, outdir, compress, snapshot)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -350,12 +837,76 @@ def main():
     ap.add_argument('--hermetic-download', action='store_true',
                     help="""Download necessary files rather than generating perf json.
 The downloaded files can later be passed to the --url/--metrics-url options""")
+    ap.add_argument('--compress', choices=['gz', 'xz'],
+                    help='Compress the files of --hermetic-download, not valid with --snapshot. Compressed inputs are read transparently')
+    ap.add_argument('--snapshot', metavar='ARCHIVE',
+                    help='Zip archive of the inputs, written by --hermetic-download and read instead of --url/--metrics-url')
+    ap.add_argument('--cse', action='store_true',
+                    help='Hoist repeated subexpressions of TMA metrics into shared helper metrics')
+    ap.add_argument('--incremental', action='store_true',
+                    help='Only regenerate metrics files whose TMA columns, event json or options changed')
+    target = ap.add_mutually_exclusive_group()
+    target.add_argument('--cpuid',
+                        help='Only fetch and generate the model matching a CPUID like GenuineIntel-6-55-4')
+    target.add_argument('--host', action='store_true',
+                        help='Only fetch and generate the model of this machine, read from /proc/cpuinfo')
+    ap.add_argument('--shard', metavar='I/N',
+                    help='Only generate the I-th (from 1) of N parts, balanced by input size, for merging with --merge-shards')
+    ap.add_argument('--merge-shards', nargs='+', metavar='SHARDDIR',
+                    help='Combine the --outdir of each --shard into --outdir')
+    ap.add_argument('--watch', action='store_true',
+                    help='After generating, regenerate the models affected by each change to the local inputs or --csvdir')
+    ap.add_argument('--watch-poll', action='store_true',
+                    help='Poll for changes rather than using inotify')
+    ap.add_argument('--task-report', metavar='FILE',
+                    help='Write the status and duration of each generation task as json')
+    ap.add_argument('--event-memo', metavar='FILE',
+                    help='Keep the normalized events, shared by many models, in FILE for the next run')
+    ap.add_argument('--store', metavar='DIR',
+                    help='Also keep the generated tree in a store of the unique records of every tree added to it')
+    ap.add_argument('--store-tag', default='latest',
+                    help='Name of the tree in --store, like a release')
+    ap.add_argument('--pmu-events-c', metavar='FILE',
+                    help="Also write perf's pmu-events.c, in place of jevents.py's, from the generated events and metrics")
     args = ap.parse_args()
 
+    if args.store and (args.hermetic_download or args.watch or args.shard):
+        ap.error('--store needs a whole generated tree')
+    if args.pmu_events_c and (args.hermetic_download or args.watch or args.shard or
+                              args.merge_shards or args.incremental):
+        ap.error('--pmu-events-c needs every model generated in one run, '
+                 'use perf-json-to-c.py on a merged or incremental tree')
+    if args.merge_shards:
+        merge_shards(args.merge_shards, args.outdir)
+        if args.store:
+            store_tree(args.outdir, args.store, args.store_tag)
+        return
+    shard = None
+    if args.shard:
+        m = re.fullmatch(r'(\d+)/(\d+)', args.shard)
+        if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            ap.error(f'Invalid --shard {args.shard}, expected I/N with 1 <= I <= N')
+        shard = (int(m.group(1)), int(m.group(2)))
+    cpuid = host_cpuid() if args.host else args.cpuid
     if args.hermetic_download:
-        hermetic_download(args.url, args.metrics_url, args.outdir)
-    else:
-        generate_all_event_json(args.url, args.metrics_url, args.outdir, args.csvdir)
+        hermetic_download(args.url, args.metrics_url, args.outdir, cpuid, args.compress,
+                          args.snapshot)
+        return
+    if args.snapshot:
+        args.url = inputs.snapshot_url(args.snapshot, '01')
+        args.metrics_url = inputs.snapshot_url(args.snapshot, 'github')
+    if args.watch:
+        try:
+            watch(args.url, args.metrics_url, args.outdir, args.csvdir, args.cse,
+                  args.incremental, cpuid, args.watch_poll, args.event_memo)
+        except KeyboardInterrupt:
+            pass
+        return
+    generate_all_event_json(args.url, args.metrics_url, args.outdir, args.csvdir,
+                            args.cse, args.incremental, cpuid, shard, args.task_report,
+                            args.event_memo, args.pmu_events_c)
+    if args.store:
+        store_tree(args.outdir, args.store, args.store_tag)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# normalize each distinct event once, however many models share it
+import collections
+import hashlib
+import json
+import threading
+import output
+import perfjson
+import topics
+from typing import (Any, Dict, Optional, Tuple)
+
+# The topic and perf json of an event, or None if perf doesn't get it.
+Normalized = Optional[Tuple[str, Dict[str, str]]]
+
+# Normalized events by the SHA256 of the raw event.
+_memo : Dict[str, Normalized] = {}
+# The memo file loaded by this process, and the entries added since
+# take_stats, to be returned to the process saving the file.
+_path : Optional[str] = None
+_new : Dict[str, Normalized] = {}
+# Whether there are entries the memo file doesn't have.
+_unsaved = False
+_stats : Dict[str, int] = collections.Counter()
+_lock = threading.Lock()
+
+
+def _version() -> str:
+    """The hash of the code normalizing events. A memo file written by other
+    code is ignored."""
+    h = hashlib.sha256()
+    for m in (perfjson, topics):
+        with open(m.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def normalize(event: Dict[str, Any]) -> Normalized:
+    """perfjson.normalize_event of event, computed once for each distinct
+    event."""
+    key = hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()
+    with _lock:
+        found = key in _memo
+        result = _memo.get(key)
+        _stats['hits' if found else 'misses'] += 1
+    if not found:
+        result = perfjson.normalize_event(event)
+        _add({key: result})
+    # The caller may change the event, the memo's copy must not.
+    return result and (result[0], dict(result[1]))
+
+
+def _add(entries: Dict[str, Normalized]):
+    global _unsaved
+    with _lock:
+        for key, result in entries.items():
+            if key not in _memo:
+                _memo[key] = result
+                _unsaved = True
+                if _path:
+                    _new[key] = result
+
+
+def load(path: str):
+    """Add the entries of the memo file at path, once for each process. A
+    missing or stale file is ignored."""
+    global _path, _unsaved
+    with _lock:
+        if _path == path:
+            return
+        _path = path
+    try:
+        with open(path, 'r') as f:
+            j = json.load(f)
+    except (OSError, ValueError):
+        return
+    if j.get('Version') != _version():
+        return
+    with _lock:
+        for key, result in j['Events'].items():
+            _memo.setdefault(key, tuple(result) if result else None)
+        _unsaved = False
+
+
+def save(path: str):
+    """Write every entry to the memo file at path, if it is missing any."""
+    global _unsaved
+    with _lock:
+        if not _unsaved:
+            return
+        content = json.dumps({'Version': _version(), 'Events': _memo},
+                             sort_keys=True, separators=(',', ':'))
+        _unsaved = False
+    output.write_if_changed(path, content + '\n')
+
+
+def take_stats() -> Dict[str, Any]:
+    """The hits and misses since the last call, and the entries added if a
+    memo file is loaded. Worker processes return theirs to be added to the
+    caller's."""
+    global _stats, _new
+    with _lock:
+        result = {'hits': _stats['hits'], 'misses': _stats['misses'], 'new': _new}
+        _stats = collections.Counter()
+        _new = {}
+    return result
+
+
+def add_stats(*stats: Dict[str, Any]):
+    """Add the stats returned by worker processes."""
+    for s in stats:
+        with _lock:
+            _stats['hits'] += s['hits']
+            _stats['misses'] += s['misses']
+        _add(s['new'])
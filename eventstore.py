@@ -0,0 +1,234 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# keep generated perf json trees as the unique records of all of them
+import collections
+import gzip
+import hashlib
+import json
+import os
+import output
+from typing import (Any, DefaultDict, Dict, List, Set)
+
+# String values at least this long, like the PublicDescription of an event
+# on both core types, are kept once rather than in each record.
+LONG_STRING = 64
+
+
+def perf_json(records: List[Dict[str, Any]]) -> str:
+    """The text of a perf json file of records, as the generators write it."""
+    return json.dumps(records, sort_keys=True, indent=4, separators=(',', ': ')) + '\n'
+
+
+def _canonical(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _records(text: str) -> Any:
+    """The records of a perf json file, or None if the file can't be
+    written again from them exactly."""
+    try:
+        records = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(records, list) or \
+       any(not isinstance(r, dict) or
+           any(isinstance(v, (dict, list)) for v in r.values()) for r in records):
+        return None
+    return records if perf_json(records) == text else None
+
+
+def _target(outdir: str, name: str) -> str:
+    if os.path.isabs(name) or '..' in name.split('/'):
+        raise Exception(f'Invalid file name {name} in store')
+    return f'{outdir}/{name}'
+
+
+class Store:
+    """A directory of objects and trees. An object is a JSON value named by
+    the SHA256 of its canonical text, in a pack objects/XX/P.jsonl.gz of the
+    bucket of its first two hex digits. A tree, in trees/TAG.json, names the
+    manifest object of each model directory, which names the record objects
+    of each file, so every record is kept once however many trees and
+    models have it. A bucket is only read when an object in it is first
+    added or fetched."""
+
+    def __init__(self, root: str):
+        self.root = root
+        # The pack of each object, by bucket, for the buckets read so far.
+        self.index : Dict[str, Dict[str, str]] = {}
+        # The objects of the packs fetched from, by pack.
+        self.packs : Dict[str, Dict[str, str]] = {}
+        self.pending : DefaultDict[str, Dict[str, str]] = collections.defaultdict(dict)
+        self.added = 0
+
+    def _read_pack(self, path: str) -> Dict[str, str]:
+        objects = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for l in f:
+                h, _, text = l.rstrip('\n').partition(' ')
+                objects[h] = text
+        return objects
+
+    def _bucket(self, bucket: str) -> Dict[str, str]:
+        """The pack of each stored object of bucket, reading only their
+        hashes."""
+        if bucket not in self.index:
+            index = {}
+            d = f'{self.root}/objects/{bucket}'
+            if os.path.isdir(d):
+                for name in sorted(os.listdir(d)):
+                    if name.endswith('.jsonl.gz'):
+                        for h in self._read_pack(f'{d}/{name}'):
+                            index[h] = f'{d}/{name}'
+            self.index[bucket] = index
+        return self.index[bucket]
+
+    def put(self, value: Any) -> str:
+        text = _canonical(value)
+        h = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if h not in self._bucket(h[:2]) and h not in self.pending[h[:2]]:
+            self.pending[h[:2]][h] = text
+            self.added += 1
+        return h
+
+    def get(self, h: str) -> Any:
+        if h in self.pending[h[:2]]:
+            return json.loads(self.pending[h[:2]][h])
+        pack = self._bucket(h[:2]).get(h)
+        if pack is None:
+            raise Exception(f'Object {h} is missing from {self.root}')
+        if pack not in self.packs:
+            self.packs[pack] = self._read_pack(pack)
+        return json.loads(self.packs[pack][h])
+
+    def count(self) -> int:
+        """The number of objects stored, reading the hashes of every
+        bucket."""
+        d = f'{self.root}/objects'
+        buckets = set(os.listdir(d)) if os.path.isdir(d) else set()
+        return sum(len(self._bucket(b)) for b in buckets | set(self.pending))
+
+    def put_record(self, record: Dict[str, Any]) -> str:
+        return self.put({k: {'String': self.put(v)}
+                         if isinstance(v, str) and len(v) >= LONG_STRING else v
+                         for k, v in record.items()})
+
+    def get_record(self, h: str) -> Dict[str, Any]:
+        return {k: self.get(v['String']) if isinstance(v, dict) else v
+                for k, v in self.get(h).items()}
+
+    def put_file(self, path: str) -> Dict[str, Any]:
+        """Add the file at path, returning its manifest entry."""
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8', 'surrogateescape')
+        records = _records(text) if path.endswith('.json') else None
+        if records is None:
+            return {'File': self.put(text)}
+        return {'Records': [self.put_record(r) for r in records]}
+
+    def get_file(self, entry: Dict[str, Any]) -> bytes:
+        if 'File' in entry:
+            text = self.get(entry['File'])
+        else:
+            text = perf_json([self.get_record(h) for h in entry['Records']])
+        return text.encode('utf-8', 'surrogateescape')
+
+    def flush(self):
+        """Write the objects added as a new pack in each bucket, named by
+        its content, so the existing packs aren't rewritten and an
+        interrupted write leaves the store as it was."""
+        for bucket, objects in sorted(self.pending.items()):
+            if not objects:
+                continue
+            lines = ''.join(f'{h} {text}\n' for h, text in sorted(objects.items()))
+            data = gzip.compress(lines.encode('utf-8'), mtime=0)
+            d = f'{self.root}/objects/{bucket}'
+            os.makedirs(d, exist_ok=True)
+            path = f'{d}/{hashlib.sha256(data).hexdigest()[:16]}.jsonl.gz'
+            output.write_if_changed(path, data)
+            index = self._bucket(bucket)
+            for h in objects:
+                index[h] = path
+            self.packs[path] = objects
+        self.pending.clear()
+
+    def tags(self) -> List[str]:
+        if not os.path.isdir(f'{self.root}/trees'):
+            return []
+        return sorted(n.removesuffix('.json') for n in os.listdir(f'{self.root}/trees')
+                      if n.endswith('.json'))
+
+    def _tree_path(self, tag: str) -> str:
+        if not tag or '/' in tag or tag.startswith('.'):
+            raise Exception(f'Invalid tag {tag}')
+        return f'{self.root}/trees/{tag}.json'
+
+    def add_tree(self, tag: str, tree: str) -> int:
+        """Store the perf json tree in directory tree, with its mapfile.csv
+        and a directory for each model, as tag. Hidden files, like the
+        generator's state, are left out. Returns the number of new objects."""
+        before = self.added
+        manifest : Dict[str, Any] = {'Files': {}, 'Models': {}}
+        for name in sorted(os.listdir(tree)):
+            path = f'{tree}/{name}'
+            if name.startswith('.'):
+                continue
+            if not os.path.isdir(path):
+                manifest['Files'][name] = self.put_file(path)
+                continue
+            files = {}
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for n in sorted(names):
+                    if not n.startswith('.'):
+                        files[os.path.relpath(f'{root}/{n}', path)] = \
+                            self.put_file(f'{root}/{n}')
+            manifest['Models'][name] = self.put({'Files': files})
+        # The objects first, a tree never names missing objects.
+        self.flush()
+        os.makedirs(f'{self.root}/trees', exist_ok=True)
+        output.write_if_changed(self._tree_path(tag),
+                                json.dumps(manifest, sort_keys=True, indent=4) + '\n')
+        return self.added - before
+
+    def materialize(self, tag: str, outdir: str):
+        """Write the tree stored as tag to outdir, leaving unchanged files
+        untouched."""
+        path = self._tree_path(tag)
+        if not os.path.exists(path):
+            raise Exception(f'No tree {tag} in {self.root}')
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        os.makedirs(outdir, exist_ok=True)
+        for name, entry in manifest['Files'].items():
+            output.write_if_changed(_target(outdir, name), self.get_file(entry))
+        for model, h in manifest['Models'].items():
+            for name, entry in self.get(h)['Files'].items():
+                target = _target(outdir, f'{model}/{name}')
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                output.write_if_changed(target, self.get_file(entry))
@@ -30,11 +30,15 @@
 # extract-tma-metrics.py CPU tma-csv-file.csv > cpu-metrics.json
 import csv
 import argparse
+import hashlib
 import re
 import json
 import sys
+import counters
+import metricexpr
+import scheduler
 from collections import defaultdict
-from typing import (Dict, Optional, Sequence, Set, TextIO, Union)
+from typing import (Any, Dict, Optional, Sequence, Set, TextIO, Tuple, Union)
 
 # metrics redundant with perf or unusable
 ignore = set(['MUX', 'Power', 'Time'])
@@ -239,10 +243,346 @@ def cstate_json(cpu):
     return result
 
 
+def subexpressions(expr: str) -> list[str]:
+    """Return the bracketed subexpressions of expr that may be replaced
+    by a reference to another metric. Function call arguments, such as
+    those of max(a, b), aren't subexpressions."""
+    result = []
+    stack = []
+    for pos, c in enumerate(expr):
+        if c == '(':
+            stack.append(pos)
+        elif c == ')' and stack:
+            start = stack.pop()
+            if start > 0 and re.match(r'[A-Za-z0-9_.]', expr[start - 1]):
+                continue
+            sub = expr[start:pos + 1]
+            depth = 0
+            top_level_comma = False
+            for i, x in enumerate(sub[1:-1]):
+                if x == '(':
+                    depth += 1
+                elif x == ')':
+                    depth -= 1
+                elif x == ',' and depth == 0 and sub[i] != '\\':
+                    top_level_comma = True
+                    break
+            if not top_level_comma:
+                result.append(sub)
+    return result
+
+
+def cse_metrics(jo: list[Dict[str, str]], unit: str,
+                min_uses: int = 2, min_len: int = 24) -> list[Dict[str, str]]:
+    """Hoist bracketed subexpressions repeated across the metrics in jo
+    into shared helper metrics and rewrite the metrics to refer to
+    them. The helpers are only in metricexpr.HELPER_GROUP, so perf lists
+    them under that group rather than with the metrics users select.
+    Returns the helper metrics that were created."""
+    def tokens(expr: str) -> Tuple[Tuple[str, str], ...]:
+        return tuple(metricexpr.tokenize(expr))
+
+    def replace_sub(expr: str, sub: Tuple[Tuple[str, str], ...], name: str) -> str:
+        spans = list(metricexpr.token_spans(expr))
+        result = []
+        last = 0
+        i = 0
+        while i < len(spans):
+            # Only replace occurrences that aren't function call arguments.
+            call = i > 0 and spans[i - 1][0] == 'name' and spans[i - 1][3] == spans[i][2]
+            if not call and tuple(x[:2] for x in spans[i:i + len(sub)]) == sub:
+                result += [expr[last:spans[i][2]], name]
+                last = spans[i + len(sub) - 1][3]
+                i += len(sub)
+            else:
+                i += 1
+        return ''.join(result) + expr[last:]
+
+    def count_uses(sub: str) -> int:
+        return sum(subexpressions(m['MetricExpr']).count(sub) for m in jo + helpers)
+
+    helpers : list[Dict[str, str]] = []
+    candidates = set()
+    for m in jo:
+        for sub in subexpressions(m['MetricExpr']):
+            # Topdown events must be grouped with a TOPDOWN.SLOTS
+            # event, leave them in place.
+            if len(sub) >= min_len and 'topdown\\-' not in sub and \
+               re.search(r'[A-Za-z_]', sub):
+                candidates.add(sub)
+
+    # Existing metrics that compute exactly a subexpression are referred
+    # to rather than creating a new helper.
+    existing = {tokens(f'({m["MetricExpr"]})'): m['MetricName'] for m in jo}
+    # Longest first so that the outermost repeated expression is
+    # hoisted, the subexpressions of it are then shared by the helper.
+    for sub in sorted(candidates, key=lambda x: (-len(x), x)):
+        sub_tokens = tokens(sub)
+        if sub_tokens in existing:
+            if count_uses(sub) < 1:
+                continue
+            name = existing[sub_tokens]
+        else:
+            if count_uses(sub) < min_uses:
+                continue
+            name = f'cse_{len(helpers) + 1}'
+            j = {
+                'MetricName': name,
+                'MetricExpr': check_expr(sub[1:-1]),
+                'BriefDescription': f'Common subexpression shared by {count_uses(sub)} metric expressions',
+                'MetricGroup': metricexpr.HELPER_GROUP,
+            }
+            if unit:
+                j['Unit'] = unit
+            helpers.append(j)
+        for m in jo + helpers:
+            if m['MetricName'] != name:
+                m['MetricExpr'] = check_expr(replace_sub(m['MetricExpr'], sub_tokens, name))
+    return helpers
+
+
+def event_cost(name: str, kind: str, events: Set[str],
+               event_counters: Dict[str, counters.EventCounters],
+               unit: str) -> Dict[str, Any]:
+    """Compute the counters needed to collect events, used by metric or
+    metric group name, in one group."""
+    core_events = sorted(e for e in events if counters.is_core_event(e, unit))
+    other_events = sorted(e for e in events if e not in core_events and
+                          e not in metricexpr.software_events)
+    gp_demand = 0
+    fixed : Set[int] = set()
+    perf_metrics = False
+    taken_alone = []
+    unknown = []
+    msrs : Dict[str, Set[str]] = defaultdict(set)
+    for e in core_events:
+        if counters.is_topdown_event(e):
+            perf_metrics = True
+            continue
+        c = counters.find_event(e, event_counters)
+        if not c:
+            # The counters an unknown event needs aren't known, nor so
+            # whether the events fit.
+            unknown.append(e)
+            continue
+        # Events with modifiers, or that collide on a fixed counter,
+        # need a general purpose counter.
+        if c.fixed is not None and c.fixed not in fixed and '\\,' not in e:
+            fixed.add(c.fixed)
+        else:
+            gp_demand += 1
+        if c.taken_alone:
+            taken_alone.append(e)
+        for msr in c.msrs[:1]:
+            msrs[counters.msr_names.get(msr, msr)].add(metricexpr.event_name(e))
+    msr_capacity : Dict[str, int] = defaultdict(int)
+    for kind_name in counters.msr_names.values():
+        msr_capacity[kind_name] += 1
+    msr_contention = sorted(x for x, e in msrs.items()
+                            if len(e) > max(msr_capacity[x], 1))
+    gp_counters = counters.num_counters(event_counters)
+    gp_counters_htoff = counters.num_counters(event_counters, htoff=True)
+    fits = scheduler.assign_counters(core_events, event_counters, unit)
+    fits_htoff = scheduler.assign_counters(core_events, event_counters, unit,
+                                           htoff=True)
+    return {
+        'Name': name,
+        'Type': kind,
+        'Events': len(core_events) + len(other_events),
+        'CoreEvents': len(core_events),
+        'GPDemand': gp_demand,
+        'GPCounters': gp_counters,
+        'GPCountersHTOff': gp_counters_htoff,
+        'FixedCounters': sorted(fixed),
+        'PerfMetrics': perf_metrics,
+        'MSRs': {x: sorted(e) for x, e in sorted(msrs.items())},
+        'MSRContention': msr_contention,
+        'TakenAlone': taken_alone,
+        'OtherEvents': other_events,
+        'UnknownEvents': unknown,
+        'Multiplex': fits is None,
+        'MultiplexHTOff': fits_htoff is None,
+    }
+
+
+def set_constraints(jo: list[Dict[str, str]],
+                    event_counters: Dict[str, counters.EventCounters], unit: str):
+    """Add a MetricConstraint to metrics whose events can't be counted in
+    one group, either because of the NMI watchdog's counter or at all.
+    Existing constraints are kept, as are metrics with events missing from
+    event_counters."""
+    metrics = {m['MetricName']: m['MetricExpr'] for m in jo}
+    for m in jo:
+        if 'MetricConstraint' in m:
+            continue
+        events = metricexpr.metric_events(m['MetricName'], metrics)
+        if scheduler.unknown_events(events, event_counters, unit) or \
+           scheduler.assign_counters(events, event_counters, unit,
+                                     nmi_watchdog=True) is not None:
+            continue
+        if scheduler.assign_counters(events, event_counters, unit) is not None:
+            m['MetricConstraint'] = 'NO_NMI_WATCHDOG'
+        else:
+            m['MetricConstraint'] = 'NO_GROUP_EVENTS'
+
+
+def cost_report(jo: list[Dict[str, str]],
+                event_counters: Dict[str, counters.EventCounters], unit: str,
+                fmt: str, outfile: TextIO):
+    """Write the event and counter cost of every metric and metric group."""
+    metrics = {m['MetricName']: m['MetricExpr'] for m in jo}
+    metric_events = {}
+    group_events : Dict[str, Set[str]] = defaultdict(set)
+    for m in jo:
+        metric_events[m['MetricName']] = metricexpr.metric_events(m['MetricName'], metrics)
+        for group in m.get('MetricGroup', '').split(';'):
+            if group:
+                group_events[group] |= metric_events[m['MetricName']]
+
+    report = [event_cost(name, 'metric', events, event_counters, unit)
+              for name, events in metric_events.items()]
+    report += [event_cost(name, 'group', events, event_counters, unit)
+               for name, events in sorted(group_events.items())]
+
+    if fmt == 'csv':
+        w = csv.DictWriter(outfile, fieldnames=list(report[0].keys()) if report else [])
+        w.writeheader()
+        for r in report:
+            w.writerow({k: ';'.join(f'{x}={",".join(y)}' for x, y in v.items())
+                        if isinstance(v, dict) else
+                        ';'.join(str(x) for x in v) if isinstance(v, list) else v
+                        for k, v in r.items()})
+    else:
+        outfile.write(
+            json.dumps(report, sort_keys=True, indent=4, separators=(',', ': ')))
+        outfile.write('\n')
+
+
+def parse_threshold(threshold: str) -> Optional[float]:
+    """Parse the leading comparison of a TMA Threshold column entry, like
+    '> 0.1 & P', into the fraction a node must exceed to be a bottleneck."""
+    m = re.match(r'\(?\s*>\s*([0-9.]+)', threshold)
+    return float(m.group(1)) if m else None
+
+
+def topdown_tree(jo: list[Dict[str, str]],
+                 tree: list[Tuple[str, int, Optional[str], Optional[float]]],
+                 outfile: TextIO):
+    """Write the topdown hierarchy of the generated metrics, parents before
+    their children, with the threshold for descending into each node."""
+    generated = {j['MetricName'] for j in jo}
+    result = []
+    written = set()
+    for name, level, parent, threshold in tree:
+        # Skip nodes that weren't generated, and so their children.
+        if name not in generated or (parent and parent not in written):
+            continue
+        written.add(name)
+        node : Dict[str, Any] = {'MetricName': name, 'Level': level}
+        if parent:
+            node['Parent'] = parent
+        if threshold is not None:
+            node['Threshold'] = threshold
+        result.append(node)
+    outfile.write(
+        json.dumps(result, sort_keys=True, indent=4, separators=(',', ': ')))
+    outfile.write('\n')
+
+
+def metric_closure(roots: Set[str], infoname: Dict[str, str], aux: Dict[str, str],
+                   nodes: Dict[str, str], children: Dict[str, Set[str]]) -> Set[str]:
+    """Return the TMA names of the metrics in roots and of the metrics their
+    formulas refer to, through aux formulas and ## expansions of topdown
+    children, that must be generated for the roots to resolve."""
+    result : Set[str] = set()
+    scanned : Set[str] = set()
+    todo = [(x, infoname[x]) for x in roots if x in infoname]
+    result |= {x for x, _ in todo}
+
+    def output(x: str):
+        if x not in result and x in infoname:
+            result.add(x)
+            todo.append((x, infoname[x]))
+
+    while todo:
+        key, form = todo.pop()
+        if key in scanned:
+            continue
+        scanned.add(key)
+        for ref in re.findall(r'##\?[a-zA-Z0-9_.]+|##[a-zA-Z0-9_.]+|#[a-zA-Z0-9_.]+|'
+                              r'[A-Z_a-z0-9.]+', form):
+            if ref.startswith('##'):
+                parent = ref[3:] if ref.startswith('##?') else ref[2:]
+                if ref.startswith('##?'):
+                    output(parent)
+                for c in children[parent]:
+                    output(c)
+            elif ref.startswith('#'):
+                # Aux values and #Node references are expanded in place.
+                if ref[1:] in nodes:
+                    todo.append((ref, nodes[ref[1:]]))
+                elif ref in aux:
+                    todo.append((ref, aux[ref]))
+            elif ref in ignore and ref in infoname:
+                todo.append((ref, infoname[ref]))
+            else:
+                output(ref)
+    return result
+
+
+def input_hash(csvfile: Sequence[str], cpu: str, extramodel: str, unit: str,
+               memory: bool, cstate: bool, cse: bool = False,
+               extra: Sequence[bytes] = ()) -> str:
+    """Hash the inputs the metrics for cpu are generated from: for each row
+    the formula found by following ratio_column, as find_form does, and the
+    other columns read, along with the options, extra inputs such as event
+    json and the code generating the metrics: this script, which holds the
+    event fix tables, and the modules it uses. Changes to columns that cpu
+    doesn't use don't change the hash."""
+    h = hashlib.sha256()
+
+    def add(x: Any):
+        h.update(x if isinstance(x, bytes) else repr(x).encode())
+        h.update(b'\0')
+
+    for module in (__file__, counters.__file__, metricexpr.__file__, scheduler.__file__):
+        with open(module, 'rb') as f:
+            add(f.read())
+    add((cpu, extramodel, unit, memory, cstate, cse))
+    for x in extra:
+        add(x)
+    col_heading : Dict[str, int] = {}
+    for l in csv.reader(csvfile):
+        if l[0] == 'Key':
+            col_heading = {name: ind for ind, name in enumerate(l)}
+            add(sorted(x for x in col_heading if x.startswith('Level')))
+            continue
+
+        def field(x: str) -> str:
+            return l[col_heading[x]] if col_heading.get(x, len(l)) < len(l) else ''
+
+        form = next((field(x) for x in [cpu] + list(ratio_column.get(cpu, ())) if field(x)), '')
+        add([l[0], form] + [field(x) for x in col_heading
+                            if x.startswith('Level') or x in
+                            ('Metric Group', 'Metric Description', 'Locate-with',
+                             'Threshold')])
+    return h.hexdigest()
+
+
 def extract_tma_metrics(csvfile: TextIO, cpu: str,
                         extrajson: Optional[Union[bytearray, bytes, memoryview, str]],
                         cstate: bool, extramodel: str, unit: str,
-                        memory: bool, verbose: bool, outfile: TextIO):
+                        memory: bool, verbose: bool, outfile: Optional[TextIO],
+                        cse: bool = False,
+                        eventsjson: Optional[Sequence[TextIO]] = None,
+                        costfile: Optional[TextIO] = None,
+                        cost_format: str = 'json',
+                        treefile: Optional[TextIO] = None,
+                        metrics: Optional[Sequence[str]] = None,
+                        metric_groups: Optional[Sequence[str]] = None
+                        ) -> list[Dict[str, Any]]:
+    """Generate the perf json metrics for cpu, writing them to outfile if
+    given, and return them."""
     verboseprint = print if verbose else lambda *a, **k: None
     csvf = csv.reader(csvfile)
 
@@ -276,6 +616,9 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
     parents : list[str] = []
     # Map from a parent topdown metric name to its children's names.
     children: Dict[str, Set[str]] = defaultdict(set)
+    # The topdown nodes in CSV order as (perf metric name, level, parent's
+    # perf metric name, threshold).
+    tree : list[Tuple[str, int, Optional[str], Optional[float]]] = []
     for l in csvf:
         if l[0] == 'Key':
             for ind, name in enumerate(l):
@@ -344,6 +687,11 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
                     ))
                     infoname[metric_name] = form
                     tma_metric_names[metric_name] = tma_metric_name
+                    threshold = None
+                    if 'Threshold' in col_heading:
+                        threshold = parse_threshold(field('Threshold'))
+                    parent = tma_metric_names.get(parents[-2]) if level > 1 else None
+                    tree.append((tma_metric_name, level, parent, threshold))
         elif l[0].startswith('Info'):
             form = find_form()
             if form:
@@ -368,7 +716,191 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
     if cstate:
         je.extend(cstate_json(cpu))
 
+    # With selectors only resolve the selected metrics and those they need.
+    wanted = None
+    if metrics is not None or metric_groups is not None:
+        wanted_names = {x.lower() for x in metrics or []}
+        wanted_groups = {x.lower() for x in metric_groups or []}
+
+        def selected(name: str, group: str) -> bool:
+            group = re.sub(r'Tma(L[12])', r'tma_\1_group', group)
+            return name.lower() in wanted_names or \
+                bool({x.strip().lower() for x in group.split(';')} & wanted_groups)
+
+        csv_names = {v: k for k, v in tma_metric_names.items()}
+        roots = {csv_names.get(i.name, i.name) for i in info
+                 if selected(i.name, i.groups or groups.get(i.name, ''))}
+        if selected('UNCORE_FREQ', 'SoC'):
+            # UNCORE_FREQ, added below, refers to Socket_CLKS.
+            roots.add('Socket_CLKS')
+        wanted = {tma_metric_names.get(x, x) for x in
+                  metric_closure(roots, infoname, aux, nodes, children)}
+        je = [j for j in je if selected(j['MetricName'], j.get('MetricGroup', ''))]
+        verboseprint(f'Resolving {len(wanted)} selected metrics', file=sys.stderr)
+
+    def resolve_all(name: str, form: str, cpu: str, expand_metrics: bool) -> str:
+
+        def fixup(form: str) -> str:
+            def update_fix(x: str) -> str:
+                x = x.replace(',', r'\,')
+                x = x.replace('=', r'\=')
+                return x
+
+            form = check_expr(form)
+            if (cpu == 'SPR'):
+                for j, r in spr_event_fixes:
+                    form = form.replace(j, update_fix(r))
+            elif (cpu == 'ICX'):
+                for j, r in icx_event_fixes:
+                    form = form.replace(j, update_fix(r))
+            else:
+                for j, r in event_fixes:
+                    form = form.replace(j, update_fix(r))
+            for j, r in topdown_event_fixes:
+                form = form.replace(j, r)
+
+            form = re.sub(r'\bTSC\b', 'msr@tsc@', form)
+            form = form.replace('_PS', '')
+            form = form.replace('#Memory == 1', '1' if memory else '0')
+            form = form.replace('#PMM_App_Direct', '1' if memory else '0')
+            form = re.sub(r':USER', ':u', form, re.IGNORECASE)
+            form = re.sub(r':SUP', ':k', form, re.IGNORECASE)
+            form = form.replace('(0 + ', '(')
+            form = form.replace(' + 0)', ')')
+            form = form.replace('+ 0 +', '+')
+            form = form.replace(', 0 +', ',')
+            form = form.replace('else 0 +', 'else')
+            form = form.replace('( ', '(')
+            form = form.replace(' )', ')')
+            form = form.replace(' , ', ', ')
+            form = form.replace('  ', ' ')
+
+            pmu_prefix = 'cpu'
+            if unit == 'cpu_core':
+                pmu_prefix = 'cpu_core'
+            if unit == 'cpu_atom':
+                pmu_prefix = 'cpu_atom'
+            changed = True
+            event_pattern = r'[A-Z0-9_.]+'
+            term_pattern = r'[a-z0-9\\=,]+'
+            while changed:
+                changed = False
+                for match, replacement in [
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:sup', rf'{pmu_prefix}@\1@k'),
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:user', rf'{pmu_prefix}@\1@u'),
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:c(\d+)', rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:u0x([A-Fa-f0-9]+)',
+                     rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:i1', rf'{pmu_prefix}@\1\\,inv@'),
+                    (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+                     r')@:e1', rf'{pmu_prefix}@\1\\,edge@'),
+                    ('(' + event_pattern + rf'):sup',
+                     rf'{pmu_prefix}@\1@k'),
+                    ('(' + event_pattern + rf'):user',
+                     rf'{pmu_prefix}@\1@u'),
+                    ('(' + event_pattern + rf'):i1',
+                     rf'{pmu_prefix}@\1\\,inv@'),
+                    ('(' + event_pattern + rf'):c(\d+)',
+                     rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
+                    ('(' + event_pattern + rf'):u0x([a-fA-F0-9]+)',
+                     rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
+                    ('(' + event_pattern + rf'):e1',
+                     rf'{pmu_prefix}@\1\\,edge@'),
+                ]:
+                    new_form = re.sub(match, replacement, form,
+                                      re.IGNORECASE)
+                    changed = changed or new_form != form
+                    form = new_form
+
+            check_expr(form)
+            changed = True
+            while changed:
+                changed = False
+                m = re.fullmatch(r'(.*) if ([01]) else (.*)', form)
+                if m:
+                    changed = True
+                    form = check_expr(m.group(1) if m.group(2) == '1' else m.group(3))
+                m = re.search(r'\(([0-9.]+) \* ([A-Za-z_]+)\) - \(([0-9.]+) \* ([A-Za-z_]+)\)', form)
+                if m and m.group(2) == m.group(4):
+                    changed = True
+                    form = form.replace(m.group(0), f'{(float(m.group(1)) - float(m.group(3))):g} * {m.group(2)}')
+
+            return form
+
+        def resolve_aux(v: str) -> str:
+            if any(v == i for i in ['#core_wide', '#Model', '#SMT_on', '#num_dies']):
+                return v
+            if v == '#DurationTimeInSeconds':
+                return 'duration_time'
+            if v == '#EBS_Mode':
+                return '#core_wide < 1'
+            if v == '#Memory':
+                return '1' if memory else '0'
+            if v == '#NA':
+                return '0'
+            if v[1:] in nodes:
+                child = nodes[v[1:]]
+            else:
+                child = aux[v]
+            badevent(child)
+            child = fixup(child)
+            return bracket(child)
+
+        def resolve_info(v: str):
+            if v in ignore or (expand_metrics and v in infoname):
+                # If metric will be ignored in the output it must
+                # be expanded.
+                return bracket(fixup(infoname[v]))
+            if v in infoname:
+                form = infoname[v]
+                if form == '#NA':
+                    # Don't refer to empty metrics.
+                    return '0'
+                # Check the expanded formula for bad events, which
+                # would mean we want to drop this metric too.
+                form = fixup(form)
+                badevent(form)
+                if v in tma_metric_names:
+                    return tma_metric_names[v]
+            return v
+
+        def expand_hhq(parent: str) -> str:
+            return f'max({parent}, {" + ".join(sorted(children[parent]))})'
+
+        def expand_hh(parent: str) -> str:
+            return f'({" + ".join(sorted(children[parent]))})'
+
+        try:
+            # Iterate until form stabilizes to handle deeper nesting.
+            changed = True
+            while changed:
+                orig_form = form
+                form = re.sub(r'##\?[a-zA-Z0-9_.]+',
+                              lambda m: expand_hhq(m.group(0)[3:]), form)
+                form = re.sub(r'##[a-zA-Z0-9_.]+',
+                              lambda m: expand_hh(m.group(0)[2:]), form)
+                form = re.sub(r'#[a-zA-Z0-9_.]+',
+                              lambda m: resolve_aux(m.group(0)), form)
+                form = re.sub(r'[A-Z_a-z0-9.]+',
+                              lambda m: resolve_info(m.group(0)), form)
+                changed = orig_form != form
+            badevent(form)
+        except BadRef as e:
+            verboseprint(
+                'Skipping ' + name + ' due to ' + e.name, file=sys.stderr)
+            return ''
+
+        form = fixup(form)
+        return form
+
     for i in info:
+        if wanted is not None and i.name not in wanted:
+            continue
         if i.name in ignore:
             verboseprint('Skipping', i.name, file=sys.stderr)
             continue
@@ -386,166 +918,6 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
             if i.name in groups:
                 i.groups = groups[i.name]
 
-        def resolve_all(form: str, cpu: str, expand_metrics: bool) -> str:
-
-            def fixup(form: str) -> str:
-                def update_fix(x: str) -> str:
-                    x = x.replace(',', r'\,')
-                    x = x.replace('=', r'\=')
-                    return x
-
-                form = check_expr(form)
-                if (cpu == 'SPR'):
-                    for j, r in spr_event_fixes:
-                        form = form.replace(j, update_fix(r))
-                elif (cpu == 'ICX'):
-                    for j, r in icx_event_fixes:
-                        form = form.replace(j, update_fix(r))
-                else:
-                    for j, r in event_fixes:
-                        form = form.replace(j, update_fix(r))
-                for j, r in topdown_event_fixes:
-                    form = form.replace(j, r)
-
-                form = re.sub(r'\bTSC\b', 'msr@tsc@', form)
-                form = form.replace('_PS', '')
-                form = form.replace('#Memory == 1', '1' if memory else '0')
-                form = form.replace('#PMM_App_Direct', '1' if memory else '0')
-                form = re.sub(r':USER', ':u', form, re.IGNORECASE)
-                form = re.sub(r':SUP', ':k', form, re.IGNORECASE)
-                form = form.replace('(0 + ', '(')
-                form = form.replace(' + 0)', ')')
-                form = form.replace('+ 0 +', '+')
-                form = form.replace(', 0 +', ',')
-                form = form.replace('else 0 +', 'else')
-                form = form.replace('( ', '(')
-                form = form.replace(' )', ')')
-                form = form.replace(' , ', ', ')
-                form = form.replace('  ', ' ')
-
-                pmu_prefix = 'cpu'
-                if unit == 'cpu_core':
-                    pmu_prefix = 'cpu_core'
-                if unit == 'cpu_atom':
-                    pmu_prefix = 'cpu_atom'
-                changed = True
-                event_pattern = r'[A-Z0-9_.]+'
-                term_pattern = r'[a-z0-9\\=,]+'
-                while changed:
-                    changed = False
-                    for match, replacement in [
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:sup', rf'{pmu_prefix}@\1@k'),
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:user', rf'{pmu_prefix}@\1@u'),
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:c(\d+)', rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:u0x([A-Fa-f0-9]+)',
-                         rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:i1', rf'{pmu_prefix}@\1\\,inv@'),
-                        (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                         r')@:e1', rf'{pmu_prefix}@\1\\,edge@'),
-                        ('(' + event_pattern + rf'):sup',
-                         rf'{pmu_prefix}@\1@k'),
-                        ('(' + event_pattern + rf'):user',
-                         rf'{pmu_prefix}@\1@u'),
-                        ('(' + event_pattern + rf'):i1',
-                         rf'{pmu_prefix}@\1\\,inv@'),
-                        ('(' + event_pattern + rf'):c(\d+)',
-                         rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
-                        ('(' + event_pattern + rf'):u0x([a-fA-F0-9]+)',
-                         rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
-                        ('(' + event_pattern + rf'):e1',
-                         rf'{pmu_prefix}@\1\\,edge@'),
-                    ]:
-                        new_form = re.sub(match, replacement, form,
-                                          re.IGNORECASE)
-                        changed = changed or new_form != form
-                        form = new_form
-
-                check_expr(form)
-                changed = True
-                while changed:
-                    changed = False
-                    m = re.fullmatch(r'(.*) if ([01]) else (.*)', form)
-                    if m:
-                        changed = True
-                        form = check_expr(m.group(1) if m.group(2) == '1' else m.group(3))
-                    m = re.search(r'\(([0-9.]+) \* ([A-Za-z_]+)\) - \(([0-9.]+) \* ([A-Za-z_]+)\)', form)
-                    if m and m.group(2) == m.group(4):
-                        changed = True
-                        form = form.replace(m.group(0), f'{(float(m.group(1)) - float(m.group(3))):g} * {m.group(2)}')
-
-                return form
-
-            def resolve_aux(v: str) -> str:
-                if any(v == i for i in ['#core_wide', '#Model', '#SMT_on', '#num_dies']):
-                    return v
-                if v == '#DurationTimeInSeconds':
-                    return 'duration_time'
-                if v == '#EBS_Mode':
-                    return '#core_wide < 1'
-                if v == '#Memory':
-                    return '1' if memory else '0'
-                if v == '#NA':
-                    return '0'
-                if v[1:] in nodes:
-                    child = nodes[v[1:]]
-                else:
-                    child = aux[v]
-                badevent(child)
-                child = fixup(child)
-                return bracket(child)
-
-            def resolve_info(v: str):
-                if v in ignore or (expand_metrics and v in infoname):
-                    # If metric will be ignored in the output it must
-                    # be expanded.
-                    return bracket(fixup(infoname[v]))
-                if v in infoname:
-                    form = infoname[v]
-                    if form == '#NA':
-                        # Don't refer to empty metrics.
-                        return '0'
-                    # Check the expanded formula for bad events, which
-                    # would mean we want to drop this metric too.
-                    form = fixup(form)
-                    badevent(form)
-                    if v in tma_metric_names:
-                        return tma_metric_names[v]
-                return v
-
-            def expand_hhq(parent: str) -> str:
-                return f'max({parent}, {" + ".join(sorted(children[parent]))})'
-
-            def expand_hh(parent: str) -> str:
-                return f'({" + ".join(sorted(children[parent]))})'
-
-            try:
-                # Iterate until form stabilizes to handle deeper nesting.
-                changed = True
-                while changed:
-                    orig_form = form
-                    form = re.sub(r'##\?[a-zA-Z0-9_.]+',
-                                  lambda m: expand_hhq(m.group(0)[3:]), form)
-                    form = re.sub(r'##[a-zA-Z0-9_.]+',
-                                  lambda m: expand_hh(m.group(0)[2:]), form)
-                    form = re.sub(r'#[a-zA-Z0-9_.]+',
-                                  lambda m: resolve_aux(m.group(0)), form)
-                    form = re.sub(r'[A-Z_a-z0-9.]+',
-                                  lambda m: resolve_info(m.group(0)), form)
-                    changed = orig_form != form
-                badevent(form)
-            except BadRef as e:
-                verboseprint(
-                    'Skipping ' + i.name + ' due to ' + e.name, file=sys.stderr)
-                return ''
-
-            form = fixup(form)
-            return form
-
         def save_form(name, group, form, desc, locate, scale_unit, extra=''):
             if form == '':
                 return
@@ -596,8 +968,10 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
             else:
                 j['BriefDescription'] = desc
 
-            if j['MetricName'] == 'Page_Walks_Utilization' or j[
-                    'MetricName'] == 'Backend_Bound':
+            # Without an event list to derive the constraints from
+            # fall back to the known cases.
+            if not eventsjson and j['MetricName'] in ('Page_Walks_Utilization',
+                                                      'Backend_Bound'):
                 j['MetricConstraint'] = 'NO_NMI_WATCHDOG'
 
             if unit:
@@ -608,7 +982,7 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
 
             jo.append(j)
 
-        form = resolve_all(form, cpu, expand_metrics=False)
+        form = resolve_all(i.name, form, cpu, expand_metrics=False)
         needs_slots = 'topdown\-' in form and 'SLOTS' not in form
         if needs_slots:
             # topdown events must always be grouped with a
@@ -619,9 +993,9 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
             form = f'{form} + 0*SLOTS'
         save_form(i.name, i.groups, form, i.desc, i.locate, i.scale_unit)
 
-    if 'Socket_CLKS' in infoname:
+    if 'Socket_CLKS' in infoname and (wanted is None or selected('UNCORE_FREQ', 'SoC')):
         form = 'Socket_CLKS / #num_dies / duration_time / 1000000000'
-        form = check_expr(resolve_all(form, cpu, expand_metrics=False))
+        form = check_expr(resolve_all('UNCORE_FREQ', form, cpu, expand_metrics=False))
         if form:
             je.append({
                 'MetricName': 'UNCORE_FREQ',
@@ -630,11 +1004,29 @@ def extract_tma_metrics(csvfile: TextIO, cpu: str,
                 'MetricGroup': 'SoC'
             })
 
+    if cse:
+        helpers = cse_metrics(jo, unit)
+        verboseprint(f'Created {len(helpers)} common subexpression metrics',
+                     file=sys.stderr)
+        jo = jo + helpers
+
+    event_counters = counters.read_event_json(eventsjson) if eventsjson else {}
+    if event_counters:
+        set_constraints(jo, event_counters, unit)
+
     jo = jo + je
 
-    outfile.write(
-        json.dumps(jo, sort_keys=True, indent=4, separators=(',', ': ')))
-    outfile.write('\n')
+    if costfile:
+        cost_report(jo, event_counters, unit, cost_format, costfile)
+
+    if treefile:
+        topdown_tree(jo, tree, treefile)
+
+    if outfile:
+        outfile.write(
+            json.dumps(jo, sort_keys=True, indent=4, separators=(',', ': ')))
+        outfile.write('\n')
+    return jo
 
 
 def main():
@@ -648,11 +1040,27 @@ def main():
     ap.add_argument('--extramodel')
     ap.add_argument('--extrajson', type=argparse.FileType('r'))
     ap.add_argument('--unit')
+    ap.add_argument('--cse', action='store_true',
+                    help='Hoist repeated subexpressions into shared helper metrics')
+    ap.add_argument('--events-json', type=argparse.FileType('r'), action='append',
+                    help='Event json file for the CPU, used to compute MetricConstraint and by --cost-report')
+    ap.add_argument('--cost-report', type=argparse.FileType('w'),
+                    help='Write the events and counters needed by each metric and metric group')
+    ap.add_argument('--cost-format', choices=['json', 'csv'], default='json')
+    ap.add_argument('--metrics',
+                    help='Only generate these metrics, and those they use, like IPC;CPI')
+    ap.add_argument('--metric-groups',
+                    help='Only generate metrics in these groups, and those they use, like TopdownL1;Mem')
+    ap.add_argument('--tree', type=argparse.FileType('w'),
+                    help='Write the topdown hierarchy with thresholds for tma-drilldown.py')
     args = ap.parse_args()
 
     extract_tma_metrics(args.csvfile, args.cpu, args.extrajson, args.cstate,
                         args.extramodel, args.unit, args.memory, args.verbose,
-                        args.output)
+                        args.output, args.cse, args.events_json, args.cost_report,
+                        args.cost_format, args.tree,
+                        re.split(r'[;,]', args.metrics) if args.metrics else None,
+                        re.split(r'[;,]', args.metric_groups) if args.metric_groups else None)
 
 
 if __name__ == '__main__':
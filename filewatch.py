@@ -0,0 +1,160 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# wait for files to change, with inotify or else by polling
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import (Dict, Optional, Sequence, Set, Tuple)
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+_EVENT = struct.Struct('iIII')
+
+
+def _ignored(name: str) -> bool:
+    # Hidden files, like the temporaries of output.py, and editor backups.
+    return name.startswith('.') or name.endswith('~')
+
+
+class Watcher:
+    """Reports the files that changed under directories, by their real
+    paths. Each directory is watched with its subdirectories, if recursive,
+    or just its files. Closed on leaving a with block."""
+
+    def __init__(self, dirs: Sequence[Tuple[str, bool]], interval: float = 0.5,
+                 poll: bool = False):
+        self.dirs = [(os.path.realpath(d), recursive) for d, recursive in dirs]
+        self.interval = interval
+        self.fd = None
+        self.wds : Dict[int, Tuple[str, bool]] = {}
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if not poll and libc is not None and hasattr(libc, 'inotify_init1'):
+            fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+            if fd >= 0:
+                self.libc = libc
+                self.fd = fd
+        if self.fd is None:
+            self.mtimes = self._scan()
+            return
+        for d, recursive in self.dirs:
+            self._add(d, recursive)
+
+    def _add(self, d: str, recursive: bool):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch {d}')
+        self.wds[wd] = (d, recursive)
+        if recursive:
+            for e in os.scandir(d):
+                if e.is_dir(follow_symlinks=False) and not _ignored(e.name):
+                    self._add(e.path, True)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        result = {}
+        for d, recursive in self.dirs:
+            for root, dirs, files in os.walk(d):
+                dirs[:] = [x for x in dirs if recursive and not _ignored(x)]
+                for f in files:
+                    if _ignored(f):
+                        continue
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    result[path] = (st.st_mtime_ns, st.st_size)
+        return result
+
+    def _read(self, timeout: Optional[float]) -> Set[str]:
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        buf = os.read(self.fd, 65536)
+        i = 0
+        while i < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, i)
+            name = buf[i + _EVENT.size:i + _EVENT.size + length].rstrip(b'\0')
+            i += _EVENT.size + length
+            if wd not in self.wds or not name:
+                continue
+            d, recursive = self.wds[wd]
+            path = os.path.join(d, os.fsdecode(name))
+            if _ignored(os.path.basename(path)):
+                continue
+            if mask & IN_ISDIR:
+                if recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add(path, True)
+                continue
+            changed.add(path)
+        return changed
+
+    def wait(self, settle: float = 0.1) -> Set[str]:
+        """Block until files change, returning their paths once no more
+        changes arrive for settle seconds, as an editor's save or a copy
+        can take several writes."""
+        if self.fd is None:
+            while True:
+                time.sleep(self.interval)
+                mtimes = self._scan()
+                changed = {p for p in set(mtimes) | set(self.mtimes)
+                           if mtimes.get(p) != self.mtimes.get(p)}
+                self.mtimes = mtimes
+                if changed:
+                    return changed
+        changed = self._read(None)
+        while True:
+            more = self._read(settle)
+            if not more:
+                if changed:
+                    return changed
+                changed = self._read(None)
+                continue
+            changed |= more
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self) -> 'Watcher':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# serve a directory over HTTP, failing and truncating responses to test download retries
+# flaky-server.py dir [--port 8766] [--every 3]
+import argparse
+import functools
+import http.server
+import itertools
+import os
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Answer GET and HEAD, with Range, from a directory. Of every few
+    requests one fails with 503 and the body of another is cut short by
+    closing the connection."""
+
+    def __init__(self, *args, root: str, every: int, count: itertools.count, **kwargs):
+        self.root = root
+        self.every = every
+        self.count = count
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, body: bool):
+        n = next(self.count) % self.every
+        path = os.path.join(self.root, self.path.split('?')[0].lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        if n == 1:
+            self.send_error(503)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = 0
+        r = self.headers.get('Range')
+        if r:
+            start = int(r.removeprefix('bytes=').partition('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        part = data[start:]
+        self.send_header('Content-Length', str(len(part)))
+        self.end_headers()
+        if not body:
+            return
+        if n == 2 and len(part) > 1:
+            # Send half the body and close, short of the Content-Length.
+            self.wfile.write(part[:len(part) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(part)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('dir', help='Directory to serve, like a --hermetic-download tree')
+    ap.add_argument('--port', type=int, default=8766)
+    ap.add_argument('--every', type=int, default=3,
+                    help='Of every EVERY requests fail one and truncate another')
+    args = ap.parse_args()
+    if args.every < 3:
+        ap.error('--every must be at least 3 so that requests can succeed')
+    handler = functools.partial(FlakyHandler, root=os.path.abspath(args.dir),
+                                every=args.every, count=itertools.count())
+    server = http.server.ThreadingHTTPServer(('localhost', args.port), handler)
+    print(f'Serving {args.dir} at http://localhost:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,59 @@
 #!/usr/bin/python
-# generate hybrid perf json files from two perf json files (core and atom)
+# generate hybrid perf json files from the perf json files of each core type
 # For example,
-#   hybrid-json-to-perf-json.py alderlake_gracemont_core_v0.01_private.json alderlake_goldencove_v0.01_private.json
-import os
-import re
-import json
+#   hybrid-json-to-perf-json.py cpu_atom:alderlake_gracemont_core_v0.01_private.json cpu_core:alderlake_goldencove_v0.01_private.json
 import argparse
-import sys
+import collections
+import concurrent.futures
 import importlib
-from typing import TextIO
+import io
+from typing import (Dict, Sequence, TextIO, Tuple, Union)
 json_to_perf_json = importlib.import_module("json-to-perf-json")
 
-def hybrid_json_to_perf_json(atomjson: TextIO, corejson: TextIO, outdir: str):
-    def combine_jsons(atom_path, core_path, name, out_path):
-        jn = []
-
-        if len(atom_path) > 0:
-            f = open(atom_path, 'r')
-            ja = json.load(f)
-            if isinstance(ja, dict) and ja["Header"]:
-                ja = ja["Events"]
-            for l in ja:
-                jn.append(l)
-            f.close()
-
-        if len(core_path) > 0:
-            f = open(core_path, 'r')
-            jc = json.load(f)
-            if isinstance(jc, dict) and jc["Header"]:
-                jc = jc["Events"]
-            for l in jc:
-                jn.append(l)
-            f.close()
-
-        ofile = open("%s/%s" % (out_path, name), "w")
-        json.dump(jn, ofile, sort_keys=True, indent=4, separators=(',', ': '))
-        ofile.write("\n")
-        ofile.close()
-
-    os.system('rm -rf tmp-atom tmp-core')
-    os.system('mkdir -p tmp-atom')
-    os.system('mkdir -p tmp-core')
-
-    atom_out = json_to_perf_json.json_to_perf_json(atomjson, "tmp-atom", "cpu_atom")
-    core_out = json_to_perf_json.json_to_perf_json(corejson, "tmp-core", "cpu_core")
-
-    inter = list(set(atom_out).intersection(set(core_out)))
-    diff1 = list(set(core_out).difference(set(atom_out)))
-    diff2 = list(set(atom_out).difference(set(core_out)))
-
-    for s in inter:
-        atom_path = "./tmp-atom/" + s
-        core_path = "./tmp-core/" + s
-        combine_jsons(atom_path, core_path, s,outdir)
-
-    for s in diff1:
-        core_path = "./tmp-core/" + s
-        combine_jsons('', core_path, s, outdir)
-
-    for s in diff2:
-        atom_path = "./tmp-atom/" + s
-        combine_jsons(atom_path, '', s, outdir)
+def pmu_topics(content: Union[bytes, str], unit: str) -> Dict[str, list]:
+    jf = json_to_perf_json.read_events(io.StringIO(
+        content.decode('utf-8') if isinstance(content, bytes) else content))
+    return json_to_perf_json.perf_json_topics(jf, unit)
+
+def hybrid_json_to_perf_json(pmus: Sequence[Tuple[TextIO, str]], outdir: str):
+    """Write the events of each (event file, PMU unit) pair in pmus with the
+    unit set, merging the events of the same topic in the order of pmus."""
+    contents = [f.read() for f, _ in pmus]
+    # Normalizing each PMU's events is independent.
+    with concurrent.futures.ProcessPoolExecutor(len(pmus)) as pool:
+        results = list(pool.map(pmu_topics, contents, [unit for _, unit in pmus]))
+
+    write_merged_topics(results, outdir)
+
+def write_merged_topics(results: Sequence[Dict[str, list]],
+                        outdir: str) -> Dict[str, list]:
+    """Write the topics of each PMU, merging the events of the same topic in
+    the order of results, and return the merged topics."""
+    merged = collections.defaultdict(list)
+    for topics in results:
+        for name, events in topics.items():
+            merged[name] += events
+    for name, events in merged.items():
+        json_to_perf_json.write_topic(outdir, name, events)
+    return merged
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument('atomjson', type=argparse.FileType('r'), help="Input atom json file")
-    ap.add_argument('corejson', type=argparse.FileType('r'), help="Input core json file")
+    ap.add_argument('jsonfiles', nargs='+',
+                    help="Input json files as unit:file, like cpu_atom:gracemont.json. "
+                    "Without units two files are the atom and core json")
     ap.add_argument('--outdir', default='.')
     args = ap.parse_args()
 
-    hybrid_json_to_perf_json(args.atomjson, args.corejson, args.outdir)
+    pmus = []
+    for i, x in enumerate(args.jsonfiles):
+        unit, sep, path = x.partition(':')
+        if not sep:
+            if len(args.jsonfiles) != 2:
+                ap.error(f'Missing unit for {x}')
+            unit, path = ['cpu_atom', 'cpu_core'][i], x
+        pmus.append((open(path, 'r'), unit))
+    hybrid_json_to_perf_json(pmus, args.outdir)
 
 if __name__ == '__main__':
     main()
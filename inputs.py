@@ -0,0 +1,335 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# read generator inputs, mapping file:// URLs rather than copying them through urllib
+import functools
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import lzma
+import mmap
+import os
+import socket
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from typing import (Any, BinaryIO, Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple, Union)
+
+# Compressed forms of an input, used when the uncompressed file is missing.
+COMPRESSED = {
+    '.gz': gzip,
+    '.xz': lzma,
+}
+
+
+class LocalFile(NamedTuple):
+    """A fetched file:// input. Only the path is passed between processes,
+    each reads the file itself."""
+    path: str
+
+
+class ZipMember(NamedTuple):
+    """A fetched member of a snapshot archive."""
+    archive: str
+    name: str
+
+
+# The result of fetch.
+Content = Union[bytes, LocalFile, ZipMember]
+
+# The snapshot archive member listing the URL, size and SHA256 of every
+# other member.
+MANIFEST = 'manifest.json'
+
+
+def snapshot_url(archive: str, tree: str) -> str:
+    """The base URL of a tree, 01 or github, in a snapshot archive."""
+    return f'zip:{os.path.abspath(archive)}!/{tree}'
+
+
+def _zip_member(url: str) -> Optional[ZipMember]:
+    if not url.startswith('zip:'):
+        return None
+    archive, _, name = url.removeprefix('zip:').partition('!/')
+    return ZipMember(archive, name)
+
+
+@functools.lru_cache(maxsize=4)
+def _open_zip(archive: str, mtime_ns: int) -> Tuple[zipfile.ZipFile, Dict[str, Dict[str, Any]]]:
+    zf = zipfile.ZipFile(archive)
+    manifest = {m['Name']: m for m in json.loads(zf.read(MANIFEST))}
+    return zf, manifest
+
+
+def _zip(archive: str) -> Tuple[zipfile.ZipFile, Dict[str, Dict[str, Any]]]:
+    """The open archive, once per process, and its manifest by name."""
+    return _open_zip(archive, os.stat(archive).st_mtime_ns)
+
+
+def _zip_data(member: ZipMember) -> bytes:
+    """Read a member without extracting the archive, checking it against
+    the manifest."""
+    zf, manifest = _zip(member.archive)
+    data = zf.read(member.name)
+    m = manifest[member.name]
+    if len(data) != m['Size'] or hashlib.sha256(data).hexdigest() != m['SHA256']:
+        raise Exception(f'{member.name} in {member.archive} does not match the manifest')
+    return data
+
+
+def local_path(url: str) -> Optional[str]:
+    """The path of a file:// URL, None for other URLs."""
+    u = urllib.parse.urlparse(url)
+    if u.scheme != 'file':
+        return None
+    return urllib.request.url2pathname(u.path)
+
+
+def find(path: str) -> Optional[str]:
+    """path, or else its .gz or .xz form if that exists."""
+    for p in [path] + [path + ext for ext in COMPRESSED]:
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def _compression(path: str):
+    return COMPRESSED.get(os.path.splitext(path)[1])
+
+
+def open_text(path: str) -> TextIO:
+    """Open a file or its compressed form, decompressing as it is read."""
+    found = find(path)
+    if not found:
+        raise FileNotFoundError(path)
+    c = _compression(found)
+    if c:
+        return c.open(found, 'rt', encoding='utf-8')
+    return open(found, 'r')
+
+
+# Retries of a failing download, waiting BACKOFF seconds then doubling.
+RETRIES = 5
+BACKOFF = 0.5
+TIMEOUT = 60
+
+
+def _transient(e: Exception) -> bool:
+    if isinstance(e, urllib.error.HTTPError):
+        # Only retry timeouts, rate limiting and server errors.
+        return e.code in (408, 429) or e.code >= 500
+    if isinstance(e, urllib.error.URLError):
+        # A URLError wraps the failure to connect, like a refused
+        # connection or a failed name lookup. An unknown scheme isn't one.
+        return isinstance(e.reason, OSError)
+    # Failures of the network rather than of local files, like a missing
+    # partial download or a permission error, which a retry won't fix.
+    return isinstance(e, (http.client.HTTPException, ConnectionError, TimeoutError,
+                          socket.timeout))
+
+
+def _retry(url: str, fn: Callable[[], Any]) -> Any:
+    """Call fn, retrying after transient failures with exponential
+    backoff."""
+    for attempt in range(RETRIES + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if not _transient(e) or attempt == RETRIES:
+                raise
+            print(f'Retrying {url} after: {e}', file=sys.stderr)
+            time.sleep(BACKOFF * 2**attempt)
+
+
+def _retrieve(url: str, out: BinaryIO):
+    """Download url, appending to out. After a failure the download resumes
+    from the bytes already in out with a Range request, so a partial file
+    from an earlier run is continued too."""
+    def attempt():
+        offset = out.seek(0, io.SEEK_END)
+        req = urllib.request.Request(url)
+        if offset:
+            req.add_header('Range', f'bytes={offset}-')
+        try:
+            with urllib.request.urlopen(req, timeout=TIMEOUT) as f:
+                if offset and f.status != 206:
+                    # The server ignored the Range, start again.
+                    out.seek(0)
+                    out.truncate()
+                received = 0
+                while chunk := f.read(1 << 16):
+                    out.write(chunk)
+                    received += len(chunk)
+                # Reads in chunks don't report a connection closed early.
+                length = f.headers.get('Content-Length')
+                if length and received < int(length):
+                    raise http.client.IncompleteRead(b'', int(length) - received)
+        except urllib.error.HTTPError as e:
+            # 416 means there is nothing beyond what is already downloaded.
+            if not offset or e.code != 416:
+                raise
+
+    _retry(url, attempt)
+
+
+def fetch(url: str, partial: Optional[str] = None) -> Content:
+    """Fetch a URL, deferring the read of a local file or archive member to
+    its user. Other URLs are downloaded with retries, into the file partial
+    if given so that a later call resumes an interrupted download."""
+    member = _zip_member(url)
+    if member:
+        if member.name not in _zip(member.archive)[1]:
+            raise FileNotFoundError(url)
+        return member
+    path = local_path(url)
+    if path is not None:
+        found = find(path)
+        if not found:
+            raise FileNotFoundError(path)
+        return LocalFile(found)
+    if partial:
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(partial, 'ab+') as f:
+            _retrieve(url, f)
+            f.seek(0)
+            content = f.read()
+        os.unlink(partial)
+    else:
+        with io.BytesIO() as f:
+            _retrieve(url, f)
+            content = f.getvalue()
+    c = _compression(urllib.parse.urlparse(url).path)
+    return c.decompress(content) if c else content
+
+
+def exists(url: str) -> bool:
+    member = _zip_member(url)
+    if member:
+        return member.name in _zip(member.archive)[1]
+    path = local_path(url)
+    if path is not None:
+        return find(path) is not None
+    def probe() -> bool:
+        with urllib.request.urlopen(url, timeout=TIMEOUT):
+            return True
+
+    try:
+        return _retry(url, probe)
+    except Exception:
+        return False
+
+
+def size(url: str) -> int:
+    member = _zip_member(url)
+    if member:
+        return _zip(member.archive)[1][member.name]['Size']
+    path = local_path(url)
+    if path is not None:
+        found = find(path)
+        if not found:
+            raise FileNotFoundError(path)
+        # Compressed inputs compress by similar ratios, so the compressed
+        # size is still a fair estimate of relative cost.
+        return os.path.getsize(found)
+    def head() -> int:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'),
+                                    timeout=TIMEOUT) as f:
+            return int(f.headers.get('Content-Length', 0))
+
+    return _retry(url, head)
+
+
+def _split_lines(text: str) -> Tuple[str, ...]:
+    # Like readlines, lines only end at \n.
+    result = [l + '\n' for l in text.split('\n')]
+    result[-1] = result[-1][:-1]
+    if not result[-1]:
+        result.pop()
+    return tuple(result)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_local(path: str, mtime_ns: int, size: int) -> Tuple[str, Tuple[str, ...]]:
+    """Decode a file directly from a mapping of it, once per process for a
+    file shared by many models like the TMA CSV. The modification time and
+    size in the key cause a changed file to be read again. Compressed files
+    are decompressed in memory as they are read."""
+    if _compression(path):
+        with open_text(path) as f:
+            text = f.read()
+        return text, _split_lines(text)
+    if size == 0:
+        return '', ()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        text = str(m, 'utf-8')
+    return text, _split_lines(text)
+
+
+@functools.lru_cache(maxsize=16)
+def _read_member(member: ZipMember, mtime_ns: int) -> Tuple[str, Tuple[str, ...]]:
+    text = _zip_data(member).decode('utf-8')
+    return text, _split_lines(text)
+
+
+def _local(content: Union[LocalFile, ZipMember]) -> Tuple[str, Tuple[str, ...]]:
+    if isinstance(content, ZipMember):
+        return _read_member(content, os.stat(content.archive).st_mtime_ns)
+    st = os.stat(content.path)
+    return _read_local(content.path, st.st_mtime_ns, st.st_size)
+
+
+def text(content: Content) -> str:
+    if isinstance(content, (LocalFile, ZipMember)):
+        return _local(content)[0]
+    return content.decode('utf-8')
+
+
+def lines(content: Content) -> List[str]:
+    """The lines of content, ending with \\n, as readlines would return."""
+    if isinstance(content, (LocalFile, ZipMember)):
+        return list(_local(content)[1])
+    return list(_split_lines(content.decode('utf-8')))
+
+
+def data(content: Content) -> bytes:
+    """The uncompressed bytes of content."""
+    if isinstance(content, ZipMember):
+        return _zip_data(content)
+    if isinstance(content, LocalFile):
+        c = _compression(content.path)
+        with (c.open(content.path, 'rb') if c else open(content.path, 'rb')) as f:
+            return f.read()
+    return content
+
+
+def read(url: str) -> bytes:
+    return data(fetch(url))
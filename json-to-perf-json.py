@@ -33,51 +33,50 @@ import itertools
 import json
 import argparse
 import sys
+import eventmemo
+import output
 import perfjson
-from typing import TextIO
+from typing import (Dict, TextIO)
 
-def json_to_perf_json(in_file :TextIO, outdir :str, unit :str):
-    jf = json.load(in_file)
-    # Newer event files have a header and events list rather than an
-    # just an events list.
-    if isinstance(jf, dict) and jf["Header"]:
-        jf = jf["Events"]
+def perf_json_topics(jf: list, unit: str) -> Dict[str, list]:
+    """Clean up the events of an event file and split them by topic,
+    returning a map from topic file name to its events."""
     perfjson.cleanjf(jf)
     jf = perfjson.del_dup_events(jf)
-    jf = map(perfjson.fix_names, jf)
-    jf = perfjson.del_special_events(jf)
+    # Models share most of their events, each distinct event is normalized
+    # once.
+    events = [n for n in map(eventmemo.normalize, jf) if n]
 
     if unit:
-        jf = perfjson.add_unit(jf, unit)
-
-    jf = sorted(jf, key=lambda x: x["Topic"])
+        perfjson.add_unit([j for _, j in events], unit)
 
-    ofiles = []
-    for topic, nit in itertools.groupby(jf, lambda x: x["Topic"]):
-        def do_strip(n):
-            for k in n.keys():
-                if n[k] is None:
-                    del n[k]
-                    continue
-                n[k] = n[k].strip()
-                if n[k] == "0x00":
-                    del n[k]
-            return n
+    events.sort(key=lambda x: x[0])
 
-        j2 = list(nit)
-        j2 = map(perfjson.del_topic, j2)
-        j2 = map(do_strip, j2)
-        if not j2:
-            continue
+    topics = {}
+    for topic, nit in itertools.groupby(events, lambda x: x[0]):
         topic = topic.replace(" ", "-")
         fn = topic.lower() + ".json"
-        ofiles.append(fn)
-        ofile = open(f'{outdir}/{fn}', "w", encoding='ascii')
-        json.dump(sorted(list(j2), key=lambda x: x["EventName"]), ofile,
-                  sort_keys=True, indent=4, separators=(',', ': '))
-        ofile.write("\n")
-        ofile.close()
-    return ofiles
+        topics[fn] = sorted([j for _, j in nit], key=lambda x: x["EventName"])
+    return topics
+
+def write_topic(outdir: str, fn: str, events: list):
+    output.write_if_changed(f'{outdir}/{fn}',
+                            json.dumps(events, sort_keys=True, indent=4,
+                                       separators=(',', ': ')) + "\n")
+
+def read_events(in_file: TextIO) -> list:
+    jf = json.load(in_file)
+    # Newer event files have a header and events list rather than an
+    # just an events list.
+    if isinstance(jf, dict) and jf["Header"]:
+        jf = jf["Events"]
+    return jf
+
+def json_to_perf_json(in_file :TextIO, outdir :str, unit :str) -> Dict[str, list]:
+    topics = perf_json_topics(read_events(in_file), unit)
+    for fn, events in topics.items():
+        write_topic(outdir, fn, events)
+    return topics
 
 def main():
     ap = argparse.ArgumentParser()
@@ -0,0 +1,398 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# shared code for evaluating perf json metrics on perf stat output (need numpy)
+
+import ast
+import functools
+import re
+import metricexpr
+import numpy as np
+from typing import (Dict, List, Optional, Sequence, Tuple)
+
+# Values for the # literals of a MetricExpr when not given.
+default_literals = {
+    '#SMT_on': 0,
+    '#core_wide': 0,
+    '#num_dies': 1,
+    '#num_packages': 1,
+    '#num_cpus': 1,
+    '#num_cpus_online': 1,
+}
+
+
+def parse_literals(values: Sequence[str]) -> Dict[str, float]:
+    """Parse options like SMT_on=1 into # literal values."""
+    result = {}
+    for x in values:
+        name, _, value = x.partition('=')
+        result['#' + name.lstrip('#')] = float(value)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def event_key(event: str) -> str:
+    """Canonical name of an event as written in a MetricExpr or printed by
+    perf stat, so cpu@EVENT\\,cmask\\=1@ and cpu/event,cmask=1/ match."""
+    event = metricexpr.perf_event(event).lower()
+    m = re.fullmatch(r'([a-z_0-9]+)/([^/]*)/([a-z]*)', event)
+    if m:
+        mods = f':{m.group(3)}' if m.group(3) else ''
+        if m.group(1) == 'cpu':
+            return m.group(2) + mods
+        return f'{m.group(1)}/{m.group(2)}/{mods}'
+    return event
+
+
+def scale_unit(s: Optional[str]) -> Tuple[float, str]:
+    """Split a ScaleUnit like '100%' into its factor and unit."""
+    m = re.fullmatch(r'([0-9.e+-]+)(.*)', s or '')
+    if not m:
+        return (1.0, s or '')
+    return (float(m.group(1)), m.group(2))
+
+
+def d_ratio(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b == 0, 0.0, np.true_divide(a, b))
+
+
+def has_event(x):
+    return np.where(np.isnan(x), 0.0, 1.0)
+
+
+class _Vectorize(ast.NodeTransformer):
+    """Rewrite the Python form of a MetricExpr to work element-wise on
+    numpy arrays."""
+
+    functions = {
+        'min': 'np.minimum',
+        'max': 'np.maximum',
+        'd_ratio': 'd_ratio',
+        'has_event': 'has_event',
+    }
+
+    @staticmethod
+    def call(func: str, args: List[ast.expr]) -> ast.expr:
+        return ast.Call(func=ast.parse(func, mode='eval').body, args=args,
+                        keywords=[])
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return self.call('np.where', [node.test, node.body, node.orelse])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = 'np.logical_and' if isinstance(node.op, ast.And) else 'np.logical_or'
+        result = node.values[0]
+        for v in node.values[1:]:
+            result = self.call(func, [result, v])
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Invert):
+            # perf's !, written as ~ to bind as tightly as unary minus.
+            return self.call('np.logical_not', [node.operand])
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if isinstance(node.func, ast.Name) and node.func.id in self.functions:
+            node.func = ast.parse(self.functions[node.func.id], mode='eval').body
+        elif isinstance(node.func, ast.Name) and node.func.id == 'source_count':
+            # Every event is read from the one PMU it is counted on.
+            return ast.Constant(1.0)
+        return node
+
+
+def _join_xor(pieces: Sequence[Tuple[str, str]]) -> str:
+    """Join the Python source of each token of a MetricExpr, given with the
+    token, writing perf's ^ as np.logical_xor. ^ binds more loosely than &
+    and comparisons, which no Python operator does, so its operands are
+    found by splitting at the parentheses and at what binds more loosely:
+    commas, | and if/else."""
+    # For each open parenthesis, the source so far, the operands of the ^
+    # being read and the tokens of its current operand.
+    levels : List[Tuple[List[str], List[str], List[str]]] = [([], [], [])]
+
+    def operand() -> str:
+        _, xors, current = levels[-1]
+        operands = xors + [''.join(current)]
+        result = operands[0]
+        for x in operands[1:]:
+            result = f'np.logical_xor({result}, {x})'
+        xors.clear()
+        current.clear()
+        return result
+
+    for src, token in pieces:
+        done, xors, current = levels[-1]
+        if token == '(':
+            current.append(src)
+            levels.append(([], [], []))
+        elif token == ')' and len(levels) > 1:
+            levels[-1][0].append(operand())
+            inner = ''.join(levels.pop()[0])
+            levels[-1][2].append(inner + src)
+        elif token == '^':
+            xors.append(''.join(current))
+            current.clear()
+        elif token in (',', '|', 'if', 'else'):
+            done += [operand(), src]
+        else:
+            current.append(src)
+    if len(levels) != 1:
+        raise Exception('Unbalanced parentheses')
+    levels[0][0].append(operand())
+    return ''.join(levels[0][0])
+
+
+class Evaluator:
+    """Compiled metrics that evaluate, element-wise, on arrays of event
+    counts. Each element is one row of perf stat output, such as an
+    interval for one CPU."""
+
+    def __init__(self, jo: Sequence[Dict[str, str]], names: Sequence[str],
+                 literals: Optional[Dict[str, float]] = None):
+        """Compile the metrics called names, and those they refer to, from
+        the perf json metrics jo."""
+        self.literals = dict(default_literals)
+        self.literals.update(literals or {})
+        self.jo = {m['MetricName']: m for m in jo}
+        exprs = {m['MetricName']: m['MetricExpr'] for m in jo}
+        # Candidate event keys in the order they are looked up, indexed
+        # by the compiled code.
+        self.events : List[Tuple[str, ...]] = []
+        self._event_index : Dict[Tuple[str, ...], int] = {}
+        self.names = list(names)
+        self.order : List[str] = []
+        self.code = {}
+        visiting = set()
+
+        def visit(name: str):
+            if name in self.code:
+                return
+            if name in visiting:
+                raise Exception('Metric refers to itself', name)
+            visiting.add(name)
+            _, refs = metricexpr.references(exprs[name], exprs)
+            for r in sorted(refs):
+                visit(r)
+            self.code[name] = self._compile(self.jo[name], exprs)
+            self.order.append(name)
+
+        for name in names:
+            visit(name)
+
+    def _event(self, event: str, unit: str) -> str:
+        keys = [event_key(event)]
+        if unit and metricexpr.event_pmu(event) == 'cpu' and '@' not in event:
+            # Unqualified events of a hybrid metric are counted on its PMU.
+            keys.insert(0, event_key(f'{unit}@{event}@'))
+        keys = tuple(keys)
+        if keys not in self._event_index:
+            self._event_index[keys] = len(self.events)
+            self.events.append(keys)
+        return f'E[{self._event_index[keys]}]'
+
+    def _compile(self, m: Dict[str, str], exprs: Dict[str, str]):
+        lower_metrics = {x.lower(): x for x in exprs}
+        unit = m.get('Unit', '')
+        src : List[Tuple[str, str]] = []
+        for kind, text in metricexpr.tokenize(m['MetricExpr']):
+            if kind == 'event':
+                py = self._event(text, unit)
+            elif kind == 'literal':
+                if text not in self.literals:
+                    raise Exception('Unknown literal', text, m['MetricName'])
+                py = repr(float(self.literals[text]))
+            elif kind == 'name' and text in metricexpr.keywords:
+                py = f' {text} '
+            elif kind == 'name' and text.lower() in lower_metrics:
+                py = f'M[{lower_metrics[text.lower()]!r}]'
+            elif kind == 'name':
+                py = self._event(text, unit)
+            elif text == '&':
+                # perf's & and | bind more loosely than comparisons, like
+                # Python's and and or.
+                py = ' and '
+            elif text == '|':
+                py = ' or '
+            elif text == '!':
+                py = ' ~'
+            else:
+                # ^ is written by _join_xor.
+                py = text
+            src.append((py, text))
+        tree = ast.parse(_join_xor(src).strip(), mode='eval')
+        tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+        return compile(tree, m['MetricName'], 'eval')
+
+    def event_keys(self) -> List[str]:
+        """The event keys the metrics may read."""
+        return sorted(set(k for keys in self.events for k in keys))
+
+    def evaluate(self, counts: Dict[str, np.ndarray], rows: int,
+                 scale: bool = False) -> Dict[str, np.ndarray]:
+        """Evaluate the metrics on counts, a map from event_key to an array
+        with a count for each of the rows. Missing counts are NaN and give
+        NaN metrics. With scale the results are multiplied by the metrics'
+        ScaleUnit."""
+        missing = np.full(rows, np.nan)
+        E = []
+        for keys in self.events:
+            v = missing
+            for k in keys:
+                if k in counts:
+                    v = counts[k]
+                    break
+            E.append(v)
+        M : Dict[str, np.ndarray] = {}
+        env = {'np': np, 'd_ratio': d_ratio, 'has_event': has_event,
+               'E': E, 'M': M}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name in self.order:
+                v = eval(self.code[name], env)
+                M[name] = np.broadcast_to(np.asarray(v, dtype=float), (rows,))
+        if not scale:
+            return {name: M[name] for name in self.names}
+        return {name: M[name] * scale_unit(self.jo[name].get('ScaleUnit'))[0]
+                for name in self.names}
+
+
+# The aggregation field of perf stat -x output.
+_ident_re = re.compile(r'CPU\d+|S\d+(?:-D\d+)?(?:-C\d+)?|N\d+|\S+-\d+')
+
+
+class StatLine:
+    """One count from perf stat -x output."""
+
+    def __init__(self, time: Optional[float], ident: str, event: str,
+                 value: float, running: float):
+        self.time = time
+        # The aggregation, like CPU0 or S0-D0-C1, empty for the whole system.
+        self.ident = ident
+        self.event = event
+        self.value = value
+        # Percentage of the enabled time the event was counting.
+        self.running = running
+
+
+def split_fields(line: str, sep: str) -> List[str]:
+    """Split a perf stat -x line, keeping separators within pmu/.../ event
+    names."""
+    line = line.rstrip('\n')
+    if '/' not in line:
+        return line.split(sep)
+    fields : List[str] = []
+    for x in line.split(sep):
+        if fields and fields[-1].count('/') % 2 == 1:
+            fields[-1] += sep + x
+        else:
+            fields.append(x)
+    return fields
+
+
+def parse_stat_line(line: str, sep: str = ',', unscaled: bool = False) -> Optional[StatLine]:
+    """Parse a count from perf stat -x sep output, optionally with -I and
+    -A or --per-socket/die/core aggregation. Returns None for lines without
+    a count. When unscaled, perf stat was run with --no-scale and the value
+    is scaled by the time the event was counting."""
+    if not line.strip() or line.startswith('#'):
+        return None
+    f = split_fields(line, sep)
+    if '.' in f[0] and f[0].strip().replace('.', '', 1).isdigit():
+        # The -I timestamp, unless the line is a count like task-clock's.
+        result = _parse_count(f[1:], float(f[0]), unscaled)
+        if result:
+            return result
+    return _parse_count(f, None, unscaled)
+
+
+def _parse_count(f: List[str], time: Optional[float], unscaled: bool) -> Optional[StatLine]:
+    ident = ''
+    if f and f[0][:1].isalpha() and _ident_re.fullmatch(f[0]):
+        ident = f[0]
+        # Socket, die, core and node aggregations give the number of CPUs
+        # aggregated.
+        f = f[2:] if ident[0] in 'SN' and ident[1].isdigit() else f[1:]
+    if len(f) < 3 or not f[2]:
+        return None
+    try:
+        value = float(f[0])
+    except ValueError:
+        if not f[0].startswith('<'):
+            return None
+        # <not counted> or <not supported>
+        value = np.nan
+    running = 100.0
+    if len(f) > 4:
+        try:
+            running = float(f[4])
+        except ValueError:
+            pass
+    if unscaled and running > 0:
+        value = value * 100.0 / running
+    return StatLine(time, ident, f[2], value, running)
+
+
+def count_table(lines: Sequence[StatLine], start: float = 0.0
+                ) -> Tuple[List[Tuple[Optional[float], str]], Dict[str, np.ndarray]]:
+    """Arrange counts into rows, one for each interval and aggregation,
+    returning the (time, ident) of each row and a map from event_key to an
+    array with the event's count in each row. start is the time the first
+    interval began."""
+    rows : Dict[Tuple[Optional[float], str], int] = {}
+    index : Dict[str, Tuple[List[int], List[float]]] = {}
+    for l in lines:
+        row = rows.setdefault((l.time, l.ident), len(rows))
+        r, v = index.setdefault(event_key(l.event), ([], []))
+        r.append(row)
+        v.append(l.value)
+    counts = {}
+    for key, (r, v) in index.items():
+        a = np.full(len(rows), np.nan)
+        a[r] = v
+        counts[key] = a
+    if len({ident for _, ident in rows}) > 1 and any(not ident for _, ident in rows):
+        # Events like duration_time are printed once rather than for each
+        # CPU, so share them with the other rows of the interval.
+        whole = {t: i for (t, ident), i in rows.items() if not ident}
+        keep = [i for (t, ident), i in rows.items() if ident]
+        src = np.array([whole.get(t, i) for (t, ident), i in rows.items() if ident])
+        for key, a in counts.items():
+            a = a[keep]
+            missing = np.isnan(a)
+            a[missing] = counts[key][src[missing]]
+            counts[key] = a
+        rows = {x: i for i, x in enumerate(x for x in rows if x[1])}
+    if 'duration_time' not in counts and rows and None not in {t for t, _ in rows}:
+        # Without a duration_time count use the length of each interval.
+        times = sorted({t for t, _ in rows})
+        begin = dict(zip(times, [start] + times[:-1]))
+        counts['duration_time'] = np.array([(t - begin[t]) * 1e9 for t, _ in rows])
+    return (list(rows), counts)
@@ -0,0 +1,160 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# shared code for parsing perf json MetricExpr formulas
+
+import re
+from typing import (Dict, Iterator, List, Sequence, Set, Tuple)
+
+# Names in a formula that are neither events nor metrics.
+keywords = set(['if', 'else', 'min', 'max', 'd_ratio', 'source_count',
+                'has_event', 'strcmp_cpuid_str'])
+
+# Events that aren't counted by a PMU counter.
+software_events = set(['duration_time', 'msr@tsc@'])
+
+token_patterns = (
+    # A PMU qualified event like cpu@EVENT\,cmask\=1@ or uncore_imc@cas_count_read@,
+    # possibly followed by modifiers.
+    ('event', r'[a-z_0-9]+@(?:[^@\\]|\\.)*@[a-z]*'),
+    ('event', r'topdown(?:\\-[a-z]+)+'),
+    ('literal', r'#[A-Za-z_]+'),
+    ('number', r'[0-9]+\.?[0-9]*(?:e[+-]?[0-9]+)?'),
+    ('name', r'[A-Za-z_][A-Za-z0-9_.]*'),
+    ('op', r'==|<=|>=|[-+*/%()<>,&|!^]'),
+    ('space', r'\s+'),
+)
+
+token_re = re.compile('|'.join(f'(?P<{kind}{i}>{pattern})' for i, (kind, pattern)
+                               in enumerate(token_patterns)))
+
+
+def token_spans(expr: str) -> Iterator[Tuple[str, str, int, int]]:
+    """Yield (kind, text, start, end) tuples for the tokens of a MetricExpr,
+    kind is one of 'event', 'literal', 'number', 'name' or 'op'."""
+    pos = 0
+    while pos < len(expr):
+        m = token_re.match(expr, pos)
+        if not m:
+            raise Exception('Bad token in expression', expr[pos:], expr)
+        pos = m.end()
+        kind = re.sub(r'[0-9]+$', '', m.lastgroup)
+        if kind != 'space':
+            yield (kind, m.group(0), m.start(), m.end())
+
+
+def tokenize(expr: str) -> Iterator[Tuple[str, str]]:
+    """Yield (kind, text) tuples for the tokens of a MetricExpr."""
+    for kind, text, _, _ in token_spans(expr):
+        yield (kind, text)
+
+
+def event_name(event: str) -> str:
+    """Strip the PMU and modifiers from an event, so cpu@EVENT\\,cmask\\=1@ is
+    EVENT."""
+    m = re.fullmatch(r'[a-z_0-9]+@((?:[^@\\]|\\.)*)@[a-z]*', event)
+    if m:
+        event = m.group(1)
+    event = re.sub(r'\\,.*', '', event)
+    return event.replace('\\', '').upper()
+
+
+def event_pmu(event: str) -> str:
+    """Return the PMU an event is qualified with, 'cpu' if there is none."""
+    m = re.fullmatch(r'([a-z_0-9]+)@(?:[^@\\]|\\.)*@[a-z]*', event)
+    if m:
+        return m.group(1)
+    return 'cpu'
+
+
+def references(expr: str, metrics: Dict[str, str]) -> Tuple[Set[str], Set[str]]:
+    """Return the events and the names of other metrics, keys in metrics,
+    used directly by expr."""
+    lower_metrics = {x.lower(): x for x in metrics}
+    events = set()
+    refs = set()
+    for kind, text in tokenize(expr):
+        if kind == 'event':
+            events.add(text)
+        elif kind == 'name' and text not in keywords:
+            if text.lower() in lower_metrics:
+                refs.add(lower_metrics[text.lower()])
+            else:
+                events.add(text)
+    return (events, refs)
+
+
+def metric_events(name: str, metrics: Dict[str, str]) -> Set[str]:
+    """Return the events used by the metric called name, including those of
+    the metrics it refers to. metrics maps a metric name to its MetricExpr."""
+    result: Set[str] = set()
+    visited: Set[str] = set()
+    todo = [name]
+    while todo:
+        x = todo.pop()
+        if x in visited:
+            continue
+        visited.add(x)
+        events, refs = references(metrics[x], metrics)
+        result |= events
+        todo.extend(refs)
+    return result
+
+
+def perf_event(event: str) -> str:
+    """Convert an event as written in a MetricExpr to perf's command line
+    syntax, so cpu@EVENT\\,cmask\\=1@ becomes cpu/EVENT,cmask=1/."""
+    m = re.fullmatch(r'([a-z_0-9]+)@((?:[^@\\]|\\.)*)@([a-z]*)', event)
+    if m:
+        event = f'{m.group(1)}/{m.group(2)}/{m.group(3)}'
+    return re.sub(r'\\(.)', r'\1', event)
+
+
+def select_metrics(jo: Sequence[Dict[str, str]], selectors: Sequence[str]) -> List[str]:
+    """Return the names of metrics that are named by, or in a MetricGroup
+    named by, selectors like 'TopdownL2;Mem'. The common subexpressions of
+    extract-tma-metrics.py --cse are only in HELPER_GROUP, so they are
+    selected by name or by that group."""
+    wanted = set()
+    for s in selectors:
+        wanted |= {x.lower() for x in re.split(r'[;,]', s) if x}
+    result = []
+    for m in jo:
+        groups = {x.lower() for x in m.get('MetricGroup', '').split(';')}
+        if m['MetricName'].lower() in wanted or groups & wanted:
+            result.append(m['MetricName'])
+    return result
+
+
+# The MetricGroup of metrics that only exist to be referred to by other
+# metrics. perf lists metrics by group, so they are kept out of the
+# groups users select.
+HELPER_GROUP = 'cse_helpers'
+
+
+def is_internal(m: Dict[str, str]) -> bool:
+    """Whether a metric only exists to be referred to by other metrics."""
+    return HELPER_GROUP in m.get('MetricGroup', '').split(';')
@@ -0,0 +1,95 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# write generated files atomically, leaving unchanged files untouched
+import collections
+import contextlib
+import io
+import os
+import threading
+from typing import (Dict, Iterator, Union)
+
+# Files written and left unchanged by this process since take_counts.
+_counts : Dict[str, int] = collections.Counter()
+_lock = threading.Lock()
+
+
+def write_if_changed(path: str, content: Union[str, bytes], encoding: str = 'ascii') -> bool:
+    """Replace path with content unless it already has that content, so the
+    mtimes of unchanged files and so incremental perf builds are kept. The
+    content is written to a temporary file that is renamed over path, so
+    readers never see a partial file. Returns whether path changed."""
+    data = content.encode(encoding) if isinstance(content, str) else content
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    with _lock:
+                        _counts['unchanged'] += 1
+                    return False
+    except OSError:
+        pass
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        # Unlike tempfile, creates the file with the umask applied.
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    with _lock:
+        _counts['changed'] += 1
+    return True
+
+
+@contextlib.contextmanager
+def open_output(path: str, encoding: str = 'ascii') -> Iterator[io.StringIO]:
+    """A text file for path written with write_if_changed when the block
+    completes without an exception."""
+    f = io.StringIO()
+    yield f
+    write_if_changed(path, f.getvalue(), encoding)
+
+
+def take_counts() -> Dict[str, int]:
+    """The counts of changed and unchanged files written since the last
+    call. Worker processes return theirs to be added to the caller's."""
+    global _counts
+    with _lock:
+        result = dict(_counts)
+        _counts = collections.Counter()
+    return result
+
+
+def add_counts(*counts: Dict[str, int]):
+    """Add the counts returned by worker processes."""
+    with _lock:
+        for c in counts:
+            _counts.update(c)
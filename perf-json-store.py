@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# write a perf json tree from a store keeping the unique records of many trees
+# perf-json-store.py store TAG outdir | --add TAG tree | --list
+import argparse
+import sys
+import eventstore
+import output
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Write a perf json tree kept in a store by download_and_gen.py --store')
+    ap.add_argument('store', help='Store directory')
+    ap.add_argument('tag', nargs='?', help='Tag of the tree to write')
+    ap.add_argument('outdir', nargs='?', help='Directory to write the tree to')
+    ap.add_argument('--add', nargs=2, metavar=('TAG', 'TREE'),
+                    help='Store the perf json tree in directory TREE as TAG instead')
+    ap.add_argument('--list', action='store_true', help='Print the tags of the stored trees')
+    args = ap.parse_args()
+
+    store = eventstore.Store(args.store)
+    if args.list:
+        for tag in store.tags():
+            print(tag)
+    elif args.add:
+        new = store.add_tree(*args.add)
+        print(f'{new} new objects, {store.count()} in the store')
+    elif args.tag and args.outdir:
+        store.materialize(args.tag, args.outdir)
+        counts = output.take_counts()
+        print(f'{counts.get("changed", 0)} files changed, '
+              f'{counts.get("unchanged", 0)} unchanged')
+    else:
+        sys.exit('Give a tag and output directory, --add or --list')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# write perf's pmu-events.c for a perf json tree, in place of jevents.py's, or check it
+# perf-json-to-c.py perf-tree pmu-events.c [--verify]
+import argparse
+import sys
+import output
+import ctables
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Write the pmu-events.c tables and functions perf's jevents.py would "
+        "generate for a perf json tree")
+    ap.add_argument('tree', help='Perf json tree with mapfile.csv, like download_and_gen.py --outdir')
+    ap.add_argument('cfile', help='C file to write')
+    ap.add_argument('--verify', action='store_true',
+                    help='Check that cfile has the events and metrics of tree rather than writing it')
+    args = ap.parse_args()
+
+    tables = ctables.read_tree(args.tree)
+    if args.verify:
+        with open(args.cfile, 'r') as f:
+            problems = ctables.verify(f.read(), tables)
+        for p in problems:
+            print(p)
+        sys.exit(1 if problems else 0)
+    output.write_if_changed(args.cfile, ctables.emit_c(tables), 'utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# compute metrics from the counts of perf stat -x, output (need numpy)
+# perf-stat-metrics.py cpu-metrics.json perf-stat.csv [metric|group ...]
+import argparse
+import csv
+import json
+import sys
+import metricexpr
+import metriceval
+import numpy as np
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Compute metrics from perf stat -x, [-I] [-A] output')
+    ap.add_argument('metrics', type=argparse.FileType('r'),
+                    help='Generated metrics json file')
+    ap.add_argument('stat', type=argparse.FileType('r'),
+                    help='perf stat -x output, - for stdin')
+    ap.add_argument('selectors', nargs='*',
+                    help='Metric names or MetricGroups, all metrics if none')
+    ap.add_argument('-x', dest='sep', default=',', help='perf stat field separator')
+    ap.add_argument('--literal', action='append', default=[],
+                    help='Value of a # literal, like SMT_on=1')
+    ap.add_argument('--unscaled', action='store_true',
+                    help='Counts are from perf stat --no-scale')
+    ap.add_argument('--json', action='store_true', help='Print json lines rather than CSV')
+    ap.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = ap.parse_args()
+
+    jo = json.load(args.metrics)
+    if args.selectors:
+        names = metricexpr.select_metrics(jo, args.selectors)
+        if not names:
+            sys.exit('No metrics match ' + ' '.join(args.selectors))
+    else:
+        names = [m['MetricName'] for m in jo if not metricexpr.is_internal(m)]
+    evaluator = metriceval.Evaluator(jo, names, metriceval.parse_literals(args.literal))
+
+    lines = []
+    for l in args.stat:
+        s = metriceval.parse_stat_line(l, args.sep, args.unscaled)
+        if s:
+            lines.append(s)
+    rows, counts = metriceval.count_table(lines)
+    values = evaluator.evaluate(counts, len(rows), scale=True)
+
+    if args.json:
+        for i, (time, ident) in enumerate(rows):
+            j = {'time': time, 'ident': ident}
+            j.update({n: float(values[n][i]) for n in names
+                      if np.isfinite(values[n][i])})
+            args.output.write(json.dumps(j) + '\n')
+        return
+    w = csv.writer(args.output)
+    w.writerow(['time', 'ident'] + names)
+    table = np.column_stack([values[n] for n in names]) if names else np.empty((len(rows), 0))
+    for (time, ident), v in zip(rows, table):
+        w.writerow(['' if time is None else time, ident] +
+                   [f'{x:g}' if np.isfinite(x) else '' for x in v])
+
+
+if __name__ == '__main__':
+    main()
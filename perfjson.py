@@ -89,6 +89,26 @@ def del_topic(n):
     del n["Topic"]
     return n
 
+def strip_values(n):
+    for k in n.keys():
+        if n[k] is None:
+            del n[k]
+            continue
+        n[k] = n[k].strip()
+        if n[k] == "0x00":
+            del n[k]
+    return n
+
+def normalize_event(j):
+    """The per event part of generating the perf json of an event file, on
+    an event cleaned by cleanjf. Returns the event's topic and the event, or
+    None if perf doesn't get the event."""
+    j = fix_names(j)
+    if j["EventName"].startswith("CORE_SNOOP") and "BriefDescription" not in j:
+        return None
+    topic = j["Topic"]
+    return topic, strip_values(del_topic(j))
+
 def del_dup_events(jf):
     events = {}
     for i in range(len(jf)):
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# plan the fewest perf stat runs that collect metrics without multiplexing
+# plan-metric-runs.py cpu-metrics.json cpu-events.json TopdownL2;Mem IPC
+import argparse
+import json
+import sys
+import counters
+import metricexpr
+import scheduler
+from typing import (Dict, List, Set, Sequence)
+
+
+class Run:
+    """A perf stat run counting one group of core events. A run that isn't
+    grouped has the events of metrics, in unfit, that can't be counted in
+    one group. They are counted ungrouped, like NO_GROUP_EVENTS, and
+    multiplexed."""
+
+    def __init__(self, grouped: bool = True):
+        self.core_events : Set[str] = set()
+        self.other_events : Set[str] = set()
+        self.metrics : List[str] = []
+        self.grouped = grouped
+        self.unfit : List[str] = []
+
+
+def plan_runs(jo: Sequence[Dict[str, str]], names: Sequence[str],
+              events: Dict[str, counters.EventCounters], unit: str,
+              htoff: bool, nmi_watchdog: bool) -> List[Run]:
+    """Pack the events of the metrics in names into the fewest runs where
+    each run's core events can be counted in one group. A metric whose
+    events don't fit in one group gets a run of its own that isn't
+    grouped."""
+    metrics = {m['MetricName']: m['MetricExpr'] for m in jo}
+    metric_events = {name: metricexpr.metric_events(name, metrics) for name in names}
+
+    def core(evs: Set[str]) -> Set[str]:
+        return {e for e in evs if counters.is_core_event(e, unit)}
+
+    def fits(evs: Set[str]) -> bool:
+        return scheduler.assign_counters(sorted(evs), events, unit, htoff,
+                                         nmi_watchdog) is not None
+
+    runs : List[Run] = []
+    # Largest first, placing each metric in the run it adds the fewest
+    # new events to.
+    for name in sorted(names, key=lambda x: (-len(core(metric_events[x])), x)):
+        evs = metric_events[name]
+        if not fits(core(evs)):
+            # Ungrouped events multiplex with all the others of a run, so
+            # only share a run that already has every event.
+            best = next((r for r in runs if not r.grouped and
+                         evs <= r.core_events | r.other_events), None)
+            if best is None:
+                best = Run(grouped=False)
+                best.core_events = core(evs)
+                best.other_events = evs - core(evs)
+                runs.append(best)
+            best.unfit.append(name)
+            continue
+        best = None
+        for r in runs:
+            if not r.grouped:
+                continue
+            if core(evs) <= r.core_events:
+                best = r
+                break
+            new_events = len(core(evs) - r.core_events)
+            if (best is None or new_events < len(core(evs) - best.core_events)) and \
+               fits(r.core_events | core(evs)):
+                best = r
+        if best is None:
+            best = Run()
+            runs.append(best)
+        best.core_events |= core(evs)
+        best.other_events |= evs - core(evs)
+
+    # A metric can be computed from every run that has all its events.
+    for r in runs:
+        for name in names:
+            if metric_events[name] <= r.core_events | r.other_events:
+                r.metrics.append(name)
+    return runs
+
+
+def event_string(r: Run) -> str:
+    """The perf stat -e argument for a run. TOPDOWN.SLOTS must lead a group
+    with topdown events."""
+    core = sorted(r.core_events, key=lambda x: (x != 'TOPDOWN.SLOTS', x))
+    result = []
+    if core and r.grouped:
+        result.append('{' + ','.join(metricexpr.perf_event(x) for x in core) + '}')
+    else:
+        result += [metricexpr.perf_event(x) for x in core]
+    result += [metricexpr.perf_event(x) for x in sorted(r.other_events)]
+    return ','.join(result)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('metrics', type=argparse.FileType('r'),
+                    help='Generated metrics json file')
+    ap.add_argument('events', type=argparse.FileType('r'),
+                    help='Event json file for the CPU')
+    ap.add_argument('selectors', nargs='+',
+                    help='Metric names or MetricGroups, like TopdownL2;Mem')
+    ap.add_argument('--unit', default='', help='PMU of the metrics, like cpu_core')
+    ap.add_argument('--htoff', action='store_true',
+                    help='Use the counters available with hyper-threading off')
+    ap.add_argument('--nmi-watchdog', action='store_true',
+                    help='Reserve a cycles counter for the NMI watchdog')
+    ap.add_argument('--json', action='store_true', help='Print the plan as json')
+    args = ap.parse_args()
+
+    jo = json.load(args.metrics)
+    if args.unit:
+        jo = [m for m in jo if m.get('Unit', args.unit) == args.unit]
+    events = counters.read_event_json([args.events])
+    names = metricexpr.select_metrics(jo, args.selectors)
+    if not names:
+        sys.exit('No metrics match ' + ' '.join(args.selectors))
+    runs = plan_runs(jo, names, events, args.unit, args.htoff, args.nmi_watchdog)
+
+    if args.json:
+        print(json.dumps([{'Events': event_string(r), 'Grouped': r.grouped,
+                           'Metrics': r.metrics, 'Unfit': r.unfit}
+                          for r in runs],
+                         sort_keys=True, indent=4, separators=(',', ': ')))
+        return
+    for i, r in enumerate(runs):
+        print(f'Run {i + 1}:' + ('' if r.grouped else
+                                 ' (ungrouped and multiplexed, the events of ' +
+                                 ' '.join(r.unfit) + " don't fit in one group)"))
+        print(f"\tperf stat -e '{event_string(r)}'")
+        print('\tMetrics: ' + ' '.join(r.metrics))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# assign core PMU counters to a group of events
+# scheduler.py event.json... < event-names
+
+import argparse
+import json
+import re
+import sys
+import counters
+from typing import (Dict, List, Optional, Sequence, TextIO)
+
+# Pseudo event for the NMI watchdog's cycles counter.
+NMI_WATCHDOG = 'nmi_watchdog'
+
+
+def match(candidates: Dict[str, List[str]]) -> Optional[Dict[str, str]]:
+    """Find a bipartite matching giving every key of candidates a distinct
+    resource from its list, None if there is none."""
+    owner : Dict[str, str] = {}
+
+    def augment(x: str, seen: set) -> bool:
+        for r in candidates[x]:
+            if r in seen:
+                continue
+            seen.add(r)
+            if r not in owner or augment(owner[r], seen):
+                owner[r] = x
+                return True
+        return False
+
+    for x in sorted(candidates):
+        if not augment(x, set()):
+            return None
+    return {x: r for r, x in owner.items()}
+
+
+class Schedule:
+    """The result of scheduling a group of events."""
+
+    def __init__(self, counters: Dict[str, str], msrs: Dict[str, str],
+                 conflicts: Sequence[str], unknown: Sequence[str] = ()):
+        # Map from event to the counter, like gp0 or fixed1, it is assigned.
+        self.counters = counters
+        # Map from event to the shared MSR it is assigned.
+        self.msrs = msrs
+        # A minimal set of events that can't be scheduled together, empty
+        # when the group can be scheduled.
+        self.conflicts = conflicts
+        # Core events missing from the event json, that can't be
+        # scheduled.
+        self.unknown = unknown
+
+    def ok(self) -> bool:
+        return not self.conflicts and not self.unknown
+
+
+def unknown_events(names: Sequence[str], events: Dict[str, counters.EventCounters],
+                   unit: str = '') -> List[str]:
+    """The core PMU events in names that need a counter but aren't in
+    events, so whether they fit is unknown."""
+    return sorted(set(x for x in names if counters.is_core_event(x, unit) and
+                      not counters.is_topdown_event(x) and
+                      not counters.find_event(x, events)))
+
+
+def _assign(names: Sequence[str], events: Dict[str, counters.EventCounters],
+            unit: str, htoff: bool,
+            nmi_watchdog: bool) -> Optional[Schedule]:
+    gp_counters = counters.num_counters(events, htoff)
+    candidates : Dict[str, List[str]] = {}
+    taken_alone = []
+    msr_candidates : Dict[str, List[str]] = {}
+    for name in names:
+        if not counters.is_core_event(name, unit):
+            continue
+        if counters.is_topdown_event(name):
+            # Read from PERF_METRICS so no counter is needed.
+            continue
+        e = counters.find_event(name, events)
+        if not e:
+            # Unknown events might need any counter, or one that is taken.
+            return None
+        gp = e.counters_htoff if htoff else e.counters
+        c = []
+        if e.fixed is not None and '\\,' not in name:
+            c.append(f'fixed{e.fixed}')
+        # Fixed counter events may use the architectural general purpose
+        # encoding when the fixed counter is busy.
+        c += [f'gp{x}' for x in sorted(gp or range(gp_counters))]
+        candidates[name] = c
+        if e.taken_alone:
+            taken_alone.append(name)
+        if e.msrs:
+            # Events like offcore response may use any of their MSRs, but
+            # each MSR holds the configuration of only one event.
+            msr_candidates[name] = e.msrs
+    if nmi_watchdog:
+        candidates[NMI_WATCHDOG] = ['fixed1'] + [f'gp{x}' for x in range(gp_counters)]
+    msrs = match(msr_candidates)
+    if msrs is None:
+        return None
+    result = match(candidates)
+    if result is None:
+        return None
+    # An event that must be taken alone can't share the general purpose
+    # counters with other events.
+    if taken_alone and (len(taken_alone) > 1 or
+                        any(r.startswith('gp') for x, r in result.items()
+                            if x not in taken_alone)):
+        return None
+    result.pop(NMI_WATCHDOG, None)
+    return Schedule(result, msrs, [])
+
+
+def schedule(names: Sequence[str], events: Dict[str, counters.EventCounters],
+             unit: str = '', htoff: bool = False,
+             nmi_watchdog: bool = False) -> Schedule:
+    """Schedule the events, as written in a MetricExpr or perf command line,
+    in names as one group. On failure the returned Schedule has a minimal
+    set of conflicting events, removing any one of which resolves that
+    conflict, or the events that are unknown."""
+    unknown = unknown_events(names, events, unit)
+    if unknown:
+        return Schedule({}, {}, [], unknown)
+    result = _assign(names, events, unit, htoff, nmi_watchdog)
+    if result:
+        return result
+    conflicts = sorted(set(names))
+    for x in list(conflicts):
+        trial = [y for y in conflicts if y != x]
+        if _assign(trial, events, unit, htoff, nmi_watchdog) is None:
+            conflicts = trial
+    return Schedule({}, {}, conflicts)
+
+
+def assign_counters(names: Sequence[str],
+                    events: Dict[str, counters.EventCounters],
+                    unit: str = '', htoff: bool = False,
+                    nmi_watchdog: bool = False) -> Optional[Dict[str, str]]:
+    """Assign a counter to each core PMU event, as written in a MetricExpr,
+    in names so that they can all be counted in one group. Returns a map
+    from event to counter name, or None if the events must multiplex or
+    some are unknown."""
+    result = _assign(names, events, unit, htoff, nmi_watchdog)
+    return result.counters if result else None
+
+
+def read_names(f: TextIO) -> List[str]:
+    """Read event names separated by white space or commas, as in a perf -e
+    option, ignoring group braces."""
+    names = []
+    for l in f:
+        l = re.sub(r'[{}]', ' ', l.split('#')[0])
+        names += [x for x in re.split(r'(?<!\\),|\s+', l) if x]
+    return names
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Assign counters to the events read from stdin')
+    ap.add_argument('jsonfile', type=argparse.FileType('r'), nargs='+',
+                    help='Event json file for the CPU')
+    ap.add_argument('--unit', default='', help='PMU of the events, like cpu_core')
+    ap.add_argument('--htoff', action='store_true',
+                    help='Use the counters available with hyper-threading off')
+    ap.add_argument('--nmi-watchdog', action='store_true',
+                    help='Reserve a cycles counter for the NMI watchdog')
+    ap.add_argument('--json', action='store_true', help='Print the result as json')
+    args = ap.parse_args()
+
+    events = counters.read_event_json(args.jsonfile)
+    names = read_names(sys.stdin)
+    s = schedule(names, events, args.unit, args.htoff, args.nmi_watchdog)
+    if args.json:
+        print(json.dumps({'Counters': s.counters, 'MSRs': s.msrs,
+                          'Conflicts': s.conflicts, 'Unknown': s.unknown},
+                         sort_keys=True, indent=4, separators=(',', ': ')))
+    elif s.ok():
+        for name in names:
+            if name in s.counters:
+                msr = f' {s.msrs[name]}' if name in s.msrs else ''
+                print(f'{name} {s.counters[name]}{msr}')
+            else:
+                print(f'{name} -')
+    elif s.unknown:
+        print('Unknown events: ' + ' '.join(s.unknown))
+    else:
+        print('Conflicting events: ' + ' '.join(s.conflicts))
+    sys.exit(0 if s.ok() else 1)
+
+
+if __name__ == '__main__':
+    main()
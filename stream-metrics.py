@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# compute metrics for each interval of a running perf stat -I -x, (need numpy)
+# perf stat -I 100 -x, -M TopdownL1 -a 2>&1 | stream-metrics.py cpu-metrics.json TopdownL1
+import argparse
+import json
+import sys
+import metricexpr
+import metriceval
+import numpy as np
+from typing import (List, Optional, Sequence, TextIO)
+
+
+class Interval:
+    """The counts read so far for one perf stat interval."""
+
+    def __init__(self, time: float):
+        self.time = time
+        self.lines : List[metriceval.StatLine] = []
+
+
+def emit(evaluator: metriceval.Evaluator, names: Sequence[str], interval: Interval,
+         start: float, partial: bool, out: TextIO):
+    """Evaluate the metrics for an interval and write a json line for each
+    aggregation."""
+    rows, counts = metriceval.count_table(interval.lines, start)
+    values = evaluator.evaluate(counts, len(rows), scale=True)
+    for i, (time, ident) in enumerate(rows):
+        j = {'time': time, 'ident': ident}
+        if partial:
+            j['partial'] = True
+        j.update({n: float(values[n][i]) for n in names if np.isfinite(values[n][i])})
+        out.write(json.dumps(j) + '\n')
+    out.flush()
+
+
+def stream(f: TextIO, evaluator: metriceval.Evaluator, names: Sequence[str],
+           sep: str, unscaled: bool, out: TextIO):
+    """Read perf stat -I output from f, writing each interval's metrics once
+    it is complete. Only the current interval is kept in memory."""
+    current : Optional[Interval] = None
+    start = 0.0
+    # The number of counts in a complete interval, learned from the first
+    # interval.
+    expected = None
+    done = None
+    for l in f:
+        s = metriceval.parse_stat_line(l, sep, unscaled)
+        if not s or s.time is None or s.time == done:
+            continue
+        if current and s.time != current.time:
+            # A new timestamp ends the previous interval.
+            if expected is None:
+                expected = len(current.lines)
+            emit(evaluator, names, current, start, len(current.lines) < expected, out)
+            start = current.time
+            current = None
+        if not current:
+            current = Interval(s.time)
+        current.lines.append(s)
+        if expected and len(current.lines) == expected:
+            # Don't wait for the next interval to start.
+            emit(evaluator, names, current, start, False, out)
+            start = done = current.time
+            current = None
+    if current and current.lines:
+        emit(evaluator, names, current, start,
+             expected is not None and len(current.lines) < expected, out)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Compute metrics for each interval of perf stat -I -x, output')
+    ap.add_argument('metrics', type=argparse.FileType('r'),
+                    help='Generated metrics json file')
+    ap.add_argument('selectors', nargs='+', help='Metric names or MetricGroups')
+    ap.add_argument('--input', type=argparse.FileType('r'), default=sys.stdin,
+                    help='perf stat output, a file or FIFO, default stdin')
+    ap.add_argument('-x', dest='sep', default=',', help='perf stat field separator')
+    ap.add_argument('--literal', action='append', default=[],
+                    help='Value of a # literal, like SMT_on=1')
+    ap.add_argument('--unscaled', action='store_true',
+                    help='Counts are from perf stat --no-scale')
+    args = ap.parse_args()
+
+    jo = json.load(args.metrics)
+    names = metricexpr.select_metrics(jo, args.selectors)
+    if not names:
+        sys.exit('No metrics match ' + ' '.join(args.selectors))
+    evaluator = metriceval.Evaluator(jo, names, metriceval.parse_literals(args.literal))
+    try:
+        stream(args.input, evaluator, names, args.sep, args.unscaled, sys.stdout)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+# run a DAG of tasks, I/O in threads and CPU bound work in processes
+import concurrent.futures
+import contextlib
+import multiprocessing
+import time
+from typing import (Any, Callable, Dict, List, Optional, Sequence)
+
+
+class Skip:
+    """Returned by a task to skip the tasks that depend on it."""
+
+
+SKIP = Skip()
+
+
+class Task:
+    """A step of work. fn is called with the results of deps, in order,
+    once deps and the tasks in after are done."""
+
+    def __init__(self, name: str, fn: Callable, deps: Sequence['Task'],
+                 after: Sequence['Task'], cpu: bool):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.after = list(after)
+        # CPU bound tasks run in another process so fn, the results of deps
+        # and the result must be picklable. Other tasks run in a thread and
+        # may update the caller's state.
+        self.cpu = cpu
+        self.status = 'pending'
+        self.result : Any = None
+        self.error : Optional[BaseException] = None
+        self.start : Optional[float] = None
+        self.end : Optional[float] = None
+
+    def duration(self) -> Optional[float]:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+def _timed(fn: Callable, *args) -> tuple:
+    """Run fn in a worker, returning its result and start and end times."""
+    start = time.time()
+    result = fn(*args)
+    return result, start, time.time()
+
+
+def process_pool(workers: Optional[int] = None) -> concurrent.futures.ProcessPoolExecutor:
+    # Forking while fetching threads hold locks is unsafe.
+    return concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('forkserver'))
+
+
+class TaskGraph:
+    """Tasks run as soon as the tasks they depend on are done, so fetches
+    overlap conversions within and across models."""
+
+    def __init__(self):
+        self.tasks : List[Task] = []
+
+    def add(self, name: str, fn: Callable, deps: Sequence[Task] = (),
+            after: Sequence[Task] = (), cpu: bool = False) -> Task:
+        t = Task(name, fn, deps, after, cpu)
+        self.tasks.append(t)
+        return t
+
+    def run(self, io_workers: int = 16, cpu_workers: Optional[int] = None,
+            processes: Optional[concurrent.futures.Executor] = None):
+        """Run every task. A task whose dependency failed or was skipped is
+        skipped. Raises the first failure once no more tasks can run. The
+        CPU bound tasks run in processes, if given, so that the state of the
+        workers outlives the run. Only the results of tasks that no other
+        task depends on are kept."""
+        running : Dict[concurrent.futures.Future, Task] = {}
+        # The number of tasks yet to be submitted or skipped that look at
+        # each task's result. Once none remain the result is dropped, so
+        # that fetched files aren't held until the end of the run.
+        waiting : Dict[int, int] = {}
+        for t in self.tasks:
+            for d in t.deps + t.after:
+                waiting[id(d)] = waiting.get(id(d), 0) + 1
+
+        def release(t: Task):
+            for d in t.deps + t.after:
+                waiting[id(d)] -= 1
+                if waiting[id(d)] == 0 and d.status == 'done':
+                    d.result = None
+
+        with concurrent.futures.ThreadPoolExecutor(io_workers) as threads, \
+             contextlib.nullcontext(processes) if processes else \
+             process_pool(cpu_workers) as processes:
+            while True:
+                for t in self.tasks:
+                    if t.status != 'pending':
+                        continue
+                    if any(d.status in ('failed', 'skipped') or
+                           isinstance(d.result, Skip) for d in t.deps + t.after):
+                        t.status = 'skipped'
+                        t.result = SKIP
+                        release(t)
+                        continue
+                    if all(d.status == 'done' for d in t.deps + t.after):
+                        pool = processes if t.cpu else threads
+                        f = pool.submit(_timed, t.fn, *[d.result for d in t.deps])
+                        t.status = 'running'
+                        running[f] = t
+                        release(t)
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    t = running.pop(f)
+                    try:
+                        t.result, t.start, t.end = f.result()
+                        t.status = 'done'
+                        if waiting.get(id(t)) == 0:
+                            t.result = None
+                    except Exception as e:
+                        t.error = e
+                        t.status = 'failed'
+        for t in self.tasks:
+            if t.status == 'failed':
+                raise Exception(f'Task {t.name} failed: {t.error!r}') from t.error
+
+    def report(self) -> List[Dict[str, Any]]:
+        """The status and duration in seconds of each task."""
+        result = []
+        for t in self.tasks:
+            r = {'Name': t.name, 'Status': t.status}
+            if t.duration() is not None:
+                r['Seconds'] = round(t.duration(), 3)
+            if t.error:
+                r['Error'] = str(t.error)
+            result.append(r)
+        return result
@@ -0,0 +1,69 @@
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# test extract-tma-metrics.py metric selection
+# python -m unittest test_extract_tma_metrics
+import importlib
+import io
+import unittest
+
+etm = importlib.import_module('extract-tma-metrics')
+
+HEADER = ('Key,Level1,Level2,Level3,Level4,Count Domain,Metric Description,'
+          'Metric Group,Threshold,Locate-with,SKX\n')
+
+CSV = HEADER + '''Info.Thread,IPC,,,,Thread,Instructions Per Cycle (per Logical Processor),Ret;Summary,,,INST_RETIRED.ANY / CLKS
+Info.Thread,CLKS,,,,Thread,Per-Logical Processor actual clocks when the Logical Processor is active.,Pipeline,,,CPU_CLK_UNHALTED.THREAD
+Info.System,Socket_CLKS,,,,Slots,Socket actual clocks when any core is active on that socket,SoC,,,UNC_CHA_CLOCKTICKS:one_unit
+'''
+
+
+def extract(**kwargs):
+    return etm.extract_tma_metrics(io.StringIO(CSV), 'SKX', None, False, None, '',
+                                   False, False, None, **kwargs)
+
+
+class TestSelection(unittest.TestCase):
+
+    def test_metrics(self):
+        names = {m['MetricName'] for m in extract(metrics=['IPC'])}
+        self.assertEqual(names, {'IPC', 'CLKS'})
+
+    def test_uncore_freq(self):
+        # No CSV metric is selected, UNCORE_FREQ needs Socket_CLKS.
+        jo = extract(metrics=['UNCORE_FREQ'])
+        self.assertEqual({m['MetricName'] for m in jo}, {'UNCORE_FREQ', 'Socket_CLKS'})
+        freq = [m for m in jo if m['MetricName'] == 'UNCORE_FREQ'][0]
+        self.assertIn('Socket_CLKS', freq['MetricExpr'])
+
+    def test_soc_group(self):
+        names = {m['MetricName'] for m in extract(metric_groups=['SoC'])}
+        self.assertEqual(names, {'UNCORE_FREQ', 'Socket_CLKS'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# Copyright (c) 2022, Intel Corporation
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of Intel Corporation nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# collect TMA metrics level by level, descending only into bottlenecks
+# tma-drilldown.py cpu-tma-tree.json [-- workload]
+import argparse
+import json
+import re
+import subprocess
+import sys
+import tempfile
+from typing import (Any, Dict, List, Sequence)
+
+
+def read_tree(f) -> Dict[str, Dict[str, Any]]:
+    """Read the tree written by extract-tma-metrics.py --tree, returning a
+    map from metric name to node with an added Children list."""
+    nodes = {n['MetricName']: n for n in json.load(f)}
+    for n in nodes.values():
+        n['Children'] = []
+    for n in nodes.values():
+        if n.get('Parent') in nodes:
+            nodes[n['Parent']]['Children'].append(n['MetricName'])
+    return nodes
+
+
+def parse_perf_stat(output: str, names: Sequence[str]) -> Dict[str, float]:
+    """Read metric values for names from perf stat -x, output, as fractions
+    rather than percentages."""
+    wanted = set(names)
+    result = {}
+    for l in output.splitlines():
+        m = re.search(r'(?:^|,)([-+0-9.e]+),(%?)\s*([A-Za-z0-9_]+)\s*$', l)
+        if not m or m.group(3) not in wanted:
+            continue
+        try:
+            value = float(m.group(1))
+        except ValueError:
+            continue
+        if m.group(2):
+            value /= 100
+        # Hybrid systems report a value for each core PMU, a node is a
+        # bottleneck if it is on any of them.
+        result[m.group(3)] = max(value, result.get(m.group(3), value))
+    return result
+
+
+def collect(perf: str, names: Sequence[str], target: Sequence[str]) -> Dict[str, float]:
+    """Run perf stat for just the metrics in names."""
+    with tempfile.NamedTemporaryFile('r') as out:
+        cmd = [perf, 'stat', '-x,', '-o', out.name, '-M', ','.join(names)] + list(target)
+        subprocess.run(cmd, check=True)
+        return parse_perf_stat(out.read(), names)
+
+
+def drilldown(nodes: Dict[str, Dict[str, Any]], perf: str, target: Sequence[str],
+              max_level: int, default_threshold: float,
+              verbose: bool) -> List[Dict[str, Any]]:
+    """Collect Level 1, then each following level only for the children of
+    nodes above their threshold. Returns the collected stages."""
+    stages = []
+    todo = [n for n in nodes if 'Parent' not in nodes[n]]
+    while todo:
+        level = min(nodes[n]['Level'] for n in todo)
+        if level > max_level:
+            break
+        if verbose:
+            print(f'Level {level}: ' + ' '.join(todo), file=sys.stderr)
+        values = collect(perf, todo, target)
+        bottlenecks = [n for n in todo if n in values and
+                       values[n] > nodes[n].get('Threshold', default_threshold)]
+        stages.append({'Level': level, 'Values': values, 'Bottlenecks': bottlenecks})
+        todo = [c for n in bottlenecks for c in nodes[n]['Children']]
+    return stages
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Collect TMA metrics in stages, only for the subtrees of bottlenecks',
+        epilog='Measure the command after --, else the whole system for --duration')
+    ap.add_argument('tree', type=argparse.FileType('r'),
+                    help='Tree written by extract-tma-metrics.py --tree')
+    ap.add_argument('--perf', default='perf')
+    ap.add_argument('--duration', type=float, default=1,
+                    help='Seconds to measure each stage without a workload')
+    ap.add_argument('--max-level', type=int, default=6)
+    ap.add_argument('--threshold', type=float, default=0.1,
+                    help='Threshold for nodes without one in the tree')
+    ap.add_argument('--json', action='store_true', help='Print the stages as json')
+    ap.add_argument('--verbose', action='store_true')
+    argv = sys.argv[1:]
+    workload = []
+    if '--' in argv:
+        workload = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = ap.parse_args(argv)
+
+    nodes = read_tree(args.tree)
+    # Every stage measures the workload again, or a fresh window of the
+    # whole system.
+    target = ['--'] + workload if workload else ['-a', '--', 'sleep', f'{args.duration:g}']
+    stages = drilldown(nodes, args.perf, target, args.max_level, args.threshold,
+                       args.verbose)
+
+    if args.json:
+        print(json.dumps(stages, sort_keys=True, indent=4, separators=(',', ': ')))
+        return
+
+    values = {}
+    for s in stages:
+        values.update(s['Values'])
+    bottlenecks = set(n for s in stages for n in s['Bottlenecks'])
+
+    def show(name: str):
+        if name not in values:
+            return
+        indent = '  ' * (nodes[name]['Level'] - 1)
+        mark = ' <==' if name in bottlenecks else ''
+        print(f'{indent}{name} {values[name] * 100:.1f}%{mark}')
+        for c in nodes[name]['Children']:
+            show(c)
+
+    for n in nodes:
+        if 'Parent' not in nodes[n]:
+            show(n)
+
+
+if __name__ == '__main__':
+    main()
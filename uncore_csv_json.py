@@ -35,6 +35,7 @@ import copy
 import argparse
 import itertools
 import re
+import output
 from typing import (Dict, Optional, TextIO)
 
 repl_events = {
@@ -86,7 +87,10 @@ def update(j):
 
 def uncore_csv_json(csvfile: TextIO, jsonfile: TextIO,
                     extrajsonfile: Optional[TextIO],
-                    targetdir: str, all_events: bool, verbose: bool):
+                    targetdir: str, all_events: bool,
+                    verbose: bool) -> Dict[str, list]:
+    """Write the uncore events of jsonfile, fixed up by csvfile, to targetdir,
+    returning a map from topic file name to its events."""
     verboseprint = print if verbose else lambda *a, **k: None
     events = read_events(jsonfile)
     events2 = read_events(extrajsonfile) if extrajsonfile else None
@@ -276,15 +280,16 @@ def uncore_csv_json(csvfile: TextIO, jsonfile: TextIO,
     def get_topic(j):
         return j["Topic"]
 
+    topics = {}
     for topic, iter in itertools.groupby(sorted(jl, key=get_topic), key=get_topic):
         events : list[Dict[str, str]] = list(iter)
         for j in events:
             del j["Topic"]
         verboseprint("generating", topic)
-        of = open(targetdir + "/" + topic.lower() + ".json", "w", encoding='ascii')
         js = json.dumps(events, sort_keys=True, indent=4, separators=(',', ': '))
-        print(js, file=of)
-        of.close()
+        output.write_if_changed(targetdir + "/" + topic.lower() + ".json", js + "\n")
+        topics[topic.lower() + ".json"] = events
+    return topics
 
 def main():
     ap = argparse.ArgumentParser()